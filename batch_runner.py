@@ -0,0 +1,188 @@
+"""
+Массовый прогон партий без окна на пуле процессов.
+
+    python batch_runner.py --levels 1-35 --seeds 0-99 --policies idle,hunter --ticks 9000 -o results.csv
+
+Каждая партия - один уровень с заданным сидом и стратегией игроков, до победы, поражения
+или лимита тиков. Рабочие процессы живут весь прогон, поэтому картинки (IMAGE_CACHE)
+и разобранные карты (MAP_CACHE) загружаются в каждом из них один раз.
+Результаты пишутся в CSV по мере готовности партий, порядок строк произвольный
+"""
+import argparse
+import csv
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pygame
+
+import main
+from main import Game, SimpleEnemy, QuickTank, QuickFireTank, StrongTank, UP, DOWN, LEFT, RIGHT
+
+# Типы врагов в порядке кодов из файлов уровней (Game.enemies_amount)
+ENEMY_TYPES = (SimpleEnemy, QuickTank, QuickFireTank, StrongTank)
+FIELDS = ('level', 'seed', 'policy', 'two_players', 'winner', 'ticks', 'base_destroyed',
+          'kills_simple', 'kills_quick', 'kills_quickfire', 'kills_strong', 'enemies_left', 'score',
+          'tick_ms_mean', 'tick_ms_p99', 'tick_ms_max', 'elapsed_s')
+
+
+class IdlePolicy:
+    """
+    Игроки стоят на месте и не стреляют: проверка, как уровень проходят одни враги
+    """
+    def __init__(self, seed):
+        pass
+
+    def __call__(self, game):
+        return dict()
+
+
+class RandomPolicy:
+    """
+    Игрок едет в случайную сторону несколько тиков подряд и иногда стреляет
+    """
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.commands = dict()
+
+    def __call__(self, game):
+        commands = dict()
+        for player in game.players.sprites():
+            direction, left = self.commands.get(player.number, (None, 0))
+            if left <= 0:
+                direction, left = self.random.choice((None, UP, DOWN, LEFT, RIGHT)), self.random.randint(4, 16)
+            self.commands[player.number] = (direction, left - 1)
+            commands[player.number] = (direction, self.random.random() < 0.1)
+        return commands
+
+
+class HunterPolicy:
+    """
+    Игрок выравнивается с ближайшим врагом по одной из осей, разворачивается к нему
+    и стреляет. Пока едет, изредка стреляет перед собой, чтобы пробивать стены
+    """
+    def __init__(self, seed):
+        pass
+
+    def __call__(self, game):
+        commands = dict()
+        enemies = game.enemies.sprites()
+        for player in game.players.sprites():
+            if not enemies:
+                commands[player.number] = (None, False)
+                continue
+            x, y = player.rect.center
+            enemy = min(enemies, key=lambda enemy: abs(enemy.rect.centerx - x) + abs(enemy.rect.centery - y))
+            dx, dy = enemy.rect.centerx - x, enemy.rect.centery - y
+            if abs(dx) <= 10:
+                direction = DOWN if dy > 0 else UP
+                commands[player.number] = (direction, player.facing == direction)
+            elif abs(dy) <= 10:
+                direction = RIGHT if dx > 0 else LEFT
+                commands[player.number] = (direction, player.facing == direction)
+            else:
+                if abs(dx) < abs(dy):
+                    direction = RIGHT if dx > 0 else LEFT
+                else:
+                    direction = DOWN if dy > 0 else UP
+                commands[player.number] = (direction, game.tick % 10 == 0 and player.facing == direction)
+        return commands
+
+
+POLICIES = {'idle': IdlePolicy, 'random': RandomPolicy, 'hunter': HunterPolicy}
+
+
+def init_worker(two_players):
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    pygame.init()
+    main.TWO_PLAYERS = two_players
+
+
+def run_match(level, seed, policy, ticks):
+    """
+    Одна партия в рабочем процессе, возвращает строку результатов для CSV
+    """
+    start = time.perf_counter()
+    game = Game(level, headless=True, seed=seed)
+    script = POLICIES[policy](seed)
+    kills = [0] * len(ENEMY_TYPES)
+    enemies = set()
+    times = []
+    # Уровень увеличивается сразу при победе, следующий уровень уже не считаем.
+    # При поражении уровень сбрасывается на первый, поэтому game_over проверяется отдельно
+    while game.run and game.tick < ticks and game.level == level and not game.game_over:
+        tick_start = time.perf_counter()
+        game.step(script(game))
+        times.append(time.perf_counter() - tick_start)
+        # Враг покидает группу только уничтоженным
+        current = set(game.enemies.sprites())
+        for enemy in enemies - current:
+            kills[ENEMY_TYPES.index(type(enemy))] += 1
+        enemies = current
+    if game.game_over:
+        winner = 'enemies'
+    elif game.level != level:
+        winner = 'players'
+    else:
+        winner = 'none'
+    times.sort()
+    return {
+        'level': level, 'seed': seed, 'policy': policy, 'two_players': int(main.TWO_PLAYERS), 'winner': winner,
+        'ticks': game.tick, 'base_destroyed': int(game.game_over and len(game.players) > 0),
+        'kills_simple': kills[0], 'kills_quick': kills[1], 'kills_quickfire': kills[2], 'kills_strong': kills[3],
+        'enemies_left': len(game.enemy_list) + len(enemies),
+        'score': sum(player.score for player in game.player_slots if player is not None),
+        'tick_ms_mean': round(sum(times) / len(times) * 1000, 4) if times else 0,
+        'tick_ms_p99': round(times[int(len(times) * 0.99)] * 1000, 4) if times else 0,
+        'tick_ms_max': round(times[-1] * 1000, 4) if times else 0,
+        'elapsed_s': round(time.perf_counter() - start, 3),
+    }
+
+
+def parse_numbers(text):
+    """
+    '1-5,8,10-12' -> [1, 2, 3, 4, 5, 8, 10, 11, 12]
+    """
+    numbers = []
+    for part in text.split(','):
+        first, _, last = part.partition('-')
+        numbers.extend(range(int(first), int(last or first) + 1))
+    return numbers
+
+
+def get_levels():
+    return sorted(int(name.split('_')[1].split('.')[0]) for name in os.listdir('data/levels')
+                  if name.startswith('level_'))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Массовый прогон партий без окна')
+    parser.add_argument('--levels', type=parse_numbers, help='уровни, например 1-10,15; по умолчанию все')
+    parser.add_argument('--seeds', type=parse_numbers, default=[0], help='сиды партий, например 0-999')
+    parser.add_argument('--policies', default='hunter', help='стратегии игроков через запятую: ' +
+                        ', '.join(POLICIES))
+    parser.add_argument('--ticks', type=int, default=main.FPS * 60 * 5, help='лимит тиков на партию')
+    parser.add_argument('--two-players', action='store_true', help='партии на двоих')
+    parser.add_argument('--workers', type=int, help='число процессов, по умолчанию по числу ядер')
+    parser.add_argument('-o', '--output', default='results.csv', help='файл результатов')
+    args = parser.parse_args()
+    policies = args.policies.split(',')
+    for policy in policies:
+        if policy not in POLICIES:
+            parser.error(f'unknown policy {policy}')
+    jobs = [(level, seed, policy, args.ticks) for level in args.levels or get_levels()
+            for seed in args.seeds for policy in policies]
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(args.two_players,)) as executor, \
+            open(args.output, 'w', newline='') as file:
+        writer = csv.DictWriter(file, FIELDS)
+        writer.writeheader()
+        futures = [executor.submit(run_match, *job) for job in jobs]
+        for done, future in enumerate(as_completed(futures), 1):
+            writer.writerow(future.result())
+            file.flush()
+            print(f'\r{done}/{len(jobs)} matches, {time.perf_counter() - start:.1f} s', end='', file=sys.stderr)
+    print(file=sys.stderr)
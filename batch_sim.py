@@ -0,0 +1,760 @@
+"""
+Пакетная симуляция для обучения ботов: много независимых партий за один шаг.
+
+Состояние всех партий лежит в массивах NumPy (структура массивов): у танков, снарядов
+и карты первая ось - номер партии. Шаг идет по правилам Tank.update, Enemy.update
+и Bullet.update из main.py и в том же порядке, что Game.step, но каждая операция
+выполняется сразу для всех партий. Внутри партии танки и снаряды обновляются
+по очереди, как спрайты в группах, потому что каждый видит уже сдвинутых предшественников:
+на i-м проходе обновляется i-й по порядку танк (снаряд) каждой партии.
+
+Отличия от Game:
+    - карта хранится четвертями клеток, кирпич и так разрушается четвертями,
+      поэтому столкновения с местностью совпадают с масками Terrain;
+    - случайные решения берутся из генератора NumPy, поэтому партии с Game при одном сиде
+      не совпадают;
+    - враги поворачивают только случайно, без карты путей Navigation
+      (как в Game при ENEMY_NAVIGATION = 0);
+    - враги думают каждый тик без бюджета (как при AI_THINK_INTERVAL = 1 и AI_BUDGET = None);
+    - мест под врагов и снаряды в партии ограниченное число: враг без свободного места
+      ждет в очереди, выстрел без свободного места не происходит;
+    - после проигрыша номер уровня не сбрасывается;
+    - загрузочные экраны, звуки, анимации и сохранение прогресса не моделируются
+"""
+import os
+
+import numpy as np
+import pygame
+
+from main import CELL_SIZE, PLAYGROUND_WIDTH, FPS, BULLET_STEP, UP, DOWN, LEFT, RIGHT, IMAGE_CACHE, \
+    load_image, get_mask, read_map
+
+# Четверть клетки: кирпич разрушается половинами и четвертями
+QUARTER = CELL_SIZE // 2
+GRID = 26 * 2
+# Материалы карты, коды совпадают с кодами в файлах уровней
+EMPTY, BRICK, CONCRETE, WATER, ICE, GRASS = range(6)
+OBSTACLES = np.array([False, True, True, True, False, False])
+PLAYER_BULLET_OBSTACLES = np.array([False, True, True, False, False, False])
+TANK_SIZE = CELL_SIZE * 2 - 10
+BULLET_SIZE = 17
+BONUS_SIZE = CELL_SIZE * 2
+# Направления - индексы в FACINGS.
+# Команда игрока: 0 - стоять, 1..4 - ехать в направлении с индексом команда - 1
+FACINGS = (UP, DOWN, LEFT, RIGHT)
+FACING_UP, FACING_DOWN, FACING_LEFT, FACING_RIGHT = range(4)
+DX = np.array([0, 0, -1, 1])
+DY = np.array([-1, 1, 0, 0])
+INVERSE = np.array([FACING_DOWN, FACING_UP, FACING_RIGHT, FACING_LEFT])
+PERPENDICULAR = np.array([(FACING_LEFT, FACING_RIGHT), (FACING_LEFT, FACING_RIGHT),
+                          (FACING_UP, FACING_DOWN), (FACING_UP, FACING_DOWN)])
+FLAG_POSITION = (PLAYGROUND_WIDTH // 2 - CELL_SIZE + 5, PLAYGROUND_WIDTH - CELL_SIZE * 2 + 5)
+# Наборы кадров танков как в Player.change_tier и Enemy.make_bonus. Номер набора игрока -
+# номер игрока * 4 + уровень танка - 1, врага - 8 + тип, еще + 4 у врага с бонусом
+FRAME_SETS = (
+    ('tier1_tank', 'tier1_tank_2'), ('tier2_tank', 'tier2_tank_2'),
+    ('tier3_tank', 'tier3_tank_2'), ('tier4_tank', 'tier4_tank_2'),
+    ('tier1_tank_second', 'tier1_tank_second_2'), ('tier2_tank_second', 'tier2_tank_second_2'),
+    ('tier2_tank_second', 'tier2_tank_second_2'), ('tier4_tank_second', 'tier4_tank_second_2'),
+) + tuple((f'enemy_tier{tier}_tank', f'enemy_tier{tier}_tank_2') for tier in range(1, 5)) + \
+    tuple((f'enemy_tier{tier}_tank', f'tier{tier}_tank_bonus_2', f'enemy_tier{tier}_tank_2', f'tier{tier}_tank_bonus')
+          for tier in range(1, 5))
+PLAYER_POSITIONS = np.array([(CELL_SIZE * 9, CELL_SIZE * 24), (CELL_SIZE * 16, CELL_SIZE * 24)])
+ENEMY_POSITIONS = np.array([(CELL_SIZE * 12, 0), (CELL_SIZE * 24, 0), (0, 0)])
+# Враги по типу из файла уровня: скорость, скорость снаряда, прочность, награда
+ENEMY_TYPES = np.array([(60, 240, 1, 0), (90, 240, 1, 200), (60, 480, 1, 300), (60, 240, 4, 400)])
+PLAYER_SPEED = 90
+# Виды бонусов в порядке Game.create_bonus
+BONUS_STAR, BONUS_CLOCK, BONUS_GRENADE, BONUS_HELMET, BONUS_SHOVEL, BONUS_TANK = range(6)
+# Клетки кирпичей вокруг базы: строки 23-25, столбцы 11-14
+BASE_ROWS, BASE_COLUMNS = slice(46, 52), slice(22, 30)
+SPAWN_DURATION = FPS
+LEVEL_END_DELAY = FPS * 4
+
+TANK_FIELDS = {
+    'alive': bool, 'group': bool, 'spawn_group': bool, 'spawning': bool, 'spawn_count': np.int32,
+    'x': np.int32, 'y': np.int32, 'vx': np.int32, 'vy': np.int32, 'velocity': np.int32, 'facing': np.int8,
+    'durability': np.int32, 'lives': np.int32, 'tier': np.int32, 'bullet_speed': np.int32,
+    'bullet_limit': np.int32, 'terminating': bool, 'immortal': bool, 'immortal_count': np.int32,
+    'immortal_duration': np.int32, 'frozen': bool, 'freeze_count': np.int32, 'freeze_duration': np.int32,
+    'bonus': bool, 'reward': np.int32, 'kind': np.int8, 'serial': np.int64, 'score': np.int64,
+    'stay': bool, 'frames': np.int8, 'phase': np.int8,
+    # Кадр, с которого взята маска для попаданий: как Tank.shown_frame
+    'shown_frames': np.int8, 'shown_facing': np.int8, 'shown_phase': np.int8,
+}
+BULLET_FIELDS = {
+    'alive': bool, 'serial': np.int64, 'x': np.int32, 'y': np.int32, 'vx': np.float64, 'vy': np.float64,
+    'facing': np.int8, 'owner': np.int32, 'owner_serial': np.int64, 'owner_player': bool,
+    'terminating': bool, 'shifted': bool, 'phase': np.int32,
+}
+GAME_FIELDS = {
+    'run': bool, 'tick': np.int64, 'spawn_tick': np.int64, 'level': np.int32, 'level_end_timer': np.int64,
+    'game_over': bool, 'flag': bool, 'enemies_left': np.int32, 'queue_position': np.int32,
+    'enemies_amount': np.int32, 'enemy_position_index': np.int32, 'base_protected': bool,
+    'base_protection_count': np.int32, 'base_protection_duration': np.int32, 'bonus_kind': np.int8,
+    'bonus_x': np.int32, 'bonus_y': np.int32, 'tank_serial': np.int64, 'bullet_serial': np.int64,
+}
+LAST = np.iinfo(np.int64).max
+
+
+class Table:
+    """
+    Поля сущностей одного вида во всех партиях: массивы формы (партии, места)
+    """
+    def __init__(self, games, slots, fields):
+        self.slots = slots
+        for name, dtype in fields.items():
+            setattr(self, name, np.zeros((games, slots), dtype))
+
+
+class MaskAtlas:
+    """
+    Маски столкновений из картинок игры в массивах NumPy: снаряд по направлениям,
+    база и все наборы кадров танков по направлениям и фазам
+    """
+    def __init__(self):
+        frames = IMAGE_CACHE.get_frames(('bullet',), (BULLET_SIZE, BULLET_SIZE), (0, 0, 0))
+        self.bullet = np.array([mask_to_array(frames.masks[facing][0]) for facing in FACINGS])
+        self.flag = mask_to_array(get_mask(load_image('flag', (TANK_SIZE, TANK_SIZE), -1)))
+        self.lengths = np.array([len(names) for names in FRAME_SETS])
+        self.tanks = np.zeros((len(FRAME_SETS), len(FACINGS), self.lengths.max(), TANK_SIZE, TANK_SIZE), bool)
+        for index, names in enumerate(FRAME_SETS):
+            frames = IMAGE_CACHE.get_frames(names, (TANK_SIZE, TANK_SIZE))
+            for facing, key in enumerate(FACINGS):
+                for phase, mask in enumerate(frames.masks[key]):
+                    self.tanks[index, facing, phase] = mask_to_array(mask)
+
+
+class BatchGame:
+    """
+    games партий одновременно. Места 0 и 1 в таблице танков - игроки, остальные - враги.
+    step(directions, shoots) - один тик всех идущих партий, команды - массивы формы (партии, 2)
+    """
+    # Общие для всех пакетов маски, строятся при создании первого пакета
+    masks = None
+
+    def __init__(self, games, level=1, two_players=False, seed=None, enemy_slots=4, bullet_slots=16):
+        if BatchGame.masks is None:
+            BatchGame.masks = MaskAtlas()
+        self.games = games
+        self.two_players = two_players
+        self.random = np.random.default_rng(seed)
+        self.tanks = Table(games, 2 + enemy_slots, TANK_FIELDS)
+        self.bullets = Table(games, bullet_slots, BULLET_FIELDS)
+        self.player_slots = np.arange(self.tanks.slots) < 2
+        self.terrain = np.zeros((games, GRID, GRID), np.uint8)
+        self.base_blocks = np.zeros((games, 3, 4), bool)
+        self.enemy_queue = np.zeros((games, 20), np.int8)
+        for name, dtype in GAME_FIELDS.items():
+            setattr(self, name, np.zeros(games, dtype))
+        self.maps = dict()
+        self.reset(level=level)
+
+    def reset(self, games=None, level=1):
+        """
+        Новая партия с уровня level в указанных партиях (по умолчанию во всех)
+        """
+        games = np.arange(self.games) if games is None else np.asarray(games)
+        self.run[games] = True
+        self.game_over[games] = False
+        self.tick[games] = 0
+        self.spawn_tick[games] = 0
+        self.base_protection_count[games] = 0
+        self.base_protection_duration[games] = FPS * 10
+        lives = np.array([3, 3 if self.two_players else 0])
+        for game in games:
+            self.init_level(game, level, (1, 1), lives)
+
+    def load_map(self, level):
+        if level not in self.maps:
+            cells, amounts = read_map(f'data/levels/level_{level}.txt')
+            cells = np.array(cells, np.uint8)
+            self.maps[level] = (cells.repeat(2, 0).repeat(2, 1), cells[23:26, 11:15] == BRICK, amounts)
+        return self.maps[level]
+
+    def init_level(self, game, level, tiers, lives):
+        """
+        Карта, игроки и очередь врагов уровня в одной партии. Игрок без жизней не появляется
+        """
+        terrain, base_blocks, amounts = self.load_map(level)
+        self.terrain[game] = terrain
+        self.base_blocks[game] = base_blocks
+        self.level[game] = level
+        self.level_end_timer[game] = -1
+        self.flag[game] = True
+        self.base_protected[game] = False
+        self.bonus_kind[game] = -1
+        self.tanks.alive[game] = self.tanks.group[game] = self.tanks.spawn_group[game] = False
+        self.bullets.alive[game] = False
+        self.tank_serial[game] = 2
+        for slot in range(2):
+            if lives[slot] > 0:
+                self.init_players(np.array([game]), np.array([slot]), tiers[slot], lives[slot])
+                self.tanks.spawn_group[game, slot] = True
+        enemy_list = np.repeat(np.arange(4), amounts)
+        self.random.shuffle(enemy_list)
+        enemy_list = enemy_list[:20]
+        self.enemy_queue[game, :len(enemy_list)] = enemy_list
+        self.queue_position[game] = 0
+        self.enemies_left[game] = len(enemy_list)
+        self.enemies_amount[game] = sum(amounts)
+        self.enemy_position_index[game] = 0
+
+    def init_players(self, games, slots, tier, lives):
+        t = self.tanks
+        t.alive[games, slots] = t.group[games, slots] = t.spawning[games, slots] = True
+        t.spawn_count[games, slots] = 0
+        t.x[games, slots] = PLAYER_POSITIONS[slots, 0]
+        t.y[games, slots] = PLAYER_POSITIONS[slots, 1]
+        t.vx[games, slots] = t.vy[games, slots] = 0
+        t.velocity[games, slots] = PLAYER_SPEED // FPS
+        t.facing[games, slots] = FACING_UP
+        t.durability[games, slots] = 1
+        t.lives[games, slots] = lives
+        t.tier[games, slots] = tier
+        t.bullet_speed[games, slots] = 240
+        t.bullet_limit[games, slots] = 1
+        t.terminating[games, slots] = False
+        t.immortal[games, slots] = True
+        t.immortal_count[games, slots] = 0
+        t.immortal_duration[games, slots] = FPS * 3
+        t.frozen[games, slots] = False
+        t.bonus[games, slots] = False
+        t.reward[games, slots] = 0
+        t.kind[games, slots] = -1
+        t.serial[games, slots] = slots
+        t.score[games, slots] = 0
+        t.stay[games, slots] = True
+        t.frames[games, slots] = t.phase[games, slots] = 0
+        t.frames[games, slots] = slots * 4
+        self.show_frame(games, slots)
+        self.change_tier(games, slots)
+
+    def change_tier(self, games, slots):
+        t = self.tanks
+        tier = t.tier[games, slots]
+        t.bullet_speed[games, slots] = np.where(tier >= 2, 480, t.bullet_speed[games, slots])
+        t.bullet_limit[games, slots] = np.where(tier >= 3, 2, t.bullet_limit[games, slots])
+        t.durability[games, slots] = np.where(tier == 4, 2, t.durability[games, slots])
+        t.frames[games, slots] = slots * 4 + tier - 1
+
+    def show_frame(self, games, slots):
+        t = self.tanks
+        t.shown_frames[games, slots] = t.frames[games, slots]
+        t.shown_facing[games, slots] = t.facing[games, slots]
+        t.shown_phase[games, slots] = t.phase[games, slots]
+
+    def animate(self, games, slots):
+        t = self.tanks
+        moving = ~t.stay[games, slots]
+        games, slots = games[moving], slots[moving]
+        t.phase[games, slots] = (t.phase[games, slots] + 1) % self.masks.lengths[t.frames[games, slots]]
+        self.show_frame(games, slots)
+
+    def simulate(self, ticks, script=None):
+        """
+        ticks тиков всех партий. script(batch) возвращает команды на тик: (directions, shoots)
+        """
+        for _ in range(ticks):
+            if not self.run.any():
+                break
+            self.step(*script(self)) if script is not None else self.step()
+        return self.tick
+
+    def step(self, directions=None, shoots=None):
+        """
+        Один тик всех идущих партий в порядке Game.step.
+        directions - команды движения игроков (партии, 2), shoots - нажатия выстрела (партии, 2)
+        """
+        t = self.tanks
+        live = self.run.copy()
+        self.tick[live] += 1
+        self.apply_commands(live, directions, shoots)
+        for games, slots in self.ordered(t, t.group & ~self.player_slots, live):
+            self.update_tanks(games, slots)
+        for games, slots in self.ordered(self.bullets, self.bullets.alive, live):
+            self.update_bullets(games, slots)
+        protected = live & self.base_protected
+        expired = protected & (self.base_protection_count >= self.base_protection_duration)
+        self.make_base_unprotected(np.nonzero(expired)[0])
+        self.base_protection_count[protected & ~expired] += 1
+        for games, slots in self.ordered(t, t.group & self.player_slots, live):
+            self.update_tanks(games, slots)
+        for games, slots in self.ordered(t, t.spawn_group, live):
+            self.update_tanks(games, slots)
+        spawned = t.spawn_group & ~t.spawning & live[:, None]
+        t.spawn_group[spawned] = False
+        t.group[spawned] = True
+        self.spawn_enemies(live)
+        players = t.group[:, :2].sum(1)
+        enemies = (t.group & ~self.player_slots).sum(1)
+        self.game_over |= live & (players == 0)
+        won = live & (self.enemies_left == 0) & (enemies == 0) & (self.level_end_timer < 0)
+        self.level[won] += 1
+        self.level_end_timer[won] = self.tick[won]
+        self.enemies_amount[live] = self.enemies_left[live]
+        lost = live & self.game_over & (self.level_end_timer < 0)
+        self.level_end_timer[lost] = self.tick[lost]
+        ended = live & (self.level_end_timer >= 0) & (self.tick - self.level_end_timer >= LEVEL_END_DELAY)
+        self.run[ended & self.game_over] = False
+        for game in np.nonzero(ended & ~self.game_over)[0]:
+            if os.path.exists(f'data/levels/level_{self.level[game]}.txt'):
+                lives = np.where(t.group[game, :2], t.lives[game, :2], 0)
+                self.init_level(game, self.level[game], t.tier[game, :2].copy(), lives)
+            else:
+                self.run[game] = False
+        self.flag &= ~self.game_over
+
+    def ordered(self, table, members, live):
+        """
+        Места сущностей в порядке их групп: на i-м проходе - партии, где есть i-я сущность,
+        и ее места. Состав берется на начало прохода, как в Group.update
+        """
+        members = members & live[:, None]
+        order = np.argsort(np.where(members, table.serial, LAST), axis=1, kind='stable')
+        count = members.sum(1)
+        for rank in range(count.max(initial=0)):
+            games = np.nonzero(count > rank)[0]
+            yield games, order[games, rank]
+
+    def apply_commands(self, live, directions, shoots):
+        t = self.tanks
+        for slot in range(2):
+            games = np.nonzero(live & t.group[:, slot])[0]
+            slots = np.full(len(games), slot)
+            command = np.zeros(len(games), int) if directions is None else np.asarray(directions)[games, slot]
+            moving = command > 0
+            facing = np.maximum(command - 1, 0)
+            velocity = t.velocity[games, slot]
+            t.vx[games, slot] = np.where(moving, DX[facing] * velocity, 0)
+            t.vy[games, slot] = np.where(moving, DY[facing] * velocity, 0)
+            if shoots is not None:
+                shooting = np.asarray(shoots)[games, slot].astype(bool)
+                self.shoot(games[shooting], slots[shooting])
+
+    def update_tanks(self, games, slots):
+        """
+        Общее начало Tank.update и Enemy.update: взрыв, появление, проверка прочности
+        """
+        t = self.tanks
+        ending = t.terminating[games, slots]
+        lives = t.lives[games, slots] - 1
+        respawn = ending & (slots < 2) & (lives > 0)
+        removed = ending & ~respawn
+        t.alive[games[removed], slots[removed]] = False
+        t.group[games[removed], slots[removed]] = False
+        t.spawn_group[games[removed], slots[removed]] = False
+        self.init_players(games[respawn], slots[respawn], 1, lives[respawn])
+        games, slots = games[~removed], slots[~removed]
+        spawning = t.spawning[games, slots]
+        waiting = spawning & (t.spawn_count[games, slots] < SPAWN_DURATION)
+        spawned = spawning & ~waiting
+        self.show_frame(games[spawned], slots[spawned])
+        t.spawning[games[spawned], slots[spawned]] = False
+        t.spawn_count[games[waiting], slots[waiting]] += 1
+        games, slots = games[~waiting], slots[~waiting]
+        broken = t.durability[games, slots] <= 0
+        t.terminating[games[broken], slots[broken]] = True
+        games, slots = games[~broken], slots[~broken]
+        # На одном проходе у каждой партии не больше одного танка, поэтому игроков и врагов
+        # можно обновлять отдельно
+        player = slots < 2
+        self.update_players(games[player], slots[player])
+        self.update_enemies(games[~player], slots[~player])
+
+    def update_players(self, games, slots):
+        t = self.tanks
+        self.move_tanks(games, slots)
+        t.stay[games, slots] = (t.vx[games, slots] == 0) & (t.vy[games, slots] == 0)
+        self.change_angle(games, slots)
+        self.take_bonuses(games, slots)
+        self.animate(games, slots)
+        immortal = t.immortal[games, slots]
+        games, slots = games[immortal], slots[immortal]
+        over = t.immortal_count[games, slots] >= t.immortal_duration[games, slots]
+        t.immortal[games[over], slots[over]] = False
+        t.immortal_count[games[~over], slots[~over]] += 1
+
+    def update_enemies(self, games, slots):
+        t = self.tanks
+        frozen = t.frozen[games, slots]
+        self.move_tanks(games[~frozen], slots[~frozen], choose_direction=True)
+        frozen_games, frozen_slots = games[frozen], slots[frozen]
+        t.stay[frozen_games, frozen_slots] = True
+        thawed = t.freeze_count[frozen_games, frozen_slots] >= t.freeze_duration[frozen_games, frozen_slots]
+        t.frozen[frozen_games[thawed], frozen_slots[thawed]] = False
+        t.freeze_count[frozen_games[~thawed], frozen_slots[~thawed]] += 1
+        shooting = self.random.integers(0, 8, len(games)) == 0
+        self.shoot(games[shooting], slots[shooting])
+        self.change_angle(games, slots)
+        self.animate(games, slots)
+
+    def move_tanks(self, games, slots, choose_direction=False):
+        """
+        Сдвиг по вертикали, затем по горизонтали. Танк, уже наехавший на другой,
+        может разъехаться с ним; враг, упершись, выбирает новое направление
+        """
+        t = self.tanks
+        for position, velocity in ((t.y, t.vy), (t.x, t.vx)):
+            x, y = t.x[games, slots], t.y[games, slots]
+            stuck = self.count_tanks(games, slots, x, y) > 1
+            old = position[games, slots]
+            new = old + velocity[games, slots]
+            if position is t.y:
+                y = new
+            else:
+                x = new
+            blocked = self.terrain_hits(games, x, y, TANK_SIZE, TANK_SIZE) | \
+                (new < 0) | (new + TANK_SIZE > PLAYGROUND_WIDTH)
+            blocked |= ~stuck & (self.count_tanks(games, slots, x, y) > 1)
+            position[games, slots] = np.where(blocked, old, new)
+            if choose_direction and blocked.any():
+                self.choose_new_direction(games[blocked], slots[blocked], stuck[blocked])
+
+    def count_tanks(self, games, slots, x, y):
+        """
+        Число танков групп игроков и врагов, пересекающих танк в положении (x, y), вместе с ним самим
+        """
+        t = self.tanks
+        collided = t.group[games] & (np.abs(t.x[games] - x[:, None]) < TANK_SIZE) & \
+            (np.abs(t.y[games] - y[:, None]) < TANK_SIZE)
+        collided[np.arange(len(games)), slots] = t.group[games, slots]
+        return collided.sum(1)
+
+    def terrain_hits(self, games, x, y, width, height, materials=OBSTACLES):
+        """
+        Пересекает ли прямоугольник четверти клеток из материалов materials, как Terrain.collides_rect
+        """
+        if not len(games):
+            return np.zeros(0, bool)
+        rows, valid_rows = get_quarter_span(y, height)
+        columns, valid_columns = get_quarter_span(x, width)
+        quarters = self.terrain[games[:, None, None], rows[:, :, None], columns[:, None, :]]
+        return (materials[quarters] & valid_rows[:, :, None] & valid_columns[:, None, :]).any((1, 2))
+
+    def choose_new_direction(self, games, slots, ignore_players):
+        """
+        Как Enemy.choose_new_direction: два поворота в случайном порядке, затем разворот
+        """
+        t = self.tanks
+        facing = t.facing[games, slots]
+        new_direction = INVERSE[facing]
+        turns = PERPENDICULAR[facing]
+        swap = self.random.integers(0, 2, len(games)).astype(bool)
+        undecided = np.ones(len(games), bool)
+        for candidate in (np.where(swap, turns[:, 1], turns[:, 0]), np.where(swap, turns[:, 0], turns[:, 1])):
+            x = t.x[games, slots] + DX[candidate] * TANK_SIZE
+            y = t.y[games, slots] + DY[candidate] * TANK_SIZE
+            free = ~self.terrain_hits(games, x, y, TANK_SIZE, TANK_SIZE)
+            free &= np.select([candidate == FACING_UP, candidate == FACING_DOWN, candidate == FACING_LEFT],
+                              [y >= 0, y + TANK_SIZE <= PLAYGROUND_WIDTH, x >= 0], x + TANK_SIZE <= PLAYGROUND_WIDTH)
+            players = t.group[games, :2] & (np.abs(t.x[games, :2] - x[:, None]) < TANK_SIZE) & \
+                (np.abs(t.y[games, :2] - y[:, None]) < TANK_SIZE)
+            free &= ignore_players | ~players.any(1)
+            chosen = undecided & free
+            new_direction[chosen] = candidate[chosen]
+            undecided &= ~free
+        velocity = t.velocity[games, slots]
+        t.vx[games, slots] = DX[new_direction] * velocity
+        t.vy[games, slots] = DY[new_direction] * velocity
+        t.facing[games, slots] = new_direction
+        t.stay[games, slots] = False
+
+    def change_angle(self, games, slots):
+        t = self.tanks
+        vx, vy = t.vx[games, slots], t.vy[games, slots]
+        t.facing[games, slots] = np.select([vy < 0, vx < 0, vy > 0, vx > 0],
+                                           [FACING_UP, FACING_LEFT, FACING_DOWN, FACING_RIGHT],
+                                           t.facing[games, slots])
+
+    def shoot(self, games, slots):
+        t, b = self.tanks, self.bullets
+        allowed = ~t.frozen[games, slots] & ~t.spawning[games, slots]
+        # Снаряд в полете и взрывающийся снаряд занимают лимит владельца
+        owned = (b.alive[games] & (b.owner[games] == slots[:, None]) &
+                 (b.owner_serial[games] == t.serial[games, slots][:, None])).sum(1)
+        free = ~b.alive[games]
+        allowed &= (owned < t.bullet_limit[games, slots]) & free.any(1)
+        games, slots, places = games[allowed], slots[allowed], free[allowed].argmax(1)
+        facing = t.facing[games, slots]
+        speed = t.bullet_speed[games, slots] / FPS
+        b.alive[games, places] = True
+        b.serial[games, places] = self.bullet_serial[games]
+        self.bullet_serial[games] += 1
+        b.x[games, places] = t.x[games, slots] + TANK_SIZE // 2 + DX[facing] * (TANK_SIZE // 2) - BULLET_SIZE // 2
+        b.y[games, places] = t.y[games, slots] + TANK_SIZE // 2 + DY[facing] * (TANK_SIZE // 2) - BULLET_SIZE // 2
+        b.vx[games, places] = DX[facing] * speed
+        b.vy[games, places] = DY[facing] * speed
+        b.facing[games, places] = facing
+        b.owner[games, places] = slots
+        b.owner_serial[games, places] = t.serial[games, slots]
+        b.owner_player[games, places] = slots < 2
+        b.terminating[games, places] = b.shifted[games, places] = False
+        b.phase[games, places] = 0
+
+    def update_bullets(self, games, slots):
+        """
+        Как Bullet.update: взрыв в три кадра или полет шагами не больше BULLET_STEP
+        """
+        b = self.bullets
+        ending = b.terminating[games, slots]
+        ending_games, ending_slots = games[ending], slots[ending]
+        shift = ~b.shifted[ending_games, ending_slots]
+        b.x[ending_games[shift], ending_slots[shift]] -= 15
+        b.y[ending_games[shift], ending_slots[shift]] -= 15
+        b.shifted[ending_games, ending_slots] = True
+        over = b.phase[ending_games, ending_slots] >= 3
+        b.alive[ending_games[over], ending_slots[over]] = False
+        b.phase[ending_games[~over], ending_slots[~over]] += 1
+        games, slots = games[~ending], slots[~ending]
+        start_x, start_y = b.x[games, slots], b.y[games, slots]
+        vx, vy = b.vx[games, slots], b.vy[games, slots]
+        steps = np.maximum(1, np.ceil(np.maximum(np.abs(vx), np.abs(vy)) / BULLET_STEP)).astype(int)
+        flying = np.ones(len(games), bool)
+        for step in range(1, steps.max(initial=1) + 1):
+            flying &= steps >= step
+            index = np.nonzero(flying)[0]
+            step_games, step_slots = games[index], slots[index]
+            b.x[step_games, step_slots] = start_x[index] + np.rint(vx[index] * step / steps[index]).astype(int)
+            b.y[step_games, step_slots] = start_y[index] + np.rint(vy[index] * step / steps[index]).astype(int)
+            self.check_collisions(step_games, step_slots)
+            flying[index] &= ~b.terminating[step_games, step_slots]
+        x, y = b.x[games, slots], b.y[games, slots]
+        out = (y + BULLET_SIZE < 0) | (y > PLAYGROUND_WIDTH) | (x + BULLET_SIZE < 0) | (x > PLAYGROUND_WIDTH)
+        b.terminating[games[out], slots[out]] = True
+
+    def check_collisions(self, games, slots):
+        """
+        Как Bullet.check_collisions: танк противника, местность, база, другие снаряды.
+        Все пересечения считаются по маскам картинок, как get_collided_by_mask
+        """
+        t, b = self.tanks, self.bullets
+        x, y = b.x[games, slots], b.y[games, slots]
+        masks = self.masks.bullet[b.facing[games, slots]]
+        player = b.owner_player[games, slots]
+        targets = t.group[games] & (self.player_slots[None, :] != player[:, None]) & \
+            overlap(x[:, None], y[:, None], BULLET_SIZE, BULLET_SIZE, t.x[games], t.y[games], TANK_SIZE, TANK_SIZE)
+        rows, places = np.nonzero(targets)
+        tank_games = games[rows]
+        targets[rows, places] = masks_overlap(
+            masks[rows], x[rows], y[rows],
+            self.masks.tanks[t.shown_frames[tank_games, places], t.shown_facing[tank_games, places],
+                             t.shown_phase[tank_games, places]],
+            t.x[tank_games, places], t.y[tank_games, places])
+        hit = targets.any(1)
+        target = np.where(targets, t.serial[games], LAST).argmin(1)
+        hit_games, hit_slots, hit_targets = games[hit], slots[hit], target[hit]
+        scoring = player[hit]
+        t.score[hit_games[scoring], b.owner[hit_games[scoring], hit_slots[scoring]]] += \
+            t.reward[hit_games[scoring], hit_targets[scoring]]
+        self.make_under_fire(hit_games, hit_targets)
+        b.terminating[hit_games, hit_slots] = True
+        # Попавший в танк снаряд дальше не проверяется
+        rest = ~hit
+        games, slots, player, x, y, masks = games[rest], slots[rest], player[rest], x[rest], y[rest], masks[rest]
+        materials = self.get_materials(games, x, y)
+        walls = (np.where(player[:, None, None], PLAYER_BULLET_OBSTACLES[materials], OBSTACLES[materials]) &
+                 masks).any((1, 2))
+        self.hit_blocks(games[walls], slots[walls], x[walls], y[walls], masks[walls], materials[walls])
+        b.terminating[games[walls], slots[walls]] = True
+        base = self.flag[games] & masks_overlap(masks, x, y, self.masks.flag[None], *FLAG_POSITION)
+        b.terminating[games[base], slots[base]] = True
+        self.game_over[games[base]] = True
+        collided = b.alive[games] & overlap(x[:, None], y[:, None], BULLET_SIZE, BULLET_SIZE,
+                                            b.x[games], b.y[games], BULLET_SIZE, BULLET_SIZE)
+        collided[np.arange(len(games)), slots] = False
+        rows, places = np.nonzero(collided)
+        bullet_games = games[rows]
+        collided[rows, places] = masks_overlap(masks[rows], x[rows], y[rows],
+                                               self.masks.bullet[b.facing[bullet_games, places]],
+                                               b.x[bullet_games, places], b.y[bullet_games, places])
+        rows, places = np.nonzero(collided)
+        b.terminating[games[rows], places] = True
+        crashed = collided.any(1)
+        b.terminating[games[crashed], slots[crashed]] = True
+
+    def get_materials(self, games, x, y):
+        """
+        Материал карты под каждой точкой снаряда: массив (снаряды, BULLET_SIZE, BULLET_SIZE)
+        """
+        pixels = np.arange(BULLET_SIZE)
+        rows, columns = to_quarter(y[:, None] + pixels), to_quarter(x[:, None] + pixels)
+        valid = ((rows >= 0) & (rows < GRID))[:, :, None] & ((columns >= 0) & (columns < GRID))[:, None, :]
+        rows, columns = np.clip(rows, 0, GRID - 1), np.clip(columns, 0, GRID - 1)
+        return np.where(valid, self.terrain[games[:, None, None], rows[:, :, None], columns[:, None, :]], EMPTY)
+
+    def hit_blocks(self, games, slots, x, y, masks, materials):
+        """
+        Блоки под маской снаряда: кирпич теряет ближайший к снаряду ряд четвертей,
+        бетон разрушает только снаряд игрока четвертого уровня
+        """
+        b, t = self.bullets, self.tanks
+        pixels = np.arange(BULLET_SIZE)
+        pixel_rows, pixel_columns = (y[:, None] + pixels) // CELL_SIZE, (x[:, None] + pixels) // CELL_SIZE
+        solid = OBSTACLES[materials] & masks
+        facing = b.facing[games, slots]
+        breaks_concrete = b.owner_player[games, slots] & (t.tier[games, b.owner[games, slots]] == 4)
+        first_rows, last_rows = pixel_rows[:, 0], pixel_rows[:, -1]
+        first_columns, last_columns = pixel_columns[:, 0], pixel_columns[:, -1]
+        for row, column, valid in ((first_rows, first_columns, True),
+                                   (first_rows, last_columns, last_columns != first_columns),
+                                   (last_rows, first_columns, last_rows != first_rows),
+                                   (last_rows, last_columns, (last_rows != first_rows) & (last_columns != first_columns))):
+            touched = valid & (solid & (pixel_rows == row[:, None])[:, :, None] &
+                               (pixel_columns == column[:, None])[:, None, :]).any((1, 2))
+            cell_games, row, column = games[touched], row[touched] * 2, column[touched] * 2
+            area = (cell_games[:, None, None], row[:, None, None] + np.arange(2)[:, None],
+                    column[:, None, None] + np.arange(2))
+            quarters = self.terrain[area]
+            brick = quarters == BRICK
+            cell_facing = facing[touched]
+            vertical = cell_facing <= FACING_DOWN
+            present = np.where(vertical[:, None], brick.any(2), brick.any(1))
+            # Снаряд снизу или справа сносит дальний от начала ряд, сверху или слева - ближний
+            line = np.where((cell_facing == FACING_UP) | (cell_facing == FACING_LEFT),
+                            np.where(present[:, 1], 1, 0), np.where(present[:, 0], 0, 1))
+            hit = np.zeros_like(brick)
+            index = np.arange(len(cell_games))
+            hit[index[vertical], line[vertical], :] = True
+            hit[index[~vertical], :, line[~vertical]] = True
+            quarters[brick & hit] = EMPTY
+            quarters[breaks_concrete[touched] & (quarters == CONCRETE).any((1, 2))] = EMPTY
+            self.terrain[area] = quarters
+
+    def make_under_fire(self, games, slots):
+        t = self.tanks
+        hurt = ~t.immortal[games, slots]
+        games, slots = games[hurt], slots[hurt]
+        t.durability[games, slots] -= 1
+        drop = (slots >= 2) & t.bonus[games, slots]
+        t.bonus[games[drop], slots[drop]] = False
+        self.create_bonus(games[drop])
+
+    def create_bonus(self, games):
+        self.bonus_kind[games] = self.random.integers(0, 6, len(games))
+        self.bonus_x[games] = self.random.integers(0, PLAYGROUND_WIDTH - CELL_SIZE * 2 + 1, len(games))
+        self.bonus_y[games] = self.random.integers(0, PLAYGROUND_WIDTH - CELL_SIZE * 2 + 1, len(games))
+
+    def take_bonuses(self, games, slots):
+        t = self.tanks
+        taken = (self.bonus_kind[games] >= 0) & overlap(t.x[games, slots], t.y[games, slots], TANK_SIZE, TANK_SIZE,
+                                                        self.bonus_x[games], self.bonus_y[games],
+                                                        BONUS_SIZE, BONUS_SIZE)
+        games, slots = games[taken], slots[taken]
+        kind = self.bonus_kind[games]
+        self.bonus_kind[games] = -1
+        helmet = kind == BONUS_HELMET
+        t.immortal[games[helmet], slots[helmet]] = True
+        t.immortal_duration[games[helmet], slots[helmet]] = FPS * 10
+        t.immortal_count[games[helmet], slots[helmet]] = 0
+        t.lives[games[kind == BONUS_TANK], slots[kind == BONUS_TANK]] += 1
+        enemies = np.zeros((self.games, t.slots), bool)
+        enemies[games[kind == BONUS_GRENADE]] = t.group[games[kind == BONUS_GRENADE]] & ~self.player_slots
+        t.terminating[enemies] = True
+        enemies[:] = False
+        enemies[games[kind == BONUS_CLOCK]] = t.group[games[kind == BONUS_CLOCK]] & ~self.player_slots
+        t.frozen[enemies] = True
+        t.freeze_duration[enemies] = FPS * 10
+        t.freeze_count[enemies] = 0
+        self.make_base_protected(games[kind == BONUS_SHOVEL])
+        star = (kind == BONUS_STAR) & (t.tier[games, slots] < 4)
+        t.tier[games[star], slots[star]] += 1
+        self.change_tier(games[star], slots[star])
+
+    def make_base_protected(self, games):
+        # Бетон встает на место всех кирпичей базы, даже уже разрушенных
+        blocks = self.base_blocks[games].repeat(2, 1).repeat(2, 2)
+        area = self.terrain[games, BASE_ROWS, BASE_COLUMNS]
+        area[blocks] = CONCRETE
+        self.terrain[games, BASE_ROWS, BASE_COLUMNS] = area
+        self.base_protected[games] = True
+        self.base_protection_duration[games] = FPS * 20
+        self.base_protection_count[games] = 0
+
+    def make_base_unprotected(self, games):
+        # Уцелевший бетон снова становится целым кирпичом
+        blocks = self.base_blocks[games].repeat(2, 1).repeat(2, 2)
+        area = self.terrain[games, BASE_ROWS, BASE_COLUMNS]
+        area[blocks & (area != EMPTY)] = BRICK
+        self.terrain[games, BASE_ROWS, BASE_COLUMNS] = area
+        self.base_protected[games] = False
+
+    def spawn_enemies(self, live):
+        """
+        Условие Game.step для выпуска следующего врага из очереди
+        """
+        t = self.tanks
+        players = t.group[:, :2].sum(1)
+        on_field = (t.group & ~self.player_slots).sum(1) + t.spawn_group.sum(1)
+        delay = (190 - self.level * 4 - (players - 1) * 20) // 60 * FPS
+        due = (self.tick - self.spawn_tick > delay) & (self.enemies_left > 0) & (on_field < 4) | \
+            (self.enemies_left == 20)
+        free = ~t.alive[:, 2:]
+        games = np.nonzero(live & due & free.any(1))[0]
+        slots = 2 + free[games].argmax(1)
+        position = ENEMY_POSITIONS[self.enemy_position_index[games] % len(ENEMY_POSITIONS)]
+        self.enemy_position_index[games] += 1
+        kind = self.enemy_queue[games, self.queue_position[games]]
+        self.queue_position[games] += 1
+        self.enemies_left[games] -= 1
+        self.spawn_tick[games] = self.tick[games]
+        velocity, bullet_speed, durability, reward = ENEMY_TYPES[kind].T
+        t.alive[games, slots] = t.spawn_group[games, slots] = t.spawning[games, slots] = True
+        t.group[games, slots] = False
+        t.spawn_count[games, slots] = 0
+        t.x[games, slots], t.y[games, slots] = position.T
+        t.velocity[games, slots] = velocity // FPS
+        t.vx[games, slots] = -(velocity // FPS)
+        t.vy[games, slots] = 0
+        t.facing[games, slots] = FACING_DOWN
+        t.durability[games, slots] = durability
+        t.lives[games, slots] = 1
+        t.tier[games, slots] = 1
+        t.bullet_speed[games, slots] = bullet_speed
+        t.bullet_limit[games, slots] = 1
+        t.terminating[games, slots] = t.immortal[games, slots] = t.frozen[games, slots] = False
+        t.bonus[games, slots] = np.isin(self.enemies_amount[games], (4, 11, 18))
+        t.reward[games, slots] = reward
+        t.kind[games, slots] = kind
+        t.serial[games, slots] = self.tank_serial[games]
+        self.tank_serial[games] += 1
+        t.score[games, slots] = 0
+        t.stay[games, slots] = False
+        t.frames[games, slots] = 8 + kind + 4 * t.bonus[games, slots]
+        t.phase[games, slots] = 0
+
+
+def to_quarter(pixels):
+    return pixels // CELL_SIZE * 2 + (pixels % CELL_SIZE >= QUARTER)
+
+
+def get_quarter_span(start, size):
+    """
+    Четверти клеток, которые покрывает отрезок [start, start + size), и признак их наличия на карте
+    """
+    first, last = to_quarter(start), to_quarter(start + size - 1)
+    index = first[:, None] + np.arange(-(-(np.max(size) - 1) // QUARTER) + 1)
+    valid = (index <= np.reshape(last, (-1, 1))) & (index >= 0) & (index < GRID)
+    return np.clip(index, 0, GRID - 1), valid
+
+
+def mask_to_array(mask):
+    return pygame.surfarray.array_red(mask.to_surface()).T > 0
+
+
+def masks_overlap(first, first_x, first_y, second, second_x, second_y):
+    """
+    Пересечение пар масок, как Mask.overlap: first - (пары, h, w), second - (пары или 1, H, W)
+    """
+    rows = first_y[:, None] + np.arange(first.shape[1]) - np.reshape(second_y, (-1, 1))
+    columns = first_x[:, None] + np.arange(first.shape[2]) - np.reshape(second_x, (-1, 1))
+    valid = ((rows >= 0) & (rows < second.shape[1]))[:, :, None] & \
+        ((columns >= 0) & (columns < second.shape[2]))[:, None, :]
+    rows, columns = np.clip(rows, 0, second.shape[1] - 1), np.clip(columns, 0, second.shape[2] - 1)
+    index = np.arange(len(first))[:, None, None] if len(second) == len(first) else 0
+    return (first & second[index, rows[:, :, None], columns[:, None, :]] & valid).any((1, 2))
+
+
+def overlap(x, y, width, height, other_x, other_y, other_width, other_height):
+    # Как Rect.colliderect
+    return (x < other_x + other_width) & (other_x < x + width) & (y < other_y + other_height) & (other_y < y + height)
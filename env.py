@@ -0,0 +1,227 @@
+"""
+Окружение для обучения ботов в духе gym над Game без окна (нужен numpy).
+
+    env = TanksEnv(level=1, frame_skip=4, seed=1)
+    observation, info = env.reset()
+    observation, reward, terminated, truncated, info = env.step(action)
+
+Действие игрока - число 0..9: action % 5 - направление (0 - стоять, 1..4 - вверх, вниз, влево, вправо,
+как в batch_sim), action // 5 - выстрел. Для игры на двоих действие - пара чисел.
+Наблюдение - словарь массивов NumPy, картинка поля не рисуется и не читается:
+    tiles   - (26, 26) int8, коды клеток как в файлах уровней (0 - пусто, 1 - кирпич, ... 5 - трава);
+    tanks   - (TANK_SLOTS, len(TANK_FEATURES)) float32, строки 0 и 1 - игроки по номерам, дальше враги
+              (в режиме орды только первые TANK_SLOTS - 2 врага);
+    bullets - (BULLET_SLOTS, len(BULLET_FEATURES)) float32;
+    bonuses - (BONUS_SLOTS, len(BONUS_FEATURES)) float32;
+    state   - (len(STATE_FEATURES),) float32.
+Координаты отнесены к ширине поля. Массивы наблюдения создаются один раз и перезаписываются
+на каждом шаге, поэтому наблюдение, которое нужно сохранить, надо копировать.
+Награда - очки, набранные игроками за шаг. Эпизод - один уровень: он заканчивается
+победой (terminated, info['won']), поражением (terminated) или по лимиту тиков (truncated)
+"""
+import os
+import random
+
+import numpy as np
+import pygame
+
+import main
+from main import (Game, Player, SimpleEnemy, QuickTank, QuickFireTank, StrongTank, BonusStar, BonusClock,
+                  BonusGrenade, BonusHelmet, BonusShovel, BonusTank, CELL_SIZE, PLAYGROUND_WIDTH,
+                  UP, DOWN, LEFT, RIGHT)
+
+DIRECTIONS = (None, UP, DOWN, LEFT, RIGHT)
+ACTIONS = len(DIRECTIONS) * 2
+FACING_VECTORS = {UP: (0, -1), DOWN: (0, 1), LEFT: (-1, 0), RIGHT: (1, 0)}
+MATERIAL_CODES = {'brick': 1, 'concrete': 2, 'water': 3, 'ice': 4, 'grass': 5}
+ENEMY_TYPES = (SimpleEnemy, QuickTank, QuickFireTank, StrongTank)
+BONUS_TYPES = (BonusStar, BonusClock, BonusGrenade, BonusHelmet, BonusShovel, BonusTank)
+
+TANK_FEATURES = ('present', 'player', 'x', 'y', 'facing_x', 'facing_y', 'kind', 'durability', 'immortal',
+                 'spawning', 'bonus')
+BULLET_FEATURES = ('present', 'player', 'x', 'y', 'facing_x', 'facing_y', 'speed')
+BONUS_FEATURES = ('present', 'x', 'y', 'kind')
+STATE_FEATURES = ('tick', 'enemies_left', 'lives_1', 'lives_2', 'tier_1', 'tier_2', 'base_protected', 'frozen')
+# Места под танки: 2 игрока и 6 врагов. В обычной игре врагов на поле не больше четырех,
+# в режиме орды (Horde) лишние враги в наблюдение не попадают, как и снаряды сверх BULLET_SLOTS
+TANK_SLOTS = 8
+BULLET_SLOTS = 16
+BONUS_SLOTS = 4
+
+
+def make_buffers(*shape):
+    """
+    Массивы наблюдения; shape - размер пачки для векторного окружения
+    """
+    return {'tiles': np.zeros(shape + (26, 26), np.int8),
+            'tanks': np.zeros(shape + (TANK_SLOTS, len(TANK_FEATURES)), np.float32),
+            'bullets': np.zeros(shape + (BULLET_SLOTS, len(BULLET_FEATURES)), np.float32),
+            'bonuses': np.zeros(shape + (BONUS_SLOTS, len(BONUS_FEATURES)), np.float32),
+            'state': np.zeros(shape + (len(STATE_FEATURES),), np.float32)}
+
+
+def init_headless():
+    if not pygame.get_init():
+        os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+        os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+        pygame.init()
+
+
+class TanksEnv:
+    def __init__(self, level=1, two_players=False, frame_skip=4, max_ticks=None, seed=None, buffers=None):
+        """
+        frame_skip - сколько тиков игры повторяется одно действие.
+        max_ticks - лимит тиков эпизода, None - без лимита.
+        buffers - готовые массивы наблюдения (make_buffers), в которые писать
+        """
+        init_headless()
+        self.level = level
+        self.two_players = two_players
+        self.players = 2 if two_players else 1
+        self.frame_skip = frame_skip
+        self.max_ticks = max_ticks
+        self.random = random.Random(seed)
+        self.observation = make_buffers() if buffers is None else buffers
+        self.game = None
+        self.scores = [0, 0]
+        self.blocks_version = None
+
+    def reset(self, seed=None):
+        if seed is None:
+            seed = self.random.getrandbits(32)
+        main.TWO_PLAYERS = self.two_players
+        self.game = Game(self.level, headless=True, seed=seed)
+        # Шторки перед уровнем не меняют состояние поля, проматываем их сразу
+        while self.game.starting_level or self.game.starting_level_2:
+            self.game.step({})
+        self.scores = [0, 0]
+        self.blocks_version = None
+        self.observe()
+        return self.observation, self.get_info()
+
+    def step(self, action):
+        game = self.game
+        if self.players == 1:
+            action = (action,)
+        commands = {number: (DIRECTIONS[value % len(DIRECTIONS)], value >= len(DIRECTIONS))
+                    for number, value in enumerate(action)}
+        for _ in range(self.frame_skip):
+            game.step(commands)
+            if self.is_over():
+                break
+        reward = 0
+        for number, player in enumerate(game.player_slots):
+            score = player.score if player is not None else 0
+            # После гибели игрок создается заново с нулевым счетом
+            reward += score - self.scores[number] if score >= self.scores[number] else score
+            self.scores[number] = score
+        self.observe()
+        terminated = self.is_over()
+        truncated = not terminated and self.max_ticks is not None and game.tick >= self.max_ticks
+        return self.observation, float(reward), terminated, truncated, self.get_info()
+
+    def is_over(self):
+        # При победе номер уровня растет сразу, следующий уровень в эпизод не входит.
+        # При поражении уровень сбрасывается на первый, но это тоже game_over
+        return not self.game.run or self.game.game_over or self.game.level != self.level
+
+    def get_info(self):
+        game = self.game
+        return {'tick': game.tick, 'seed': game.seed, 'won': not game.game_over and game.level != self.level,
+                'game_over': game.game_over, 'enemies_left': len(game.enemy_list) + len(game.enemies) +
+                sum(not isinstance(tank, Player) for tank in game.spawning_tanks)}
+
+    def observe(self):
+        game = self.game
+        observation = self.observation
+        version = (game.blocks.version, game.ice_blocks.version, game.grass_blocks.version)
+        if version != self.blocks_version:
+            # Карта меняется редко: клетки пересобираются только после изменения блоков
+            self.blocks_version = version
+            tiles = observation['tiles']
+            tiles.fill(0)
+            for group in (game.blocks, game.ice_blocks, game.grass_blocks):
+                for block in group.sprites():
+                    tiles[block.rect.y // CELL_SIZE, block.rect.x // CELL_SIZE] = MATERIAL_CODES[block.material]
+
+        tanks = observation['tanks']
+        tanks.fill(0)
+        slot = 2
+        for group in (game.players, game.enemies, game.spawning_tanks):
+            for tank in group.sprites():
+                if isinstance(tank, Player):
+                    row, kind = tank.number, tank.tier
+                elif slot < TANK_SLOTS:
+                    row, kind = slot, ENEMY_TYPES.index(type(tank)) + 1
+                    slot += 1
+                else:
+                    continue
+                facing_x, facing_y = FACING_VECTORS[tank.facing]
+                tanks[row] = (1, isinstance(tank, Player), tank.rect.centerx / PLAYGROUND_WIDTH,
+                              tank.rect.centery / PLAYGROUND_WIDTH, facing_x, facing_y, kind, tank.durability,
+                              tank.immortal, tank.spawn_animation is not None, tank.bonus)
+
+        bullets = observation['bullets']
+        bullets.fill(0)
+        slot = 0
+        for bullet in game.bullets.sprites():
+            if bullet.start_terminate or slot == BULLET_SLOTS:
+                continue
+            facing_x, facing_y = FACING_VECTORS[bullet.facing]
+            bullets[slot] = (1, isinstance(bullet.owner, Player), bullet.rect.centerx / PLAYGROUND_WIDTH,
+                             bullet.rect.centery / PLAYGROUND_WIDTH, facing_x, facing_y,
+                             abs(bullet.velocity_x or bullet.velocity_y) / PLAYGROUND_WIDTH)
+            slot += 1
+
+        bonuses = observation['bonuses']
+        bonuses.fill(0)
+        for slot, bonus in enumerate(game.bonuses.sprites()[:BONUS_SLOTS]):
+            bonuses[slot] = (1, bonus.rect.centerx / PLAYGROUND_WIDTH, bonus.rect.centery / PLAYGROUND_WIDTH,
+                             BONUS_TYPES.index(type(bonus)) + 1)
+
+        players = game.player_slots
+        observation['state'][:] = (
+            game.tick / main.FPS / 60, len(game.enemy_list) / 20,
+            players[0].lives if players[0] is not None else 0, players[1].lives if players[1] is not None else 0,
+            players[0].tier if players[0] is not None else 0, players[1].tier if players[1] is not None else 0,
+            game.base_protected, any(enemy.frozen for enemy in game.enemies))
+
+
+class VectorTanksEnv:
+    """
+    Несколько независимых окружений с общими массивами наблюдения формы (count, ...):
+    каждое окружение пишет прямо в свою строку, наблюдения не склеиваются на каждом шаге.
+    Закончившееся окружение сразу начинается заново, и в его строке оказывается
+    первое наблюдение нового эпизода; итог прошлого эпизода остается в infos:
+    final=True и копия последнего наблюдения в final_observation (например, чтобы оценить
+    состояние после обрыва по лимиту тиков)
+    """
+    def __init__(self, count, level=1, two_players=False, frame_skip=4, max_ticks=None, seed=None):
+        self.observation = make_buffers(count)
+        self.rewards = np.zeros(count, np.float32)
+        self.terminated = np.zeros(count, bool)
+        self.truncated = np.zeros(count, bool)
+        self.envs = [TanksEnv(level, two_players, frame_skip, max_ticks, None if seed is None else seed + i,
+                              {name: array[i] for name, array in self.observation.items()})
+                     for i in range(count)]
+
+    def __len__(self):
+        return len(self.envs)
+
+    def reset(self, seed=None):
+        infos = [env.reset(None if seed is None else seed + i)[1] for i, env in enumerate(self.envs)]
+        return self.observation, infos
+
+    def step(self, actions):
+        """
+        actions - массив формы (count,) или (count, 2) для игры на двоих
+        """
+        infos = []
+        for i, env in enumerate(self.envs):
+            observation, self.rewards[i], self.terminated[i], self.truncated[i], info = env.step(actions[i])
+            if self.terminated[i] or self.truncated[i]:
+                info = dict(info, final=True,
+                            final_observation={name: array[i].copy() for name, array in self.observation.items()})
+                env.reset()
+            infos.append(info)
+        return self.observation, self.rewards, self.terminated, self.truncated, infos
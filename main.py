@@ -1,11 +1,20 @@
 import pygame
-from random import shuffle, randint
+import argparse
+import math
+import random
 import os
 import time
 import ctypes
-from itertools import cycle
+from collections import OrderedDict
 import csv
+import hashlib
+import queue
+import threading
+import weakref
+import zlib
+from heapq import heapify, heappush, heappop
 from operator import attrgetter
+from replay import Replay, ReplayRecorder
 
 WINDOW_SIZE = (900, 700)
 PLAYGROUND_WIDTH = 650
@@ -14,30 +23,168 @@ UP, DOWN, LEFT, RIGHT, SHOOT = pygame.K_UP, pygame.K_DOWN, pygame.K_LEFT, pygame
 BUTTONS = {UP, DOWN, LEFT, RIGHT, SHOOT}
 EXIT_TO_MENU = True
 SOUND_ON = False
+DIRTY_RENDER = True
 TWO_PLAYERS = False
+# Настройки режима орды (Horde) для новых игр, None - обычная игра
+HORDE = None
+# Частота тиков симуляции; отрисовка идет со своей частотой RENDER_FPS (0 - без ограничения)
 FPS = 30
+RENDER_FPS = 60
+# Сколько тиков можно догнать за один кадр, прежде чем игра начнет замедляться
+MAX_FRAME_SKIP = 5
+# Период снимков состояния в записи игры, в тиках
+KEYFRAME_INTERVAL = FPS * 10
+# Частота кадров меню при удержании клавиш и таймаут ожидания событий в простое, мс
+MENU_FPS = 30
+MENU_IDLE_TIMEOUT = 500
+THUMBNAIL_READY = pygame.USEREVENT + 1
+THUMBNAIL_LRU_SIZE = 48
+BULLET_STEP = CELL_SIZE // 2
+# Доля решений врага, принятых по карте путей к базе, остальные - случайный поворот
+ENEMY_NAVIGATION = 0.75
+# Во сколько шагов пути обходится проезд через кирпич: его надо сначала прострелить
+NAVIGATION_BRICK_COST = 4
+# Раз в сколько тиков каждый враг решает, стрелять ли, и сколько выборов направления
+# можно сделать за тик (None - без ограничения), см. AIScheduler; интервал не больше 8
+AI_THINK_INTERVAL = 1
+AI_BUDGET = None
+ANGLES = {UP: 0, LEFT: 90, DOWN: 180, RIGHT: 270}
+# Сколько освобожденных спрайтов каждого типа держит SpritePool
+POOL_SIZE = 512
+
+
+class ImageCache:
+    """
+    Кэш текстур: одна и та же картинка с одинаковыми параметрами
+    читается с диска и масштабируется только один раз
+    """
+    def __init__(self):
+        self.images = dict()
+        self.frame_tables = dict()
+        # Маски живут ровно столько же, сколько поверхности, по которым построены
+        self.masks = weakref.WeakKeyDictionary()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, name, size=None, color_key=None):
+        key = (name, tuple(size) if size else None,
+               tuple(color_key) if isinstance(color_key, (tuple, list)) else color_key)
+        image = self.images.get(key)
+        if image is not None:
+            self.hits += 1
+            return image
+        self.misses += 1
+        image = self.load(name, size, color_key)
+        self.images[key] = image
+        return image
+
+    def load(self, name, size=None, color_key=None):
+        fullname = os.path.join('data/images/', name + '.png')
+        if size:
+            image = pygame.transform.scale(pygame.image.load(fullname), size)
+        else:
+            image = pygame.image.load(fullname)
+        display_ready = pygame.display.get_surface() is not None
+        if color_key is not None:
+            if color_key == -1:
+                color_key = image.get_at((0, 0))
+            elif len(color_key) == 2:
+                color_key = image.get_at(color_key)
+            if display_ready:
+                image = image.convert()
+            image.set_colorkey(color_key, pygame.RLEACCEL)
+        elif display_ready:
+            image = image.convert_alpha()
+        return image
+
+    def get_frames(self, names, size, color_key=-1):
+        key = (tuple(names), tuple(size), color_key)
+        frames = self.frame_tables.get(key)
+        if frames is None:
+            frames = FrameTable([self.get(name, size, color_key) for name in names])
+            self.frame_tables[key] = frames
+        return frames
+
+    def get_mask(self, image):
+        mask = self.masks.get(image)
+        if mask is None:
+            mask = pygame.mask.from_surface(image)
+            self.masks[image] = mask
+        return mask
+
+    def clear(self):
+        self.images.clear()
+        self.frame_tables.clear()
+        self.masks.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.images)}
+
+
+class FrameTable:
+    """
+    Кадры анимации, заранее повернутые во все четыре стороны,
+    вместе с масками для проверки столкновений
+    """
+    def __init__(self, images):
+        self.length = len(images)
+        self.images = {facing: tuple(pygame.transform.rotate(image, angle) for image in images)
+                       for facing, angle in ANGLES.items()}
+        self.masks = {facing: tuple(get_mask(image) for image in images)
+                      for facing, images in self.images.items()}
+
+    def __len__(self):
+        return self.length
+
+
+IMAGE_CACHE = ImageCache()
+MAP_CACHE = dict()
 
 
 def load_image(name, size=None, color_key=None):
-    fullname = os.path.join('data/images/', name + '.png')
-    if size:
-        image = pygame.transform.scale(pygame.image.load(fullname), size)
-    else:
-        image = pygame.image.load(fullname)
-    if color_key is not None:
-        if color_key == -1:
-            color_key = image.get_at((0, 0))
-        elif len(color_key) == 2:
-            color_key = image.get_at(color_key)
-        image.set_colorkey(color_key)
-    else:
-        image = image.convert_alpha()
-    return image
+    # Поверхности общие для всех спрайтов, изменять их на месте нельзя
+    return IMAGE_CACHE.get(name, size, color_key)
+
+
+def get_mask(image):
+    # Маска общая для всех спрайтов с этой поверхностью
+    return IMAGE_CACHE.get_mask(image)
+
+
+def set_display_mode(size, flags=0):
+    # Формат пикселей может смениться вместе с режимом экрана,
+    # поэтому сконвертированные текстуры загружаются заново
+    screen = pygame.display.get_surface()
+    if screen is None or screen.get_size() != tuple(size) or screen.get_flags() & pygame.FULLSCREEN != flags:
+        IMAGE_CACHE.clear()
+    return pygame.display.set_mode(size, flags)
 
 
 class Game:
-    def __init__(self):
+    # Поля игры и группы спрайтов, из которых складывается снимок состояния
+    state_fields = ('run', 'tick', 'spawn_tick', 'level', 'level_end_timer', 'game_over', 'game_over_flag',
+                    'enemy_list', 'enemies_amount', 'enemy_position_index', 'max_enemies', 'enemy_list_size',
+                    'spawn_points', 'base_protected',
+                    'base_protection_duration', 'base_protection_count', 'blocks_around_base', 'starting_level',
+                    'starting_level_2', 'loading_screen_1_pos', 'loading_screen_2_pos', 'pause', 'player_slots')
+    sprite_groups = ('players', 'enemies', 'spawning_tanks', 'bullets', 'blocks', 'ice_blocks', 'grass_blocks',
+                     'bonuses', 'shields', 'explosions')
+
+    def __init__(self, level=None, headless=False, seed=None, horde=None):
+        """
+        level - номер уровня, с которого начать без показа меню.
+        headless - игра без окна: только симуляция, без отрисовки и сохранения прогресса.
+        seed - сид генератора случайных чисел, все случайные решения игры идут через self.random.
+        horde - настройки режима орды, по умолчанию HORDE
+        """
         global EXIT_TO_MENU
+        self.headless = headless
+        self.horde = horde if horde is not None else HORDE
+        self.seed = random.getrandbits(32) if seed is None else seed
+        self.random = random.Random(self.seed)
+        self.recorder = None
+        # Запись, из снимка которой игра восстановлена последней (Game.seek)
+        self.replay = None
         if SOUND_ON:
             self.music_lose = pygame.mixer.Sound('data/music/game_over.ogg')
         self.game_over_flag = 0
@@ -60,25 +207,37 @@ class Game:
         self.first_player_lives = 3
         self.second_player_tier = 1
         self.second_player_lives = 3
-        Menu(self)
+        if level is None:
+            Menu(self)
+        else:
+            self.level = level
         if not self.run:
             EXIT_TO_MENU = False
             return
         self.game_over = False
         self.enemy_list = []
         self.enemies_amount = tuple()
-        self.enemy_positions = cycle([(CELL_SIZE * 12, 0), (CELL_SIZE * 24, 0), (0, 0)])
-        self.enemies = pygame.sprite.Group()
+        self.enemy_positions = ((CELL_SIZE * 12, 0), (CELL_SIZE * 24, 0), (0, 0))
+        self.enemy_position_index = 0
+        self.spawn_points = list(self.enemy_positions)
+        self.max_enemies = 4
+        self.enemy_list_size = 20
+        self.enemies = SpatialHashGroup()
         self.spawning_tanks = pygame.sprite.Group()
-        self.bullets = pygame.sprite.Group()
-        self.blocks = pygame.sprite.Group()
-        self.players = pygame.sprite.Group()
-        self.ice_blocks = pygame.sprite.Group()
-        self.grass_blocks = pygame.sprite.Group()
-        self.bonuses = pygame.sprite.Group()
-        self.shields = pygame.sprite.Group()
+        self.bullets = BulletGroup()
+        self.terrain = Terrain()
+        self.blocks = BlockGroup(terrain=self.terrain)
+        self.navigation = Navigation(self.blocks)
+        self.ai = AIScheduler(AI_THINK_INTERVAL, AI_BUDGET)
+        self.players = SpatialHashGroup()
+        self.ice_blocks = BlockGroup(terrain=self.terrain)
+        self.grass_blocks = BlockGroup(terrain=self.terrain)
+        self.bonuses = SpatialHashGroup()
+        self.shields = ShieldGroup()
         self.explosions = pygame.sprite.Group()
         self.blocks_around_base = list()
+        # Игроки по номерам: номер нового игрока - первое свободное место
+        self.player_slots = [None, None]
         self.base_protected = False
         self.base_protection_duration = FPS * 10
         self.base_protection_count = 0
@@ -104,15 +263,26 @@ class Game:
         self.flag_sprite.image = load_image('flag', (CELL_SIZE * 2 - 10, CELL_SIZE * 2 - 10), -1)
         self.flag_sprite.rect = pygame.Rect(PLAYGROUND_WIDTH // 2 - CELL_SIZE + 5,
                                             PLAYGROUND_WIDTH - CELL_SIZE * 2 + 5, 39 * 2, 7 * 2)
-        self.flag_sprite.mask = pygame.mask.from_surface(self.flag_sprite.image)
+        self.flag_sprite.mask = get_mask(self.flag_sprite.image)
         self.flag_broken_group = pygame.sprite.Group()
         self.flag_broken_sprite = pygame.sprite.Sprite(self.flag_broken_group)
         self.flag_broken_sprite.image = load_image('flag_broken', (CELL_SIZE * 2 - 10, CELL_SIZE * 2 - 10), -1)
         self.flag_broken_sprite.rect = pygame.Rect(PLAYGROUND_WIDTH // 2 - CELL_SIZE + 5,
                                                    PLAYGROUND_WIDTH - CELL_SIZE * 2 + 5, 39 * 2, 7 * 2)
-        self.screen = pygame.display.set_mode(WINDOW_SIZE)
-        if self.fullscreen_mode:
-            pygame.display.set_mode(self.get_resolution(), pygame.FULLSCREEN)
+        if not self.headless:
+            self.screen = set_display_mode(WINDOW_SIZE)
+            if self.fullscreen_mode:
+                set_display_mode(self.get_resolution(), pygame.FULLSCREEN)
+            self.canvas = pygame.Surface((PLAYGROUND_WIDTH, PLAYGROUND_WIDTH)).convert()
+            self.background = TerrainLayer(self.blocks, self.ice_blocks)
+            self.foreground = TerrainLayer(self.grass_blocks, color_key=(255, 0, 255))
+            self.hud = pygame.Surface((CELL_SIZE * 8, PLAYGROUND_WIDTH)).convert()
+            self.hud_font = pygame.font.SysFont('arial', 21, bold=True)
+        self.drawn_sprites = dict()
+        self.full_redraw = True
+        # Доля тика, прошедшая с последнего шага симуляции, для интерполяции при отрисовке
+        self.alpha = 1.0
+        self.hud_state = None
         if SOUND_ON:
             self.music_pause = pygame.mixer.Sound('data/music/pause.ogg')
             self.music_stop = pygame.mixer.Sound('data/music/stop.ogg')
@@ -121,9 +291,10 @@ class Game:
             self.level = int(self.level.split('_')[1].split('.')[0])
         self.init_level(f'data/levels/level_{self.level}.txt', self.first_player_tier,
                         self.first_player_lives, self.second_player_tier, self.second_player_lives)
-        self.time = time.time()
+        # Таймеры игры считаются в тиках симуляции, а не в реальном времени
+        self.tick = 0
+        self.spawn_tick = 0
         self.clock = pygame.time.Clock()
-        self.bonus_time = time.time()
         self.level_end_timer = None
 
     def main_loop(self):
@@ -131,6 +302,9 @@ class Game:
         if self.run:
             if SOUND_ON:
                 self.music_stop.play()
+        tick_length = 1000 / FPS
+        lag = 0
+        self.clock.tick()
         while self.run:
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
@@ -138,80 +312,272 @@ class Game:
                     EXIT_TO_MENU = False
                 elif event.type == pygame.KEYUP and event.key == pygame.K_F11:
                     if self.fullscreen_mode:
-                        pygame.display.set_mode(WINDOW_SIZE)
+                        set_display_mode(WINDOW_SIZE)
                     else:
-                        pygame.display.set_mode(self.get_resolution(), pygame.FULLSCREEN)
+                        set_display_mode(self.get_resolution(), pygame.FULLSCREEN)
                     self.fullscreen_mode = not self.fullscreen_mode
+                    self.full_redraw = True
                 elif event.type == pygame.KEYUP and event.key == pygame.K_ESCAPE:
                     self.pause = not self.pause
+                    self.full_redraw = True
                     if SOUND_ON:
                         self.music_pause.play()
                 if not self.pause:
                     for player in self.players.sprites():
                         player.check_controls(event)
-            if not any([self.pause, self.starting_level, self.starting_level_2]):
-                self.enemies.update()
-                self.bullets.update()
-                if self.base_protected:
-                    if self.base_protection_count >= self.base_protection_duration:
-                        self.make_base_unprotected()
+            # Накопившееся с прошлого кадра время отрабатываем целыми тиками,
+            # при нехватке времени пропускаем кадры, а не замедляем игру
+            lag += self.clock.tick(RENDER_FPS)
+            steps = 0
+            while lag >= tick_length and self.run:
+                self.step()
+                lag -= tick_length
+                steps += 1
+                if steps >= MAX_FRAME_SKIP:
+                    lag %= tick_length
+                    break
+            self.render(lag / tick_length)
+
+    def simulate(self, ticks, script=None):
+        """
+        Прогон игры без окна и без ожидания между тиками.
+        script(game) возвращает команды игроков на тик: {номер игрока: (направление, выстрел)}
+        """
+        target = self.tick + ticks
+        while self.run and self.tick < target:
+            self.step(script(self) if script is not None else None)
+        return self.tick
+
+    def get_commands(self):
+        # Команды с клавиатуры, накопленные игроками с прошлого тика
+        commands = dict()
+        for player in self.players.sprites():
+            commands[player.number] = player.command
+            player.command = (player.command[0], False)
+        return commands
+
+    def apply_commands(self, commands):
+        for player in self.players.sprites():
+            if player.number in commands:
+                player.apply_command(*commands[player.number])
+
+    def checksum(self):
+        """
+        Контрольная сумма состояния поля, по ней сверяется воспроизведение записи
+        """
+        state = [self.tick, self.level, self.game_over, len(self.enemy_list)]
+        for group in (self.players, self.enemies, self.bullets, self.bonuses, self.blocks):
+            state.extend((type(sprite).__name__, tuple(sprite.rect)) for sprite in group.sprites())
+        return zlib.crc32(repr(state).encode())
+
+    def step(self, commands=None):
+        """
+        Один тик игры. Не зависит ни от экрана, ни от реального времени.
+        commands - команды игроков на тик, по умолчанию берутся с клавиатуры
+        """
+        tick = self.tick
+        if not self.headless:
+            self.remember_positions()
+        if self.starting_level or self.starting_level_2:
+            self.move_loading_screens()
+        elif not self.pause:
+            self.tick += 1
+            if commands is None:
+                commands = self.get_commands()
+            if self.recorder is not None:
+                self.recorder.record(self.tick, commands)
+            self.apply_commands(commands)
+            self.ai.begin_tick(self.tick)
+            self.enemies.update()
+            self.bullets.update()
+            if self.base_protected:
+                if self.base_protection_count >= self.base_protection_duration:
+                    self.make_base_unprotected()
+                else:
+                    self.base_protection_count += 1
+            self.blocks.update()
+            self.players.update()
+            self.shields.update()
+            self.spawning_tanks.update()
+            self.explosions.update()
+            tanks_to_spawn = []
+            for tank in self.spawning_tanks.sprites():
+                if tank.spawn_animation is None:
+                    tanks_to_spawn.append(tank)
+            for tank in tanks_to_spawn:
+                if isinstance(tank, Player):
+                    self.players.add(tank)
+                elif isinstance(tank, Enemy):
+                    self.enemies.add(tank)
+                self.spawning_tanks.remove(tank)
+            if self.tick - self.spawn_tick > (190 - self.level * 4 - (len(self.players) - 1) * 20) // 60 * FPS and \
+                    len(self.enemy_list) > 0 and len(self.enemies) + len(self.spawning_tanks) < self.max_enemies or \
+                    len(self.enemy_list) == self.enemy_list_size:
+                self.spawn_enemy()
+                if self.horde is not None:
+                    # В орде враги появляются сразу во всех свободных точках
+                    for _ in range(len(self.spawn_points) - 1):
+                        if not self.enemy_list or len(self.enemies) + len(self.spawning_tanks) >= self.max_enemies:
+                            break
+                        self.spawn_enemy()
+                self.spawn_tick = self.tick
+            if len(self.players.sprites()) == 0:
+                self.game_over = True
+                self.level = 1
+                self.first_player_tier = 1
+                self.first_player_lives = 3
+                self.second_player_tier = 1
+                self.second_player_lives = 3
+                self.save_config()
+            if self.game_over and SOUND_ON:
+                self.play_game_over_music()
+            if len(self.enemy_list) == 0 and len(self.enemies.sprites()) == 0 and self.level_end_timer is None:
+                self.level += 1
+                self.save_config()
+                self.level_end_timer = self.tick
+            self.enemies_amount = (self.enemy_list.count(0), self.enemy_list.count(1),
+                                   self.enemy_list.count(2), self.enemy_list.count(3))
+            if self.game_over and self.level_end_timer is None:
+                self.level_end_timer = self.tick
+            if self.level_end_timer is not None and self.tick - self.level_end_timer >= FPS * 4:
+                if self.game_over:
+                    self.run = False
+                    self.player_slots = [None, None]
+                else:
+                    if os.path.exists(f'data/levels/level_{self.level}.txt'):
+                        if TWO_PLAYERS:
+                            self.init_level(f'data/levels/level_{self.level}.txt', self.players.sprites()[0].tier,
+                                            self.players.sprites()[0].lives, self.players.sprites()[1].tier,
+                                            self.players.sprites()[1].lives)
+                        else:
+                            self.init_level(f'data/levels/level_{self.level}.txt', self.players.sprites()[0].tier,
+                                            self.players.sprites()[0].lives)
                     else:
-                        self.base_protection_count += 1
-                self.blocks.update()
-                self.players.update()
-                self.shields.update()
-                self.spawning_tanks.update()
-                self.explosions.update()
-                tanks_to_spawn = []
-                for tank in self.spawning_tanks.sprites():
-                    if tank.spawn_animation is None:
-                        tanks_to_spawn.append(tank)
-                for tank in tanks_to_spawn:
-                    if isinstance(tank, Player):
-                        self.players.add(tank)
-                    elif isinstance(tank, Enemy):
-                        self.enemies.add(tank)
-                    self.spawning_tanks.remove(tank)
-                if time.time() - self.time > (190 - self.level * 4 - (len(self.players) - 1) * 20) // 60 and \
-                        len(self.enemy_list) > 0 and len(self.enemies.sprites()) +\
-                        len(self.spawning_tanks.sprites()) < 4 or len(self.enemy_list) == 20:
-                    self.spawn_enemy()
-                    self.time = time.time()
-                if len(self.players.sprites()) == 0:
-                    self.game_over = True
-                    self.level = 1
-                    self.first_player_tier = 1
-                    self.first_player_lives = 3
-                    self.second_player_tier = 1
-                    self.second_player_lives = 3
-                    self.save_config()
-                if self.game_over and SOUND_ON:
-                    self.play_game_over_music()
-                if len(self.enemy_list) == 0 and len(self.enemies.sprites()) == 0 and self.level_end_timer is None:
-                    self.level += 1
-                    self.save_config()
-                    self.level_end_timer = time.time()
-                self.enemies_amount = (self.enemy_list.count(0), self.enemy_list.count(1),
-                                       self.enemy_list.count(2), self.enemy_list.count(3))
-                if self.game_over and self.level_end_timer is None:
-                    self.level_end_timer = time.time()
-                if self.level_end_timer is not None and time.time() - self.level_end_timer >= 4:
-                    if self.game_over:
                         self.run = False
-                        Player._instances = [None, None]
-                    else:
-                        if os.path.exists(f'data/levels/level_{self.level}.txt'):
-                            if TWO_PLAYERS:
-                                self.init_level(f'data/levels/level_{self.level}.txt', self.players.sprites()[0].tier,
-                                                self.players.sprites()[0].lives, self.players.sprites()[1].tier,
-                                                self.players.sprites()[1].lives)
-                            else:
-                                self.init_level(f'data/levels/level_{self.level}.txt', self.players.sprites()[0].tier,
-                                                self.players.sprites()[0].lives)
-                        else:
-                            self.run = False
-            self.render()
-            self.clock.tick(FPS)
+        if self.game_over:
+            self.flag_group.empty()
+            if self.game_over_sprite.rect.centery > WINDOW_SIZE[1] // 2:
+                self.game_over_sprite.rect.centery -= 5
+        if self.recorder is not None and self.tick != tick and self.tick % KEYFRAME_INTERVAL == 0:
+            self.recorder.add_keyframe(self.tick, self.snapshot())
+
+    def start_recording(self, filename):
+        self.recorder = ReplayRecorder(filename, self.seed, self.level, TWO_PLAYERS,
+                                       self.horde.get_state() if self.horde is not None else None)
+        self.recorder.add_keyframe(self.tick, self.snapshot())
+
+    def stop_recording(self):
+        self.recorder.close(self.tick, self.checksum())
+        self.recorder = None
+
+    def seek(self, replay, tick):
+        """
+        Перемотка воспроизводимой записи к тику tick: восстанавливаем ближайший
+        снимок до него и досчитываем только оставшиеся тики. Игра, еще не восстановленная
+        из этой записи, восстанавливается всегда: начальный снимок несет уровни и жизни игроков
+        """
+        keyframe = replay.keyframe(tick)
+        if keyframe is not None and (replay is not self.replay or keyframe[0] > self.tick or tick < self.tick):
+            self.restore(keyframe[1])
+            self.replay = replay
+        return self.simulate(tick - self.tick, replay)
+
+    def snapshot(self):
+        """
+        Полное состояние игры простыми данными, пригодными для JSON: поля игры,
+        спрайты, составы групп и состояние генератора случайных чисел.
+        Ссылки на спрайты заменяются на {'ref': номер спрайта}
+        """
+        sprites = []
+        refs = dict()
+
+        def encode(value):
+            if isinstance(value, pygame.sprite.Sprite):
+                if value not in refs:
+                    refs[value] = len(sprites)
+                    sprites.append(None)
+                    sprites[refs[value]] = [type(value).__name__, list(value.rect), encode(value.get_state())]
+                return {'ref': refs[value]}
+            if isinstance(value, dict):
+                return {key: encode(item) for key, item in value.items()}
+            if isinstance(value, set):
+                return [encode(item) for item in sorted(value)]
+            if isinstance(value, (list, tuple)):
+                return [encode(item) for item in value]
+            return value
+
+        return {'game': encode({name: getattr(self, name) for name in self.state_fields}),
+                'groups': {name: encode(getattr(self, name).sprites()) for name in self.sprite_groups},
+                'flag': self.flag_group.has(self.flag_sprite),
+                'game_over_sprite': list(self.game_over_sprite.rect),
+                'random': encode(self.random.getstate()),
+                'ai': encode(self.ai.get_state()),
+                'sprites': sprites}
+
+    def restore(self, snapshot):
+        """
+        Восстанавливает игру из снимка, сделанного snapshot()
+        """
+        sprites = []
+        for name, rect, state in snapshot['sprites']:
+            sprite_type = SPRITE_TYPES[name]
+            sprite = sprite_type.__new__(sprite_type)
+            pygame.sprite.Sprite.__init__(sprite)
+            sprite.rect = pygame.Rect(rect)
+            sprites.append(sprite)
+
+        def decode(value):
+            if isinstance(value, dict):
+                if set(value) == {'ref'}:
+                    return sprites[value['ref']]
+                return {key: decode(item) for key, item in value.items()}
+            if isinstance(value, list):
+                return [decode(item) for item in value]
+            return value
+
+        for name in self.sprite_groups:
+            release_all(getattr(self, name))
+        # Танки восстанавливаются первыми: щитам нужен размер своего танка
+        states = sorted(zip(sprites, (state for name, rect, state in snapshot['sprites'])),
+                        key=lambda pair: not isinstance(pair[0], Tank))
+        for sprite, state in states:
+            sprite.set_state(decode(state), self)
+        for name, members in snapshot['groups'].items():
+            getattr(self, name).add(*decode(members))
+        for name, value in decode(snapshot['game']).items():
+            setattr(self, name, value)
+        self.enemies_amount = tuple(self.enemies_amount)
+        if snapshot['flag']:
+            self.flag_group.add(self.flag_sprite)
+        else:
+            self.flag_group.empty()
+        self.game_over_sprite.rect = pygame.Rect(snapshot['game_over_sprite'])
+        self.ai.set_state(decode(snapshot['ai']))
+        version, internal_state, gauss_next = snapshot['random']
+        self.random.setstate((version, tuple(internal_state), gauss_next))
+        self.drawn_sprites = dict()
+        self.full_redraw = True
+        self.hud_state = None
+
+    def remember_positions(self):
+        # Положения до тика, от них интерполируется отрисовка движущихся спрайтов
+        for group in (self.players, self.enemies, self.bullets, self.shields, self.game_over_group):
+            for sprite in group.sprites():
+                sprite.prev_pos = sprite.rect.topleft
+
+    def move_loading_screens(self):
+        if self.starting_level:
+            self.loading_screen_1_pos[1] += 19
+            self.loading_screen_2_pos[1] -= 19
+            if self.loading_screen_1_pos[1] > self.loading_screen_2_pos[1]:
+                self.starting_level = False
+                self.starting_level_2 = True
+        elif self.starting_level_2:
+            self.loading_screen_1_pos[1] -= 19
+            self.loading_screen_2_pos[1] += 19
+            if self.loading_screen_2_pos[1] >= PLAYGROUND_WIDTH:
+                self.starting_level_2 = False
+                self.full_redraw = True
 
     def play_game_over_music(self):
         if self.game_over_flag == 0:
@@ -233,6 +599,8 @@ class Game:
             self.second_player_lives = int(content[1][3])
 
     def save_config(self):
+        if self.headless:
+            return
         with open('config.csv', encoding='utf-8') as config_file:
             content = csv.reader(config_file, delimiter=',')
             header = next(content)
@@ -256,8 +624,36 @@ class Game:
             else:
                 writer.writerow([2, 1, 1, 3])
 
+    def get_spawn_point(self):
+        """
+        Следующая по кругу точка появления врага. В орде занятые танками точки
+        пропускаются, None - свободных точек нет
+        """
+        for _ in range(len(self.spawn_points)):
+            coords = self.spawn_points[self.enemy_position_index % len(self.spawn_points)]
+            self.enemy_position_index += 1
+            if self.horde is None:
+                return coords
+            rect = pygame.Rect(coords, (CELL_SIZE * 2 - 10, CELL_SIZE * 2 - 10))
+            if not self.enemies.query(rect) and not self.players.query(rect) and \
+                    not any(tank.rect.colliderect(rect) for tank in self.spawning_tanks):
+                return coords
+        return None
+
+    def get_horde_spawn_points(self):
+        # Кроме трех обычных точек - каждая вторая клетка верхнего ряда и верх боковых краев
+        points = list(self.enemy_positions)
+        candidates = [(j, 0) for j in range(0, 25, 2)] + [(j, i) for i in range(2, 13, 2) for j in (0, 24)]
+        for j, i in candidates:
+            rect = pygame.Rect(j * CELL_SIZE, i * CELL_SIZE, CELL_SIZE * 2 - 10, CELL_SIZE * 2 - 10)
+            if rect.topleft not in points and not self.terrain.collides_rect(rect):
+                points.append(rect.topleft)
+        return points
+
     def spawn_enemy(self):
-        coords = next(self.enemy_positions)
+        coords = self.get_spawn_point()
+        if coords is None:
+            return
         enemy_type = self.enemy_list.pop(0)
         bonus = True if sum(self.enemies_amount) in [4, 11, 18] else False
         if enemy_type == 0:
@@ -269,146 +665,229 @@ class Game:
         elif enemy_type == 3:
             self.spawning_tanks.add(StrongTank(*coords, self, bonus))
 
-    def render(self):
-        canvas = pygame.Surface((PLAYGROUND_WIDTH, PLAYGROUND_WIDTH))
-        canvas.fill((0, 0, 0))
-        if not self.starting_level:
-            self.blocks.draw(canvas)
-            self.ice_blocks.draw(canvas)
-            self.players.draw(canvas)
-            self.enemies.draw(canvas)
-            self.bullets.draw(canvas)
-            self.grass_blocks.draw(canvas)
-            self.flag_group.draw(canvas)
-            self.shields.draw(canvas)
-            self.spawning_tanks.draw(canvas)
-            self.bonuses.draw(canvas)
-            self.explosions.draw(canvas)
+    def render(self, alpha=1.0):
+        self.alpha = alpha
+        if self.starting_level or self.starting_level_2:
+            self.full_redraw = True
+        sc_width, sc_height = self.screen.get_size()
+        if self.fullscreen_mode:
+            canvas_x = self.get_resolution()[0] // 2 - (sc_width // 32 + PLAYGROUND_WIDTH + 5 + CELL_SIZE * 8) // 2
+        else:
+            canvas_x = sc_width // 32
+        canvas_y = sc_height // 2 - PLAYGROUND_WIDTH // 2
+        if self.full_redraw or not DIRTY_RENDER:
+            self.background.update()
+            self.foreground.update()
+            self.draw_playground(self.canvas)
+            self.drawn_sprites = self.get_drawn_sprites()
+            self.full_redraw = False
+            self.screen.fill((192, 192, 192))
+            self.screen.blit(self.canvas, (canvas_x, canvas_y))
+            self.render_hud(canvas_x, canvas_y, True)
+            pygame.display.flip()
+        else:
+            dirty_rects = self.get_dirty_rects()
+            for rect in dirty_rects:
+                self.draw_playground(self.canvas, rect)
+                self.screen.blit(self.canvas, (canvas_x + rect.x, canvas_y + rect.y), rect)
+            dirty_rects = [rect.move(canvas_x, canvas_y) for rect in dirty_rects]
+            hud_rect = self.render_hud(canvas_x, canvas_y)
+            if hud_rect is not None:
+                dirty_rects.append(hud_rect)
+            pygame.display.update(dirty_rects)
+
+    def get_layers(self):
+        # Группы спрайтов в порядке отрисовки: под травой и над ней
+        under_grass = [self.players, self.enemies, self.bullets]
+        over_grass = [self.flag_group, self.shields, self.spawning_tanks, self.bonuses, self.explosions]
         if self.pause:
-            self.pause_group.draw(canvas)
+            over_grass.append(self.pause_group)
         if self.game_over:
-            self.flag_group.empty()
-            self.flag_broken_group.draw(canvas)
-            self.game_over_group.draw(canvas)
-            if self.game_over_sprite.rect.centery > WINDOW_SIZE[1] // 2:
-                self.game_over_sprite.rect.centery -= 5
-        self.screen.fill((192, 192, 192))
+            over_grass.extend((self.flag_broken_group, self.game_over_group))
+        return under_grass, over_grass
+
+    def draw_playground(self, canvas, area=None):
+        """
+        Рисует игровое поле целиком или только область area.
+        Спрайты, задевающие область, перерисовываются с обрезкой по ней
+        """
+        canvas.set_clip(area)
         if self.starting_level:
+            canvas.fill((0, 0, 0))
+        else:
+            source = area or canvas.get_rect()
+            under_grass, over_grass = self.get_layers()
+            canvas.blit(self.background.surface, source, source)
+            self.draw_layers(canvas, under_grass, area)
+            canvas.blit(self.foreground.surface, source, source)
+            self.draw_layers(canvas, over_grass, area)
+        if self.starting_level or self.starting_level_2:
             canvas.blit(self.loading_screen_1, self.loading_screen_1_pos)
             canvas.blit(self.loading_screen_2, self.loading_screen_2_pos)
-            self.loading_screen_1_pos[1] += 19
-            self.loading_screen_2_pos[1] -= 19
-            if self.loading_screen_1_pos[1] > self.loading_screen_2_pos[1]:
-                self.starting_level = False
-                self.starting_level_2 = True
-        if self.starting_level_2:
-            canvas.blit(self.loading_screen_1, self.loading_screen_1_pos)
-            canvas.blit(self.loading_screen_2, self.loading_screen_2_pos)
-            self.loading_screen_1_pos[1] -= 19
-            self.loading_screen_2_pos[1] += 19
-            if self.loading_screen_2_pos[1] >= PLAYGROUND_WIDTH:
-                self.starting_level_2 = False
-        sc_width, sc_height = self.screen.get_size()
-        if self.fullscreen_mode:
-            canvas_x = self.get_resolution()[0] // 2 - (sc_width // 32 + PLAYGROUND_WIDTH + 5 + CELL_SIZE * 8) // 2
+        canvas.set_clip(None)
+
+    def draw_layers(self, canvas, layers, area=None):
+        for group in layers:
+            if area is not None and isinstance(group, SpatialHashGroup):
+                # Картинка спрайта может выступать за его rect (взрывы снарядов)
+                candidates = group.query(area.inflate(CELL_SIZE * 4, CELL_SIZE * 4))
+            else:
+                candidates = group.sprites()
+            drawn = ((sprite.image, get_drawn_rect(sprite, self.alpha)) for sprite in candidates)
+            canvas.blits([(image, rect) for image, rect in drawn
+                          if area is None or rect.colliderect(area)], False)
+
+    def get_drawn_sprites(self):
+        drawn_sprites = dict()
+        for group in sum(self.get_layers(), []):
+            for sprite in group.sprites():
+                drawn_sprites[sprite] = (sprite.image, get_drawn_rect(sprite, self.alpha))
+        return drawn_sprites
+
+    def get_dirty_rects(self):
+        """
+        Сравнивает положение и картинку каждого спрайта с прошлым кадром
+        и возвращает области поля, которые нужно перерисовать
+        """
+        drawn_sprites = self.get_drawn_sprites()
+        dirty_rects = self.background.update() + self.foreground.update()
+        for sprite, (image, rect) in drawn_sprites.items():
+            previous = self.drawn_sprites.pop(sprite, None)
+            if previous is None:
+                dirty_rects.append(rect)
+            elif previous[0] is not image or previous[1] != rect:
+                # Спрайт из пула может появиться далеко от прошлого места: две области, а не одна огромная
+                if rect.colliderect(previous[1]):
+                    dirty_rects.append(rect.union(previous[1]))
+                else:
+                    dirty_rects.extend((rect, previous[1]))
+        dirty_rects.extend(rect for image, rect in self.drawn_sprites.values())
+        self.drawn_sprites = drawn_sprites
+        playground = pygame.Rect(0, 0, PLAYGROUND_WIDTH, PLAYGROUND_WIDTH)
+        merged = []
+        for rect in dirty_rects:
+            rect = rect.clip(playground)
+            if not rect.width or not rect.height:
+                continue
+            # Пересекающиеся области склеиваем, чтобы не рисовать одно место дважды
+            index = rect.collidelist(merged)
+            while index != -1:
+                rect.union_ip(merged.pop(index))
+                index = rect.collidelist(merged)
+            merged.append(rect)
+        return merged
+
+    def render_hud(self, canvas_x, canvas_y, force=False):
+        """
+        Выводит боковую панель. Панель перерисовывается только при изменении
+        показываемых значений; возвращает обновленный прямоугольник экрана или None
+        """
+        hud_state = (self.level, self.enemies_amount, self.get_lives(), TWO_PLAYERS)
+        if hud_state != self.hud_state:
+            self.hud_state = hud_state
+            self.draw_hud(*hud_state[2])
+        elif not force:
+            return None
+        rect = self.hud.get_rect(topleft=(canvas_x + PLAYGROUND_WIDTH + 5, canvas_y))
+        self.screen.blit(self.hud, rect)
+        return rect
+
+    def get_lives(self):
+        players = self.players.sprites()
+        if players and players[0].number == 0:
+            first_lives = players[0].lives
         else:
-            canvas_x = sc_width // 32
-        self.screen.blit(canvas, (canvas_x,
-                                  sc_height // 2 - canvas.get_height() // 2))
-        font = pygame.font.SysFont('arial', 21, bold=True)
-        label = font.render(f'УРОВЕНЬ: {self.level}', True, (0, 0, 0))
-        rect = pygame.Rect(canvas_x + canvas.get_width() + 5, sc_height // 2 - canvas.get_height() // 2,
-                           CELL_SIZE * 8, label.get_height())
-        pygame.draw.rect(self.screen, (92, 157, 124), rect)
-        pygame.draw.rect(self.screen, (0, 0, 0), rect, 2)
-        self.screen.blit(label, (rect.left + rect.width // 2 - label.get_width() // 2,
-                                 rect.top + rect.height // 2 - label.get_height() // 2))
+            first_lives = 0
+        if len(players) == 2:
+            second_lives = players[1].lives
+        elif len(players) == 1 and players[0].number == 1:
+            second_lives = players[0].lives
+        else:
+            second_lives = 0
+        return first_lives, second_lives
+
+    def draw_hud(self, first_lives, second_lives):
+        hud = self.hud
+        hud.fill((192, 192, 192))
+        label = self.hud_font.render(f'УРОВЕНЬ: {self.level}', True, (0, 0, 0))
+        rect = pygame.Rect(0, 0, CELL_SIZE * 8, label.get_height())
+        pygame.draw.rect(hud, (92, 157, 124), rect)
+        pygame.draw.rect(hud, (0, 0, 0), rect, 2)
+        hud.blit(label, (rect.left + rect.width // 2 - label.get_width() // 2,
+                         rect.top + rect.height // 2 - label.get_height() // 2))
         rect = pygame.Rect(rect.left, rect.bottom + 5, CELL_SIZE * 8, CELL_SIZE * 8)
         if self.enemies_amount[0] == 0:
-            pygame.draw.rect(self.screen, (96, 192, 96), (rect.left, rect.top, rect.width, CELL_SIZE * 2))
+            pygame.draw.rect(hud, (96, 192, 96), (rect.left, rect.top, rect.width, CELL_SIZE * 2))
         else:
-            pygame.draw.rect(self.screen, (192, 96, 96), (rect.left, rect.top, rect.width, CELL_SIZE * 2))
-        self.screen.blit(self.simple_enemy_texture,
-                         (rect.left + CELL_SIZE - self.simple_enemy_texture.get_width() // 2,
-                          rect.top + CELL_SIZE - self.simple_enemy_texture.get_height() // 2))
-        pygame.draw.line(self.screen, (0, 0, 0), (rect.left, rect.top + CELL_SIZE * 2),
+            pygame.draw.rect(hud, (192, 96, 96), (rect.left, rect.top, rect.width, CELL_SIZE * 2))
+        hud.blit(self.simple_enemy_texture,
+                 (rect.left + CELL_SIZE - self.simple_enemy_texture.get_width() // 2,
+                  rect.top + CELL_SIZE - self.simple_enemy_texture.get_height() // 2))
+        pygame.draw.line(hud, (0, 0, 0), (rect.left, rect.top + CELL_SIZE * 2),
                          (rect.right, rect.top + CELL_SIZE * 2), 2)
-        label = font.render(f'{self.enemies_amount[0]}', True, (0, 0, 0))
-        self.screen.blit(label, (rect.left + CELL_SIZE * 7 - label.get_width() // 2,
-                                 rect.top + CELL_SIZE - label.get_height() // 2))
+        label = self.hud_font.render(f'{self.enemies_amount[0]}', True, (0, 0, 0))
+        hud.blit(label, (rect.left + CELL_SIZE * 7 - label.get_width() // 2,
+                         rect.top + CELL_SIZE - label.get_height() // 2))
         if self.enemies_amount[1] == 0:
-            pygame.draw.rect(self.screen, (96, 192, 96), (rect.left, rect.top + CELL_SIZE * 2,
-                                                          rect.width, CELL_SIZE * 2))
+            pygame.draw.rect(hud, (96, 192, 96), (rect.left, rect.top + CELL_SIZE * 2,
+                                                  rect.width, CELL_SIZE * 2))
         else:
-            pygame.draw.rect(self.screen, (192, 96, 96), (rect.left, rect.top + CELL_SIZE * 2,
-                                                          rect.width, CELL_SIZE * 2))
-        self.screen.blit(self.quick_enemy_texture,
-                         (rect.left + CELL_SIZE - self.quick_enemy_texture.get_width() // 2,
-                          rect.top + CELL_SIZE * 3 - self.quick_enemy_texture.get_height() // 2))
-        pygame.draw.line(self.screen, (0, 0, 0), (rect.left, rect.top + CELL_SIZE * 4),
+            pygame.draw.rect(hud, (192, 96, 96), (rect.left, rect.top + CELL_SIZE * 2,
+                                                  rect.width, CELL_SIZE * 2))
+        hud.blit(self.quick_enemy_texture,
+                 (rect.left + CELL_SIZE - self.quick_enemy_texture.get_width() // 2,
+                  rect.top + CELL_SIZE * 3 - self.quick_enemy_texture.get_height() // 2))
+        pygame.draw.line(hud, (0, 0, 0), (rect.left, rect.top + CELL_SIZE * 4),
                          (rect.right, rect.top + CELL_SIZE * 4), 2)
-        label = font.render(f'{self.enemies_amount[1]}', True, (0, 0, 0))
-        self.screen.blit(label, (rect.left + CELL_SIZE * 7 - label.get_width() // 2,
-                                 rect.top + CELL_SIZE * 3 - label.get_height() // 2))
+        label = self.hud_font.render(f'{self.enemies_amount[1]}', True, (0, 0, 0))
+        hud.blit(label, (rect.left + CELL_SIZE * 7 - label.get_width() // 2,
+                         rect.top + CELL_SIZE * 3 - label.get_height() // 2))
         if self.enemies_amount[2] == 0:
-            pygame.draw.rect(self.screen, (96, 192, 96), (rect.left, rect.top + CELL_SIZE * 4,
-                                                          rect.width, CELL_SIZE * 2))
+            pygame.draw.rect(hud, (96, 192, 96), (rect.left, rect.top + CELL_SIZE * 4,
+                                                  rect.width, CELL_SIZE * 2))
         else:
-            pygame.draw.rect(self.screen, (192, 96, 96), (rect.left, rect.top + CELL_SIZE * 4,
-                                                          rect.width, CELL_SIZE * 2))
-        self.screen.blit(self.quickfire_enemy_texture,
-                         (rect.left + CELL_SIZE - self.quickfire_enemy_texture.get_width() // 2,
-                          rect.top + CELL_SIZE * 5 - self.quick_enemy_texture.get_height() // 2))
-        pygame.draw.line(self.screen, (0, 0, 0), (rect.left, rect.top + CELL_SIZE * 6),
+            pygame.draw.rect(hud, (192, 96, 96), (rect.left, rect.top + CELL_SIZE * 4,
+                                                  rect.width, CELL_SIZE * 2))
+        hud.blit(self.quickfire_enemy_texture,
+                 (rect.left + CELL_SIZE - self.quickfire_enemy_texture.get_width() // 2,
+                  rect.top + CELL_SIZE * 5 - self.quick_enemy_texture.get_height() // 2))
+        pygame.draw.line(hud, (0, 0, 0), (rect.left, rect.top + CELL_SIZE * 6),
                          (rect.right, rect.top + CELL_SIZE * 6), 2)
-        label = font.render(f'{self.enemies_amount[2]}', True, (0, 0, 0))
-        self.screen.blit(label, (rect.left + CELL_SIZE * 7 - label.get_width() // 2,
-                                 rect.top + CELL_SIZE * 5 - label.get_height() // 2))
+        label = self.hud_font.render(f'{self.enemies_amount[2]}', True, (0, 0, 0))
+        hud.blit(label, (rect.left + CELL_SIZE * 7 - label.get_width() // 2,
+                         rect.top + CELL_SIZE * 5 - label.get_height() // 2))
         if self.enemies_amount[3] == 0:
-            pygame.draw.rect(self.screen, (96, 192, 96), (rect.left, rect.top + CELL_SIZE * 6,
-                                                          rect.width, CELL_SIZE * 2))
-        else:
-            pygame.draw.rect(self.screen, (192, 96, 96), (rect.left, rect.top + CELL_SIZE * 6,
-                                                          rect.width, CELL_SIZE * 2))
-        self.screen.blit(self.strong_enemy_texture,
-                         (rect.left + CELL_SIZE - self.strong_enemy_texture.get_width() // 2,
-                          rect.top + CELL_SIZE * 7 - self.strong_enemy_texture.get_height() // 2))
-        label = font.render(f'{self.enemies_amount[3]}', True, (0, 0, 0))
-        self.screen.blit(label, (rect.left + CELL_SIZE * 7 - label.get_width() // 2,
-                                 rect.top + CELL_SIZE * 7 - label.get_height() // 2))
-        pygame.draw.rect(self.screen, (0, 0, 0), rect, 2)
-        rect = pygame.Rect(canvas_x + canvas.get_width() + 5,
-                           sc_height // 2 - canvas.get_height() // 2 + canvas.get_height() - CELL_SIZE * 2,
-                           CELL_SIZE * 8, CELL_SIZE * 2)
-        pygame.draw.rect(self.screen, (128, 128, 128), rect)
-        self.screen.blit(self.first_player_texture,
-                         (rect.left + CELL_SIZE - self.first_player_texture.get_width() // 2,
-                          rect.top + CELL_SIZE - self.first_player_texture.get_height() // 2))
-        if self.players.sprites() and self.players.sprites()[0].number == 0:
-            lives = self.players.sprites()[0].lives
+            pygame.draw.rect(hud, (96, 192, 96), (rect.left, rect.top + CELL_SIZE * 6,
+                                                  rect.width, CELL_SIZE * 2))
         else:
-            lives = 0
-        label = font.render(f'{lives}', True, (0, 0, 0))
-        self.screen.blit(label, (rect.left + CELL_SIZE * 7 - label.get_width() // 2,
-                                 rect.top + CELL_SIZE - label.get_height() // 2))
-        pygame.draw.rect(self.screen, (0, 0, 0), rect, 2)
+            pygame.draw.rect(hud, (192, 96, 96), (rect.left, rect.top + CELL_SIZE * 6,
+                                                  rect.width, CELL_SIZE * 2))
+        hud.blit(self.strong_enemy_texture,
+                 (rect.left + CELL_SIZE - self.strong_enemy_texture.get_width() // 2,
+                  rect.top + CELL_SIZE * 7 - self.strong_enemy_texture.get_height() // 2))
+        label = self.hud_font.render(f'{self.enemies_amount[3]}', True, (0, 0, 0))
+        hud.blit(label, (rect.left + CELL_SIZE * 7 - label.get_width() // 2,
+                         rect.top + CELL_SIZE * 7 - label.get_height() // 2))
+        pygame.draw.rect(hud, (0, 0, 0), rect, 2)
+        rect = pygame.Rect(0, PLAYGROUND_WIDTH - CELL_SIZE * 2, CELL_SIZE * 8, CELL_SIZE * 2)
+        pygame.draw.rect(hud, (128, 128, 128), rect)
+        hud.blit(self.first_player_texture,
+                 (rect.left + CELL_SIZE - self.first_player_texture.get_width() // 2,
+                  rect.top + CELL_SIZE - self.first_player_texture.get_height() // 2))
+        label = self.hud_font.render(f'{first_lives}', True, (0, 0, 0))
+        hud.blit(label, (rect.left + CELL_SIZE * 7 - label.get_width() // 2,
+                         rect.top + CELL_SIZE - label.get_height() // 2))
+        pygame.draw.rect(hud, (0, 0, 0), rect, 2)
         if TWO_PLAYERS:
             rect = rect.move(0, -(rect.height + 5))
-            pygame.draw.rect(self.screen, (128, 128, 128), rect)
-            self.screen.blit(self.second_player_texture,
-                             (rect.left + CELL_SIZE - self.first_player_texture.get_width() // 2,
-                              rect.top + CELL_SIZE - self.first_player_texture.get_height() // 2))
-            if len(self.players.sprites()) == 2:
-                lives = self.players.sprites()[1].lives
-            elif len(self.players.sprites()) == 1 and self.players.sprites()[0].number == 1:
-                lives = self.players.sprites()[0].lives
-            else:
-                lives = 0
-            label = font.render(f'{lives}', True, (0, 0, 0))
-            self.screen.blit(label, (rect.left + CELL_SIZE * 7 - label.get_width() // 2,
-                                     rect.top + CELL_SIZE - label.get_height() // 2))
-            pygame.draw.rect(self.screen, (0, 0, 0), rect, 2)
-        pygame.display.flip()
+            pygame.draw.rect(hud, (128, 128, 128), rect)
+            hud.blit(self.second_player_texture,
+                     (rect.left + CELL_SIZE - self.first_player_texture.get_width() // 2,
+                      rect.top + CELL_SIZE - self.first_player_texture.get_height() // 2))
+            label = self.hud_font.render(f'{second_lives}', True, (0, 0, 0))
+            hud.blit(label, (rect.left + CELL_SIZE * 7 - label.get_width() // 2,
+                             rect.top + CELL_SIZE - label.get_height() // 2))
+            pygame.draw.rect(hud, (0, 0, 0), rect, 2)
 
     def init_level(self, filename, first_player_tier=1, first_player_lives=3,
                    second_player_tier=1, second_player_lives=3):
@@ -424,18 +903,19 @@ class Game:
         self.loading_screen_2_pos = [0, PLAYGROUND_WIDTH]
         self.starting_level = True
         self.starting_level_2 = False
-        Player._instances = [None, None]
+        self.full_redraw = True
+        self.player_slots = [None, None]
         _map, self.enemies_amount = read_map(filename)
         self.ice_blocks.empty()
         self.blocks.empty()
         self.grass_blocks.empty()
-        self.bullets.empty()
+        release_all(self.bullets)
         self.enemies.empty()
         self.players.empty()
         self.spawning_tanks.empty()
-        self.bonuses.empty()
-        self.shields.empty()
-        self.explosions.empty()
+        release_all(self.bonuses)
+        release_all(self.shields)
+        release_all(self.explosions)
         self.blocks_around_base = list()
         self.base_protected = False
 
@@ -460,29 +940,37 @@ class Game:
         if TWO_PLAYERS:
             self.spawning_tanks.add(Player(CELL_SIZE * 16, CELL_SIZE * 24, self,
                                            second_player_tier, second_player_lives, self.players))
-        self.enemy_list = [0 for _ in range(self.enemies_amount[0])] + \
-                          [1 for _ in range(self.enemies_amount[1])] + \
-                          [2 for _ in range(self.enemies_amount[2])] + \
-                          [3 for _ in range(self.enemies_amount[3])]
-        shuffle(self.enemy_list)
-        del self.enemy_list[20:]
+        if self.horde is None:
+            self.max_enemies, waves = 4, 1
+            self.spawn_points = list(self.enemy_positions)
+        else:
+            self.max_enemies, waves = self.horde.get_limits(self.level)
+            self.spawn_points = self.get_horde_spawn_points()
+        self.enemy_list = ([0 for _ in range(self.enemies_amount[0])] +
+                           [1 for _ in range(self.enemies_amount[1])] +
+                           [2 for _ in range(self.enemies_amount[2])] +
+                           [3 for _ in range(self.enemies_amount[3])]) * waves
+        self.random.shuffle(self.enemy_list)
+        # Волна - 20 врагов, пока очередь полная, первый враг появляется без ожидания
+        self.enemy_list_size = 20 * waves
+        del self.enemy_list[self.enemy_list_size:]
 
     def create_bonus(self):
-        num = randint(0, 5)
-        x, y = randint(0, PLAYGROUND_WIDTH - CELL_SIZE * 2), \
-               randint(0, PLAYGROUND_WIDTH - CELL_SIZE * 2)
+        num = self.random.randint(0, 5)
+        x, y = self.random.randint(0, PLAYGROUND_WIDTH - CELL_SIZE * 2), \
+               self.random.randint(0, PLAYGROUND_WIDTH - CELL_SIZE * 2)
         if not num:
-            self.bonuses.add(BonusStar(x, y))
+            self.bonuses.add(acquire(BonusStar, x, y))
         elif num == 1:
-            self.bonuses.add(BonusClock(x, y))
+            self.bonuses.add(acquire(BonusClock, x, y))
         elif num == 2:
-            self.bonuses.add(BonusGrenade(x, y))
+            self.bonuses.add(acquire(BonusGrenade, x, y))
         elif num == 3:
-            self.bonuses.add(BonusHelmet(x, y))
+            self.bonuses.add(acquire(BonusHelmet, x, y))
         elif num == 4:
-            self.bonuses.add(BonusShovel(x, y))
+            self.bonuses.add(acquire(BonusShovel, x, y))
         elif num == 5:
-            self.bonuses.add(BonusTank(x, y))
+            self.bonuses.add(acquire(BonusTank, x, y))
 
     def make_base_protected(self):
         new_blocks = list()
@@ -499,7 +987,7 @@ class Game:
     def make_base_unprotected(self):
         new_blocks = list()
         for block in self.blocks_around_base:
-            if block in self.blocks.sprites():
+            if self.blocks.has(block):
                 _block = BrickWall(block.rect.x, block.rect.y)
                 self.blocks.remove(block)
                 self.blocks.add(_block)
@@ -514,21 +1002,29 @@ class Game:
 
 
 class Tank(pygame.sprite.Sprite):
+    # Поля танка, из которых складывается его состояние в снимке игры
+    state_fields = ('cell_size', 'start_tank_terminate', 'velocity', 'velocity_backup', 'vel_x', 'vel_y', 'facing',
+                    'frame_names', 'shown_frame', 'phase', 'durability', 'lives', 'stay', 'bullet_limit',
+                    'bullet_speed', 'tier', 'bonus', 'immortal', 'immortal_count', 'immortal_duration',
+                    'spawn_duration', 'spawn_count', 'frozen', 'freeze_duration', 'freeze_count')
+
     def __init__(self, x, y, velocity, game, *groups):
+        self.cell_size = CELL_SIZE * 2 - 10
+        self.rect = pygame.Rect(x, y, self.cell_size, self.cell_size)
         super().__init__(*groups)
+        self.prev_pos = None
         self.start_tank_terminate = False
         self.game = game
-        self.cell_size = CELL_SIZE * 2 - 10
-        self.rect = pygame.Rect(x, y, self.cell_size, self.cell_size)
         self.velocity = velocity / FPS
         self.velocity_backup = self.velocity
         self.vel_x, self.vel_y = -self.velocity, 0
         self.bonuses = dict()
         self.facing = UP
-        self.animation = None
+        self.frame_names = tuple()
+        self.frames = None
+        self.phase = 0
         self.durability = 1
         self.lives = 1
-        self.angle = 0
         self.stay = True
         self.bullet_limit = 1
         self.bullet_speed = 240
@@ -537,18 +1033,17 @@ class Tank(pygame.sprite.Sprite):
         self.immortal = True
         self.immortal_count = 0
         self.immortal_duration = FPS * 3
-        self.spawn_animation = cycle(load_image(f'spawn_animation_{i}', (self.cell_size, self.cell_size), -1)
-                                     for i in range(8))
+        self.spawn_animation = self.load_spawn_animation()
         self.spawn_duration = FPS
         self.spawn_count = 0
         self.frozen = False
         self.freeze_duration = FPS * 10
         self.freeze_count = 0
-        self.image = next(self.spawn_animation)
+        self.image = self.spawn_animation[0]
 
     def update(self, *args):
         if self.start_tank_terminate:
-            self.game.explosions.add(TankExplosion(self))
+            self.game.explosions.add(acquire(TankExplosion, self))
             if isinstance(self, Player):
                 lives = self.lives - 1
                 self.terminate()
@@ -565,71 +1060,65 @@ class Tank(pygame.sprite.Sprite):
                 return
         if self.spawn_animation is not None:
             if self.spawn_count >= self.spawn_duration:
-                self.image = next(self.animation)
+                self.show_frame()
                 self.spawn_animation = None
             else:
-                self.image = next(self.spawn_animation)
                 self.spawn_count += 1
+                self.image = self.spawn_animation[self.spawn_count % len(self.spawn_animation)]
                 return
         if self.durability <= 0:
             self.terminate()
             return
-        if len(get_collided_by_rect(self, game.players, game.enemies)) > 1:
+        if self.count_collided_tanks() > 1:
             self.rect.y += self.vel_y
-            collides = get_collided_by_rect(self, game.blocks)
-            if len(collides) or not (0 <= self.rect.top and self.rect.bottom <= PLAYGROUND_WIDTH):
+            if self.game.terrain.collides_rect(self.rect) or \
+                    not (0 <= self.rect.top and self.rect.bottom <= PLAYGROUND_WIDTH):
                 self.rect.y -= self.vel_y
         else:
             self.rect.y += self.vel_y
-            collides = get_collided_by_rect(self, game.players, game.blocks, game.enemies)
-            if len(collides) > 1 or not (0 <= self.rect.top and self.rect.bottom <= PLAYGROUND_WIDTH):
+            if self.count_collided_tanks() > 1 or self.game.terrain.collides_rect(self.rect) or \
+                    not (0 <= self.rect.top and self.rect.bottom <= PLAYGROUND_WIDTH):
                 self.rect.y -= self.vel_y
-        if len(get_collided_by_rect(self, game.players, game.enemies)) > 1:
+        if self.count_collided_tanks() > 1:
             self.rect.x += self.vel_x
-            collides = get_collided_by_rect(self, game.blocks)
-            if len(collides) or not (0 <= self.rect.left and self.rect.right <= PLAYGROUND_WIDTH):
+            if self.game.terrain.collides_rect(self.rect) or \
+                    not (0 <= self.rect.left and self.rect.right <= PLAYGROUND_WIDTH):
                 self.rect.x -= self.vel_x
         else:
             self.rect.x += self.vel_x
-            collides = get_collided_by_rect(self, game.players, game.blocks, game.enemies)
-            if len(collides) > 1 or not (0 <= self.rect.left and self.rect.right <= PLAYGROUND_WIDTH):
+            if self.count_collided_tanks() > 1 or self.game.terrain.collides_rect(self.rect) or \
+                    not (0 <= self.rect.left and self.rect.right <= PLAYGROUND_WIDTH):
                 self.rect.x -= self.vel_x
         self.stay = False
         if self.vel_x > 0:
             self.facing = RIGHT
-            self.angle = 270
         elif self.vel_x < 0:
             self.facing = LEFT
-            self.angle = 90
         elif self.vel_y > 0:
             self.facing = DOWN
-            self.angle = 180
         elif self.vel_y < 0:
             self.facing = UP
-            self.angle = 0
         else:
             self.stay = True
         self.bonus_handler()
         self.change_angle()
-        if self.animation and not self.stay:
-            self.image = next(self.animation)
-            self.image = pygame.transform.rotate(self.image, self.angle)
+        if self.frames and not self.stay:
+            self.phase = (self.phase + 1) % len(self.frames)
+            self.show_frame()
         if self.immortal:
-            if self not in [shield.tank for shield in self.game.shields.sprites()]:
-                self.game.shields.add(Shield(self))
+            shield = self.game.shields.get(self)
+            if shield is None:
+                self.game.shields.add(acquire(Shield, self))
                 self.immortal_count += 1
             else:
                 if self.immortal_count >= self.immortal_duration:
                     self.immortal = False
-                    for shield in self.game.shields.sprites():
-                        if shield.tank == self:
-                            self.game.shields.remove(shield)
-                            break
+                    release(shield)
                 else:
                     self.immortal_count += 1
 
     def bonus_handler(self):
-        for bonus in get_collided_by_rect(self, game.bonuses):
+        for bonus in get_collided_by_rect(self, self.game.bonuses):
             if SOUND_ON:
                 pygame.mixer.Sound('data/music/bonus_taken.wav').play()
             if isinstance(bonus, BonusHelmet):
@@ -648,37 +1137,30 @@ class Tank(pygame.sprite.Sprite):
                 if self.tier in range(1, 4):
                     self.tier += 1
                     self.change_tier()
-            game.bonuses.remove(bonus)
             bonus.terminate()
 
     def change_tier(self):
         if self.tier == 2:
             self.bullet_speed = 480
             if self.number:
-                self.animation = cycle((load_image('tier2_tank_second', (self.cell_size, self.cell_size), -1),
-                                        load_image('tier2_tank_second_2', (self.cell_size, self.cell_size), -1)))
+                self.set_frames('tier2_tank_second', 'tier2_tank_second_2')
             else:
-                self.animation = cycle((load_image('tier2_tank', (self.cell_size, self.cell_size), -1),
-                                        load_image('tier2_tank_2', (self.cell_size, self.cell_size), -1)))
+                self.set_frames('tier2_tank', 'tier2_tank_2')
         elif self.tier == 3:
             self.bullet_speed = 480
             self.bullet_limit = 2
             if self.number:
-                self.animation = cycle((load_image('tier2_tank_second', (self.cell_size, self.cell_size), -1),
-                                        load_image('tier2_tank_second_2', (self.cell_size, self.cell_size), -1)))
+                self.set_frames('tier2_tank_second', 'tier2_tank_second_2')
             else:
-                self.animation = cycle((load_image('tier3_tank', (self.cell_size, self.cell_size), -1),
-                                        load_image('tier3_tank_2', (self.cell_size, self.cell_size), -1)))
+                self.set_frames('tier3_tank', 'tier3_tank_2')
         elif self.tier == 4:
             self.bullet_speed = 480
             self.bullet_limit = 2
             self.durability = 2
             if self.number:
-                self.animation = cycle((load_image('tier4_tank_second', (self.cell_size, self.cell_size), -1),
-                                        load_image('tier4_tank_second_2', (self.cell_size, self.cell_size), -1)))
+                self.set_frames('tier4_tank_second', 'tier4_tank_second_2')
             else:
-                self.animation = cycle((load_image('tier4_tank', (self.cell_size, self.cell_size), -1),
-                                        load_image('tier4_tank_2', (self.cell_size, self.cell_size), -1)))
+                self.set_frames('tier4_tank', 'tier4_tank_2')
 
     def make_immortal(self, duration):
         self.immortal = True
@@ -690,167 +1172,172 @@ class Tank(pygame.sprite.Sprite):
         self.freeze_duration = duration
         self.freeze_count = 0
 
+    def count_collided_tanks(self):
+        # То же, что len(get_collided_by_rect(self, players, enemies)), но без сборки и сортировки списков
+        return self.game.players.count(self.rect, self) + self.game.enemies.count(self.rect, self)
+
     def shoot(self):
-        if not self.frozen and self.spawn_animation is None:
-            bullets_count = 0
-            for bullet in game.bullets.sprites():
-                if bullet.owner is self:
-                    bullets_count += 1
-                if bullets_count >= self.bullet_limit:
-                    return
-            game.bullets.add(Bullet(self))
+        if not self.frozen and self.spawn_animation is None and \
+                self.game.bullets.count_owned(self) < self.bullet_limit:
+            self.game.bullets.add(acquire(Bullet, self))
 
     def is_under_fire(self):
         if not self.immortal:
             self.durability -= 1
             if isinstance(self, Enemy) and self.bonus:
-                self.game.bonuses.empty()
+                for bonus in self.game.bonuses.sprites():
+                    bonus.terminate()
                 self.game.create_bonus()
                 self.bonus = False
 
     def change_angle(self):
         if self.vel_y == -self.velocity:
             self.facing = UP
-            self.angle = 0
         elif self.vel_x == -self.velocity:
             self.facing = LEFT
-            self.angle = 90
         elif self.vel_y == self.velocity:
             self.facing = DOWN
-            self.angle = 180
         elif self.vel_x == self.velocity:
             self.facing = RIGHT
-            self.angle = 270
+
+    def load_spawn_animation(self):
+        return tuple(load_image(f'spawn_animation_{i}', (self.cell_size, self.cell_size), -1) for i in range(8))
+
+    def set_frames(self, *names):
+        self.frame_names = names
+        self.frames = IMAGE_CACHE.get_frames(names, (self.cell_size, self.cell_size))
+        self.phase %= len(self.frames)
+
+    def show_frame(self):
+        self.image = self.frames.images[self.facing][self.phase]
+        self.mask = self.frames.masks[self.facing][self.phase]
+        # Маска участвует в столкновениях, поэтому запоминаем, с какого кадра она взята
+        self.shown_frame = (self.frame_names, self.facing, self.phase)
 
     def terminate(self):
         self.start_tank_terminate = True
 
+    def get_state(self):
+        state = {name: getattr(self, name) for name in self.state_fields}
+        state['spawning'] = self.spawn_animation is not None
+        return state
+
+    def set_state(self, state, game):
+        for name in self.state_fields:
+            setattr(self, name, state[name])
+        self.game = game
+        self.prev_pos = None
+        self.bonuses = dict()
+        self.set_frames(*self.frame_names)
+        names, facing, phase = self.shown_frame
+        self.shown_frame = (tuple(names), facing, phase)
+        shown = IMAGE_CACHE.get_frames(self.shown_frame[0], (self.cell_size, self.cell_size))
+        self.image, self.mask = shown.images[facing][phase], shown.masks[facing][phase]
+        self.spawn_animation = None
+        if state['spawning']:
+            self.spawn_animation = self.load_spawn_animation()
+            self.image = self.spawn_animation[self.spawn_count % len(self.spawn_animation)]
+
 
 class Enemy(Tank):
+    state_fields = Tank.state_fields + ('reward', 'ai_slot')
+
     def __init__(self, x, y, velocity, game, bonus: bool, *groups):
         super().__init__(x, y, velocity, game, *groups)
-        self.animation = cycle((load_image('enemy_tier1_tank', (self.cell_size, self.cell_size), -1),
-                                load_image('enemy_tier1_tank_2', (self.cell_size, self.cell_size), -1)))
-        self.image = next(self.animation)
-        self.mask = pygame.mask.from_surface(self.image)
+        self.set_frames('enemy_tier1_tank', 'enemy_tier1_tank_2')
+        self.show_frame()
         self.bonus = bonus
         self.reward = 0
         self.stay = False
         self.facing = DOWN
         self.immortal = False
+        self.ai_slot = game.ai.register()
 
     def update(self, *args):
         if self.start_tank_terminate:
-            self.game.explosions.add(TankExplosion(self))
+            self.game.explosions.add(acquire(TankExplosion, self))
             self.remove(*self.groups())
             del self
             return
         if self.spawn_animation is not None:
             if self.spawn_count >= self.spawn_duration:
-                self.image = next(self.animation)
+                self.show_frame()
                 self.spawn_animation = None
             else:
-                self.image = next(self.spawn_animation)
                 self.spawn_count += 1
+                self.image = self.spawn_animation[self.spawn_count % len(self.spawn_animation)]
                 return
         if self.durability <= 0:
             self.terminate()
             return
         if not self.frozen:
-            if len(get_collided_by_rect(self, game.players, game.enemies)) > 1:
+            if self.count_collided_tanks() > 1:
                 self.rect.y += self.vel_y
-                collides = get_collided_by_rect(self, game.blocks)
-                if len(collides) or not (0 <= self.rect.top and self.rect.bottom <= PLAYGROUND_WIDTH):
+                if self.game.terrain.collides_rect(self.rect) or \
+                        not (0 <= self.rect.top and self.rect.bottom <= PLAYGROUND_WIDTH):
                     self.rect.y -= self.vel_y
-                    self.choose_new_direction(True)
+                    self.game.ai.request(self, True)
             else:
                 self.rect.y += self.vel_y
-                collides = get_collided_by_rect(self, game.players, game.blocks, game.enemies)
-                if len(collides) > 1 or not (0 <= self.rect.top and self.rect.bottom <= PLAYGROUND_WIDTH):
+                if self.count_collided_tanks() > 1 or self.game.terrain.collides_rect(self.rect) or \
+                        not (0 <= self.rect.top and self.rect.bottom <= PLAYGROUND_WIDTH):
                     self.rect.y -= self.vel_y
-                    self.choose_new_direction()
+                    self.game.ai.request(self)
 
-            if len(get_collided_by_rect(self, game.players, game.enemies)) > 1:
+            if self.count_collided_tanks() > 1:
                 self.rect.x += self.vel_x
-                collides = get_collided_by_rect(self, game.blocks)
-                if len(collides) or not (0 <= self.rect.left and self.rect.right <= PLAYGROUND_WIDTH):
+                if self.game.terrain.collides_rect(self.rect) or \
+                        not (0 <= self.rect.left and self.rect.right <= PLAYGROUND_WIDTH):
                     self.rect.x -= self.vel_x
-                    self.choose_new_direction(True)
+                    self.game.ai.request(self, True)
             else:
                 self.rect.x += self.vel_x
-                collides = get_collided_by_rect(self, game.players, game.blocks, game.enemies)
-                if len(collides) > 1 or not (0 <= self.rect.left and self.rect.right <= PLAYGROUND_WIDTH):
+                if self.count_collided_tanks() > 1 or self.game.terrain.collides_rect(self.rect) or \
+                        not (0 <= self.rect.left and self.rect.right <= PLAYGROUND_WIDTH):
                     self.rect.x -= self.vel_x
-                    self.choose_new_direction()
+                    self.game.ai.request(self)
         else:
             self.stay = True
             if self.freeze_count >= self.freeze_duration:
                 self.frozen = False
             else:
                 self.freeze_count += 1
-        if randint(0, 7) == 0:
+        # Думая раз в interval тиков, враг стреляет с той же частотой, что и каждый тик
+        if self.game.ai.is_thinking(self) and self.game.random.randint(0, 7) < self.game.ai.interval:
             self.shoot()
         self.change_angle()
-        if self.animation and not self.stay:
-            self.image = next(self.animation)
-            self.image = pygame.transform.rotate(self.image, self.angle)
+        if self.frames and not self.stay:
+            self.phase = (self.phase + 1) % len(self.frames)
+            self.show_frame()
 
     def choose_new_direction(self, ignore_players=False):
         directions = [UP, RIGHT, DOWN, LEFT]
 
         inverse_direction = directions[(directions.index(self.facing) + 2) % 4]
-        shuffle(directions)
+        self.game.random.shuffle(directions)
         directions.remove(inverse_direction)
         directions.append(inverse_direction)
+        if ENEMY_NAVIGATION and self.game.random.random() < ENEMY_NAVIGATION:
+            # Сначала стороны, откуда путь до базы короче; при равенстве порядок остается случайным
+            distances = self.game.navigation.get_direction_distances(self.rect)
+            directions.sort(key=distances.__getitem__)
+            if directions[0] == self.facing and \
+                    self.game.terrain.collides_rect(self.rect.move(*self.get_step(self.facing)), ('brick',)):
+                # Кратчайший путь идет сквозь кирпич впереди: стоим и простреливаем его
+                self.stay = True
+                return
         directions.remove(self.facing)
 
         new_direction = None
 
         for direction in directions:
-            if direction == UP:
-                new_sprite = pygame.sprite.Sprite()
-                new_sprite.rect = self.rect.move(0, -self.cell_size)
-                if ignore_players:
-                    collides = get_collided_by_rect(new_sprite, game.blocks)
-                else:
-                    collides = get_collided_by_rect(new_sprite, game.players, game.blocks)
-                if len(collides) == 0 and 0 <= new_sprite.rect.top:
-                    new_direction = direction
-                    del new_sprite
-                    break
-            elif direction == RIGHT:
-                new_sprite = pygame.sprite.Sprite()
-                new_sprite.rect = self.rect.move(self.cell_size, 0)
-                if ignore_players:
-                    collides = get_collided_by_rect(new_sprite, game.blocks)
-                else:
-                    collides = get_collided_by_rect(new_sprite, game.players, game.blocks)
-                if len(collides) == 0 and PLAYGROUND_WIDTH >= new_sprite.rect.right:
-                    new_direction = direction
-                    del new_sprite
-                    break
-            elif direction == DOWN:
-                new_sprite = pygame.sprite.Sprite()
-                new_sprite.rect = self.rect.move(0, self.cell_size)
-                if ignore_players:
-                    collides = get_collided_by_rect(new_sprite, game.blocks)
-                else:
-                    collides = get_collided_by_rect(new_sprite, game.players, game.blocks)
-                if len(collides) == 0 and PLAYGROUND_WIDTH >= new_sprite.rect.bottom:
-                    new_direction = direction
-                    del new_sprite
-                    break
-            elif direction == LEFT:
-                new_sprite = pygame.sprite.Sprite()
-                new_sprite.rect = self.rect.move(-self.cell_size, 0)
-                if ignore_players:
-                    collides = get_collided_by_rect(new_sprite, game.blocks)
-                else:
-                    collides = get_collided_by_rect(new_sprite, game.players, game.blocks)
-                if len(collides) == 0 and 0 <= new_sprite.rect.left:
-                    new_direction = direction
-                    del new_sprite
-                    break
+            rect = self.rect.move(*self.get_step(direction))
+            if (ignore_players or not self.game.players.query(rect)) and \
+                    not self.game.terrain.collides_rect(rect) and \
+                    0 <= rect.left and 0 <= rect.top and rect.right <= PLAYGROUND_WIDTH and \
+                    rect.bottom <= PLAYGROUND_WIDTH:
+                new_direction = direction
+                break
 
         if new_direction is None:
             new_direction = inverse_direction
@@ -868,10 +1355,13 @@ class Enemy(Tank):
             self.stay = True
         self.facing = new_direction
 
+    def get_step(self, direction):
+        return {UP: (0, -self.cell_size), DOWN: (0, self.cell_size),
+                LEFT: (-self.cell_size, 0), RIGHT: (self.cell_size, 0)}[direction]
+
     def make_bonus(self, tier: int):
-        first, second = next(self.animation), next(self.animation)
-        self.animation = cycle((first, load_image(f'tier{tier}_tank_bonus_2', (self.cell_size, self.cell_size), -1),
-                                second, load_image(f'tier{tier}_tank_bonus', (self.cell_size, self.cell_size), -1)))
+        first, second = self.frame_names
+        self.set_frames(first, f'tier{tier}_tank_bonus_2', second, f'tier{tier}_tank_bonus')
 
 
 class SimpleEnemy(Enemy):
@@ -887,12 +1377,10 @@ class QuickTank(Enemy):
         super().__init__(x, y, 90, game, bonus, *groups)
         self.bonus = bonus
         self.reward = 200
-        self.animation = cycle((load_image('enemy_tier2_tank', (self.cell_size, self.cell_size), -1),
-                                load_image('enemy_tier2_tank_2', (self.cell_size, self.cell_size), -1)))
+        self.set_frames('enemy_tier2_tank', 'enemy_tier2_tank_2')
         if self.bonus:
             self.make_bonus(2)
-        self.image = next(self.animation)
-        self.mask = pygame.mask.from_surface(self.image)
+        self.show_frame()
 
 
 class QuickFireTank(Enemy):
@@ -901,12 +1389,10 @@ class QuickFireTank(Enemy):
         self.bonus = bonus
         self.bullet_speed *= 2
         self.reward = 300
-        self.animation = cycle((load_image('enemy_tier3_tank', (self.cell_size, self.cell_size), -1),
-                                load_image('enemy_tier3_tank_2', (self.cell_size, self.cell_size), -1)))
+        self.set_frames('enemy_tier3_tank', 'enemy_tier3_tank_2')
         if self.bonus:
             self.make_bonus(3)
-        self.image = next(self.animation)
-        self.mask = pygame.mask.from_surface(self.image)
+        self.show_frame()
 
 
 class StrongTank(Enemy):
@@ -915,30 +1401,28 @@ class StrongTank(Enemy):
         self.bonus = bonus
         self.reward = 400
         self.durability = 4
-        self.animation = cycle((load_image('enemy_tier4_tank', (self.cell_size, self.cell_size), -1),
-                                load_image('enemy_tier4_tank_2', (self.cell_size, self.cell_size), -1)))
+        self.set_frames('enemy_tier4_tank', 'enemy_tier4_tank_2')
         if self.bonus:
             self.make_bonus(4)
-        self.image = next(self.animation)
-        self.mask = pygame.mask.from_surface(self.image)
+        self.show_frame()
 
 
 class Player(Tank):
-    _instances = [None, None]
+    state_fields = Tank.state_fields + ('number', 'start_coords', 'command', 'score')
 
     def __init__(self, x, y, game, tier, lives, *groups):
         super().__init__(x, y, 90, game, *groups)
-        self.number = Player._instances.index(None)
+        self.number = self.game.player_slots.index(None)
         self.start_coords = (x, y)
-        Player._instances[self.number] = self
+        self.game.player_slots[self.number] = self
         if self.number:
-            self.animation = cycle((load_image('tier1_tank_second', (self.cell_size, self.cell_size), -1),
-                                    load_image('tier1_tank_second_2', (self.cell_size, self.cell_size), -1)))
+            self.set_frames('tier1_tank_second', 'tier1_tank_second_2')
         else:
-            self.animation = cycle((load_image('tier1_tank', (self.cell_size, self.cell_size), -1),
-                                    load_image('tier1_tank_2', (self.cell_size, self.cell_size), -1)))
-        self.image = next(self.animation)
+            self.set_frames('tier1_tank', 'tier1_tank_2')
+        self.show_frame()
         self.vel_x, self.vel_y = 0, 0
+        # Команда до следующего тика: направление и нажатие выстрела
+        self.command = (None, False)
         self.score = 0
         self.lives = lives
         self.tier = tier
@@ -946,51 +1430,520 @@ class Player(Tank):
 
     def check_controls(self, event: pygame.event.EventType):
         if self.number == 0:
-            if pygame.key.get_pressed()[pygame.K_a]:
-                self.vel_x = -self.velocity
-                self.vel_y = 0
-            elif pygame.key.get_pressed()[pygame.K_d]:
-                self.vel_x = self.velocity
-                self.vel_y = 0
-            elif pygame.key.get_pressed()[pygame.K_w]:
-                self.vel_y = -self.velocity
-                self.vel_x = 0
-            elif pygame.key.get_pressed()[pygame.K_s]:
-                self.vel_y = self.velocity
-                self.vel_x = 0
-            else:
-                self.vel_x = 0
-                self.vel_y = 0
-            if event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE:
-                self.shoot()
-        elif self.number == 1:
-            if pygame.key.get_pressed()[pygame.K_LEFT]:
-                self.vel_x = -self.velocity
-                self.vel_y = 0
-            elif pygame.key.get_pressed()[pygame.K_RIGHT]:
-                self.vel_x = self.velocity
-                self.vel_y = 0
-            elif pygame.key.get_pressed()[pygame.K_UP]:
-                self.vel_y = -self.velocity
-                self.vel_x = 0
-            elif pygame.key.get_pressed()[pygame.K_DOWN]:
-                self.vel_y = self.velocity
-                self.vel_x = 0
-            else:
-                self.vel_x = 0
-                self.vel_y = 0
-            if event.type == pygame.KEYDOWN and event.key == pygame.K_KP_ENTER:
-                self.shoot()
+            keys = ((pygame.K_a, LEFT), (pygame.K_d, RIGHT), (pygame.K_w, UP), (pygame.K_s, DOWN))
+            shoot_key = pygame.K_SPACE
+        else:
+            keys = ((pygame.K_LEFT, LEFT), (pygame.K_RIGHT, RIGHT), (pygame.K_UP, UP), (pygame.K_DOWN, DOWN))
+            shoot_key = pygame.K_KP_ENTER
+        pressed = pygame.key.get_pressed()
+        direction = next((direction for key, direction in keys if pressed[key]), None)
+        shoot = self.command[1] or event.type == pygame.KEYDOWN and event.key == shoot_key
+        self.command = (direction, shoot)
+
+    def apply_command(self, direction, shoot=False):
+        """
+        Управление без клавиатуры: направление движения (None - стоять на месте) и выстрел
+        """
+        if direction == LEFT:
+            self.vel_x, self.vel_y = -self.velocity, 0
+        elif direction == RIGHT:
+            self.vel_x, self.vel_y = self.velocity, 0
+        elif direction == UP:
+            self.vel_x, self.vel_y = 0, -self.velocity
+        elif direction == DOWN:
+            self.vel_x, self.vel_y = 0, self.velocity
+        else:
+            self.vel_x, self.vel_y = 0, 0
+        if shoot:
+            self.shoot()
+
+    def set_state(self, state, game):
+        super().set_state(state, game)
+        self.start_coords = tuple(self.start_coords)
+        self.command = tuple(self.command)
 
     def respawn(self):
-        Player._instances[self.number] = None
-        self.__init__(*self.start_coords, game, 1, self.lives - 1, game.players)
+        self.game.player_slots[self.number] = None
+        self.__init__(*self.start_coords, self.game, 1, self.lives - 1, self.game.players)
+
+
+class Terrain:
+    """
+    Карта материалов: по одной маске размером с игровое поле на каждый материал.
+    Проверка пересечения с местностью - один вызов Mask.overlap на материал
+    """
+    materials = ('brick', 'concrete', 'water', 'ice', 'grass')
+    # Материалы, через которые не проезжают танки
+    obstacles = ('brick', 'concrete', 'water')
+
+    def __init__(self):
+        self.masks = {material: pygame.mask.Mask((PLAYGROUND_WIDTH, PLAYGROUND_WIDTH))
+                      for material in self.materials}
+        self.rect_masks = dict()
+
+    def draw(self, block):
+        self.masks[block.material].draw(block.mask, block.rect.topleft)
+
+    def erase(self, block):
+        self.masks[block.material].erase(block.mask, block.rect.topleft)
+
+    def collides(self, mask, pos, materials):
+        for material in materials:
+            if self.masks[material].overlap(mask, pos) is not None:
+                return True
+        return False
+
+    def collides_rect(self, rect, materials=obstacles):
+        mask = self.rect_masks.get(rect.size)
+        if mask is None:
+            mask = pygame.mask.Mask(rect.size, fill=True)
+            self.rect_masks[rect.size] = mask
+        return self.collides(mask, rect.topleft, materials)
+
+
+class Horde:
+    """
+    Режим орды для нагрузочных прогонов: на поле одновременно до max_enemies врагов,
+    состав врагов уровня повторяется waves раз, враги появляются сразу во всех свободных точках.
+    levels - свои ограничения для отдельных уровней: {номер уровня: (max_enemies, waves)}
+    """
+    def __init__(self, max_enemies=200, waves=10, levels=None):
+        self.max_enemies = max_enemies
+        self.waves = waves
+        self.levels = dict(levels or ())
+
+    def get_limits(self, level):
+        return self.levels.get(level, (self.max_enemies, self.waves))
+
+    def get_state(self):
+        return {'max_enemies': self.max_enemies, 'waves': self.waves,
+                'levels': [[level, *limits] for level, limits in sorted(self.levels.items())]}
+
+    def set_state(self, state):
+        self.max_enemies = state['max_enemies']
+        self.waves = state['waves']
+        self.levels = {level: (max_enemies, waves) for level, max_enemies, waves in state['levels']}
+
+
+class Navigation:
+    """
+    Карта путей к базе, общая для всех врагов.
+    Узел (i, j) - танк, стоящий на клетках i..i+1, j..j+1. Для каждого узла хранится
+    длина кратчайшего пути до базы: шаг через свободные клетки стоит 1,
+    через кирпич - 1 + NAVIGATION_BRICK_COST, бетон и вода непроходимы.
+    Изменения блоков копятся в BlockGroup.changed_cells и разбираются разом при первом
+    запросе после них: пересчитываются только узлы, чьи пути прошли через изменившиеся клетки
+    """
+    size = 25
+    steps = {UP: (-1, 0), DOWN: (1, 0), LEFT: (0, -1), RIGHT: (0, 1)}
+    # Если изменилось больше клеток (новый уровень, восстановление снимка), карта строится заново
+    rebuild_limit = 26 * 26 // 4
+
+    def __init__(self, blocks, targets=None):
+        """
+        targets - узлы, к которым ведут пути, по умолчанию узлы вокруг флага
+        """
+        self.blocks = blocks
+        blocks.changed_cells = set()
+        self.targets = targets or [(i, j) for i in (23, 24) for j in (11, 12, 13)]
+        self.costs = None
+        self.distances = None
+        # Следующий узел по кратчайшему пути к базе
+        self.parents = None
+        self.rebuilds = 0
+        self.repairs = 0
+
+    def get_cost(self, i, j):
+        cost = 1
+        for cell in ((i, j), (i, j + 1), (i + 1, j), (i + 1, j + 1)):
+            for block in self.blocks.cells.get(cell, ()):
+                if block.material == 'brick':
+                    cost = 1 + NAVIGATION_BRICK_COST
+                else:
+                    return None
+        return cost
+
+    def update(self):
+        changed_cells = self.blocks.changed_cells
+        if self.distances is None or len(changed_cells) > self.rebuild_limit:
+            self.rebuild()
+        elif changed_cells:
+            self.repair(changed_cells)
+        changed_cells.clear()
+
+    def rebuild(self):
+        self.rebuilds += 1
+        self.costs = {(i, j): self.get_cost(i, j) for i in range(self.size) for j in range(self.size)}
+        self.distances = dict()
+        self.parents = dict()
+        heap = []
+        for node in self.targets:
+            self.distances[node] = 0
+            heap.append((0, node))
+        self.propagate(heap)
+
+    def repair(self, changed_cells):
+        """
+        Динамический пересчет кратчайших путей после изменения стоимости узлов.
+        Подорожавшие и ставшие непроходимыми узлы обрывают пути, которые шли через них:
+        такие узлы теряют расстояния и получают новые от соседей с целыми путями.
+        Подешевевшие узлы просто распространяют улучшение дальше
+        """
+        nodes = {(i + di, j + dj) for i, j in changed_cells for di in (-1, 0) for dj in (-1, 0)}
+        costs, distances, parents = self.costs, self.distances, self.parents
+        raised = []
+        lowered = []
+        for node in nodes:
+            if node not in costs:
+                continue
+            old_cost, cost = costs[node], self.get_cost(*node)
+            if cost == old_cost:
+                continue
+            costs[node] = cost
+            if old_cost is None or cost is not None and cost < old_cost:
+                lowered.append(node)
+            else:
+                raised.append(node)
+        if not raised and not lowered:
+            return
+        self.repairs += 1
+        # Узлы, пути которых шли через подорожавшие узлы: поддеревья по ссылкам на следующий узел
+        invalid = set()
+        if raised:
+            children = dict()
+            for node, parent in parents.items():
+                children.setdefault(parent, []).append(node)
+            stack = [node for node in raised if costs[node] is None and node not in self.targets]
+            for node in raised:
+                stack.extend(children.get(node, ()))
+            while stack:
+                node = stack.pop()
+                if node not in invalid:
+                    invalid.add(node)
+                    stack.extend(children.get(node, ()))
+            for node in invalid:
+                distances.pop(node, None)
+                parents.pop(node, None)
+        heap = []
+        for node in invalid.union(lowered):
+            if costs[node] is None:
+                continue
+            i, j = node
+            for di, dj in self.steps.values():
+                neighbour = (i + di, j + dj)
+                if neighbour in distances:
+                    distance = distances[neighbour] + (costs[neighbour] or 1)
+                    if distance < distances.get(node, math.inf):
+                        distances[node] = distance
+                        parents[node] = neighbour
+            if node in distances:
+                heap.append((distances[node], node))
+        self.propagate(heap)
+
+    def propagate(self, heap):
+        # Алгоритм Дейкстры от узлов heap с уже известными расстояниями
+        costs, distances, parents = self.costs, self.distances, self.parents
+        heapify(heap)
+        while heap:
+            distance, (i, j) = heappop(heap)
+            if distance > distances[(i, j)]:
+                continue
+            # Шаг к цели стоит столько, сколько въезд в узел, куда он ведет.
+            # Цель под бетоном (база под защитой лопаты) считается свободной
+            new_distance = distance + (costs[(i, j)] or 1)
+            for di, dj in self.steps.values():
+                node = (i + di, j + dj)
+                if costs.get(node) is not None and new_distance < distances.get(node, math.inf):
+                    distances[node] = new_distance
+                    parents[node] = (i, j)
+                    heappush(heap, (new_distance, node))
+
+    def get_node(self, rect):
+        return (min(max(round(rect.y / CELL_SIZE), 0), self.size - 1),
+                min(max(round(rect.x / CELL_SIZE), 0), self.size - 1))
+
+    def get_distance(self, node):
+        self.update()
+        return self.distances.get(node, math.inf)
+
+    def get_direction_distances(self, rect):
+        """
+        Длина пути до базы после шага в каждую сторону из узла, на котором стоит rect
+        """
+        i, j = self.get_node(rect)
+        return {direction: self.get_distance((i + di, j + dj)) for direction, (di, dj) in self.steps.items()}
+
+
+class AIScheduler:
+    """
+    Планировщик решений врагов. Движение идет каждый тик, а решения распределяются по тикам:
+    бросок на выстрел каждый враг делает раз в interval тиков со своим сдвигом,
+    а выбор нового направления тратит одну операцию из бюджета budget на тик.
+    Решения сверх бюджета ждут в очереди и первыми выполняются в следующих тиках,
+    танк пока стоит. Бюджет считается в операциях, а не во времени,
+    чтобы игра с одним сидом всегда шла одинаково
+    """
+    def __init__(self, interval=1, budget=None):
+        # Шанс выстрела за решение - interval из 8 (Enemy.update): при интервале больше 8
+        # частота выстрелов падала бы, поэтому интервал ограничен
+        self.interval = max(1, min(interval, 8))
+        self.budget = budget
+        self.left = budget
+        self.tick = 0
+        # Отложенные решения по порядку: танк -> ignore_players
+        self.queue = dict()
+        self.slots = 0
+        self.decisions = 0
+        self.deferred = 0
+
+    def register(self):
+        # Сдвиг нового врага по тикам: враги думают по очереди, а не все в одном тике
+        slot = self.slots % self.interval
+        self.slots += 1
+        return slot
+
+    def begin_tick(self, tick):
+        self.tick = tick
+        self.left = self.budget
+        for tank, ignore_players in list(self.queue.items()):
+            if self.left is not None and self.left <= 0:
+                break
+            del self.queue[tank]
+            if tank.alive():
+                self.decide(tank, ignore_players)
+
+    def is_thinking(self, tank):
+        return (self.tick + tank.ai_slot) % self.interval == 0
+
+    def request(self, tank, ignore_players=False):
+        """
+        Танк уперся и должен выбрать новое направление
+        """
+        if self.left is None or not self.queue and self.left > 0:
+            self.decide(tank, ignore_players)
+        elif tank not in self.queue:
+            self.queue[tank] = ignore_players
+            self.deferred += 1
+
+    def decide(self, tank, ignore_players):
+        if self.left is not None:
+            self.left -= 1
+        self.decisions += 1
+        tank.choose_new_direction(ignore_players)
+
+    def get_state(self):
+        return {'queue': list(map(list, self.queue.items())), 'slots': self.slots}
+
+    def set_state(self, state):
+        self.queue = {tank: ignore_players for tank, ignore_players in state['queue']}
+        self.slots = state['slots']
+
+    def stats(self):
+        return {'decisions': self.decisions, 'deferred': self.deferred, 'waiting': len(self.queue)}
+
+
+class TerrainLayer:
+    """
+    Заранее собранная картинка блоков нескольких групп.
+    Клетка пересобирается только после изменения, за кадр слой рисуется одним blit
+    """
+    def __init__(self, *groups, color_key=None):
+        self.groups = groups
+        self.color_key = color_key
+        self.surface = pygame.Surface((PLAYGROUND_WIDTH, PLAYGROUND_WIDTH)).convert()
+        if color_key is not None:
+            self.surface.set_colorkey(color_key)
+        self.invalid = {(i, j) for i in range(26) for j in range(26)}
+        for group in groups:
+            group.layer = self
+
+    def invalidate(self, rect):
+        for i in range(max(rect.top // CELL_SIZE, 0), min((rect.bottom - 1) // CELL_SIZE, 25) + 1):
+            for j in range(max(rect.left // CELL_SIZE, 0), min((rect.right - 1) // CELL_SIZE, 25) + 1):
+                self.invalid.add((i, j))
+
+    def update(self):
+        """
+        Пересобирает устаревшие клетки и возвращает их прямоугольники
+        """
+        if not self.invalid:
+            return []
+        background = self.color_key or (0, 0, 0)
+        if len(self.invalid) > 26 * 26 // 4:
+            self.surface.fill(background)
+            for group in self.groups:
+                group.draw(self.surface)
+            self.invalid.clear()
+            return [self.surface.get_rect()]
+        changed = []
+        for i, j in self.invalid:
+            rect = pygame.Rect(j * CELL_SIZE, i * CELL_SIZE, CELL_SIZE, CELL_SIZE)
+            self.surface.fill(background, rect)
+            for group in self.groups:
+                self.surface.blits([(sprite.image, sprite.rect) for sprite in group.query(rect)], False)
+            changed.append(rect)
+        self.invalid.clear()
+        return changed
+
+
+class BlockGroup(pygame.sprite.Group):
+    """
+    Группа блоков с индексом по клеткам карты:
+    поиск пересечений смотрит только клетки, которые покрывает прямоугольник
+    """
+    def __init__(self, *sprites, terrain=None):
+        self.cells = dict()
+        self.terrain = terrain
+        # Слой TerrainLayer, в который собраны картинки блоков группы
+        self.layer = None
+        # Растет при каждом добавлении и удалении блока, по нему видно, что карта изменилась
+        self.version = 0
+        # Клетки, где менялись блоки, копятся до следующего обновления карты путей.
+        # None - изменения никто не отслеживает
+        self.changed_cells = None
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        self.version += 1
+        if self.changed_cells is not None:
+            self.changed_cells.add(get_cell(sprite.rect))
+        self.cells.setdefault(get_cell(sprite.rect), []).append(sprite)
+        if self.terrain is not None:
+            self.terrain.draw(sprite)
+        self.refresh(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        self.version += 1
+        if self.changed_cells is not None:
+            self.changed_cells.add(get_cell(sprite.rect))
+        self.cells[get_cell(sprite.rect)].remove(sprite)
+        if self.terrain is not None:
+            self.terrain.erase(sprite)
+        self.refresh(sprite)
+
+    def refresh(self, sprite):
+        # Вызывается и при смене картинки блока
+        if self.layer is not None:
+            self.layer.invalidate(sprite.rect)
+
+    def query(self, rect):
+        collided = []
+        for i in range(max(rect.top // CELL_SIZE, 0), min((rect.bottom - 1) // CELL_SIZE, 25) + 1):
+            for j in range(max(rect.left // CELL_SIZE, 0), min((rect.right - 1) // CELL_SIZE, 25) + 1):
+                for sprite in self.cells.get((i, j), ()):
+                    if sprite.rect.colliderect(rect):
+                        collided.append(sprite)
+        return collided
+
+
+class SpatialHashGroup(pygame.sprite.Group):
+    """
+    Группа движущихся спрайтов с пространственным хэшем.
+    Спрайт переиндексируется после своего update, поэтому во время
+    обновления одного спрайта положение остальных в хэше актуально
+    """
+    cell_size = CELL_SIZE * 2
+
+    def __init__(self, *sprites):
+        self.buckets = dict()
+        self.sprite_cells = dict()
+        # Порядковые номера, чтобы выдавать спрайты в порядке группы
+        self.order = dict()
+        self.counter = 0
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        self.counter += 1
+        self.order[sprite] = self.counter
+        self.reindex(sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        del self.order[sprite]
+        for cell in self.sprite_cells.pop(sprite):
+            del self.buckets[cell][sprite]
+
+    def update(self, *args):
+        for sprite in self.sprites():
+            sprite.update(*args)
+            if sprite in self.sprite_cells:
+                self.reindex(sprite)
+
+    def reindex(self, sprite):
+        cells = self.get_cells(sprite.rect)
+        old_cells = self.sprite_cells.get(sprite)
+        if cells == old_cells:
+            return
+        if old_cells:
+            for cell in old_cells:
+                del self.buckets[cell][sprite]
+        for cell in cells:
+            self.buckets.setdefault(cell, dict())[sprite] = None
+        self.sprite_cells[sprite] = cells
+
+    def get_cells(self, rect):
+        size = self.cell_size
+        top, bottom = rect.top // size, (rect.bottom - 1) // size
+        left, right = rect.left // size, (rect.right - 1) // size
+        if top == bottom and left == right:
+            return (top, left),
+        return tuple((i, j) for i in range(top, bottom + 1) for j in range(left, right + 1))
+
+    def collect(self, rect):
+        collided = dict()
+        buckets = self.buckets
+        for cell in self.get_cells(rect):
+            if cell in buckets:
+                for sprite in buckets[cell]:
+                    if sprite.rect.colliderect(rect):
+                        collided[sprite] = None
+        return collided
+
+    def query(self, rect):
+        return sorted(self.collect(rect), key=self.order.__getitem__)
+
+    def count(self, rect, sprite=None):
+        """
+        Сколько спрайтов группы задевают rect. Спрайт sprite из группы учитывается всегда,
+        даже если в хэше он еще числится по старому положению
+        """
+        collided = self.collect(rect)
+        return len(collided) + (sprite in self.order and sprite not in collided)
+
+
+class BulletGroup(SpatialHashGroup):
+    """
+    Снаряды с подсчетом по владельцам: лимит выстрелов танка проверяется без обхода всех снарядов.
+    Взрывающийся снаряд остается в группе и продолжает занимать место в лимите
+    """
+    def __init__(self, *sprites):
+        self.owned = dict()
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        self.owned[sprite.owner] = self.owned.get(sprite.owner, 0) + 1
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        if self.owned[sprite.owner] == 1:
+            del self.owned[sprite.owner]
+        else:
+            self.owned[sprite.owner] -= 1
+
+    def count_owned(self, owner):
+        return self.owned.get(owner, 0)
 
 
 class Block(pygame.sprite.Sprite):
+    material = None
+
     def __init__(self, x, y, *groups):
-        super().__init__(*groups)
         self.rect = pygame.Rect(x, y, CELL_SIZE, CELL_SIZE)
+        super().__init__(*groups)
 
     def is_under_fire(self, bullet):
         pass
@@ -999,23 +1952,69 @@ class Block(pygame.sprite.Sprite):
         self.remove(*self.groups())
         del self
 
+    def get_state(self):
+        return dict()
+
+    def set_state(self, state, game):
+        self.__init__(*self.rect.topleft)
+
 
 class BrickWall(Block):
+    material = 'brick'
+
     def __init__(self, x, y):
         super().__init__(x, y)
         self.image = load_image('brick_wall', (CELL_SIZE, CELL_SIZE))
-        self.mask = pygame.mask.from_surface(self.image)
+        self.mask = get_mask(self.image)
         self.start_exp_flag = False
+        # Уцелевшие четверти клетки: (строка, столбец)
+        self.quarters = {(0, 0), (0, 1), (1, 0), (1, 1)}
 
     def is_under_fire(self, bullet):
-        self.terminate()
+        # Снаряд сносит ближайший к нему ряд оставшихся четвертей
+        if bullet.velocity_y:
+            axis, nearest = 0, max if bullet.velocity_y < 0 else min
+        else:
+            axis, nearest = 1, max if bullet.velocity_x < 0 else min
+        line = nearest(quarter[axis] for quarter in self.quarters)
+        hit = {quarter for quarter in self.quarters if quarter[axis] == line}
+        if hit == self.quarters:
+            self.terminate()
+            return
+        groups = self.groups()
+        # Переиндексация в группах обновляет маски местности
+        self.remove(*groups)
+        self.quarters -= hit
+        self.draw_quarters()
+        self.add(*groups)
+
+    def draw_quarters(self):
+        full_image = load_image('brick_wall', (CELL_SIZE, CELL_SIZE))
+        self.image = pygame.Surface((CELL_SIZE, CELL_SIZE), pygame.SRCALPHA)
+        for row, column in self.quarters:
+            area = pygame.Rect(column * (CELL_SIZE // 2), row * (CELL_SIZE // 2),
+                               CELL_SIZE - CELL_SIZE // 2 if column else CELL_SIZE // 2,
+                               CELL_SIZE - CELL_SIZE // 2 if row else CELL_SIZE // 2)
+            self.image.blit(full_image, area, area)
+        self.mask = pygame.mask.from_surface(self.image)
+
+    def get_state(self):
+        return {'quarters': self.quarters}
+
+    def set_state(self, state, game):
+        super().set_state(state, game)
+        self.quarters = {tuple(quarter) for quarter in state['quarters']}
+        if len(self.quarters) < 4:
+            self.draw_quarters()
 
 
 class StrongBrickWall(Block):
+    material = 'concrete'
+
     def __init__(self, x, y):
         super().__init__(x, y)
         self.image = load_image('strong_brick_wall', (CELL_SIZE, CELL_SIZE))
-        self.mask = pygame.mask.from_surface(self.image)
+        self.mask = get_mask(self.image)
 
     def is_under_fire(self, bullet):
         if isinstance(bullet.owner, Player) and bullet.owner.tier == 4:
@@ -1023,44 +2022,75 @@ class StrongBrickWall(Block):
 
 
 class WaterWall(Block):
+    material = 'water'
+
     def __init__(self, x, y):
         super().__init__(x, y)
-        self.animation = cycle((load_image('water_wall', (CELL_SIZE, CELL_SIZE)),
-                                load_image('water_wall_2', (CELL_SIZE, CELL_SIZE)),
-                                load_image('water_wall_3', (CELL_SIZE, CELL_SIZE))))
-        self.image = next(self.animation)
-        self.mask = pygame.mask.from_surface(self.image)
-        self.time = time.time()
+        self.animation = (load_image('water_wall', (CELL_SIZE, CELL_SIZE)),
+                          load_image('water_wall_2', (CELL_SIZE, CELL_SIZE)),
+                          load_image('water_wall_3', (CELL_SIZE, CELL_SIZE)))
+        self.phase = 0
+        self.image = self.animation[self.phase]
+        self.mask = get_mask(self.image)
+        self.animation_count = 0
+        self.animation_duration = FPS * 2 // 5
 
     def update(self, *args):
-        if (time.time() - self.time) > 0.4:
-            self.time = time.time()
-            self.image = next(self.animation)
+        self.animation_count += 1
+        if self.animation_count > self.animation_duration:
+            self.animation_count = 0
+            self.phase = (self.phase + 1) % len(self.animation)
+            self.image = self.animation[self.phase]
+            self.mask = get_mask(self.image)
+            for group in self.groups():
+                if isinstance(group, BlockGroup):
+                    group.refresh(self)
+
+    def get_state(self):
+        return {'phase': self.phase, 'animation_count': self.animation_count}
+
+    def set_state(self, state, game):
+        super().set_state(state, game)
+        self.phase = state['phase']
+        self.animation_count = state['animation_count']
+        self.image = self.animation[self.phase]
+        self.mask = get_mask(self.image)
 
 
 class IceWall(Block):
+    material = 'ice'
+
     def __init__(self, x, y):
         super().__init__(x, y)
         self.image = load_image('ice_wall', (CELL_SIZE, CELL_SIZE))
-        self.mask = pygame.mask.from_surface(self.image)
+        self.mask = get_mask(self.image)
 
 
 class GrassWall(Block):
+    material = 'grass'
+
     def __init__(self, x, y):
         super().__init__(x, y)
         self.image = load_image('grass_wall', (CELL_SIZE, CELL_SIZE), (0, 0, 0))
-        self.mask = pygame.mask.from_surface(self.image)
+        self.mask = get_mask(self.image)
 
 
 class Bullet(pygame.sprite.Sprite):
     def __init__(self, owner: Tank, *groups):
         super().__init__(*groups)
+        self.reset(owner)
+
+    def reset(self, owner: Tank):
+        # Спрайт из пула получает состояние нового снаряда
+        self.prev_pos = None
         if isinstance(owner, Player) and SOUND_ON:
             self.ex_sound = pygame.mixer.Sound('data/music/bullet_explosion.ogg')
             self.beyond_sound = pygame.mixer.Sound('data/music/bullet_beyond_field.ogg')
             pygame.mixer.Sound('data/music/shoot.ogg').play()
+        self.game = owner.game
         self.flag_move = 0
-        self.explosion_animation = iter([load_image('bullet_explosion_%d' % i, (50, 50), -1) for i in range(3)])
+        self.explosion_animation = tuple(load_image('bullet_explosion_%d' % i, (50, 50), -1) for i in range(3))
+        self.explosion_phase = 0
         self.start_terminate = False
         self.owner = owner
         self.rect = pygame.Rect(0, 0, 17, 17)
@@ -1077,169 +2107,341 @@ class Bullet(pygame.sprite.Sprite):
             self.rect.center = owner.rect.midtop
             self.velocity_x, self.velocity_y = 0, -self.owner.bullet_speed / FPS
 
-        self.image = load_image('bullet', (17, 17), (0, 0, 0))
-        if self.owner.facing == RIGHT:
-            self.image = pygame.transform.rotate(self.image, -90)
-        if self.owner.facing == LEFT:
-            self.image = pygame.transform.rotate(self.image, 90)
-        if self.owner.facing == DOWN:
-            self.image = pygame.transform.rotate(self.image, 180)
-        self.mask = pygame.mask.from_surface(self.image)
+        self.facing = owner.facing
+        frames = IMAGE_CACHE.get_frames(('bullet',), (17, 17), (0, 0, 0))
+        self.image = frames.images[self.facing][0]
+        self.mask = frames.masks[self.facing][0]
 
     def update(self, *args):
-        if not self.start_terminate:
-            self.rect.centerx += self.velocity_x
-            self.rect.centery += self.velocity_y
-        else:
+        if self.start_terminate:
             if self.flag_move == 0:
                 self.rect.centerx -= 15
                 self.rect.centery -= 15
                 self.flag_move = 1
-
-        if self.start_terminate:
-            next_image = next(self.explosion_animation, None)
-            if next_image is not None:
-                self.image = next_image
+            if self.explosion_phase < len(self.explosion_animation):
+                self.image = self.explosion_animation[self.explosion_phase]
+                self.explosion_phase += 1
             else:
-                self.remove(*self.groups())
-                del self
+                release(self)
+            return
+        # Путь за тик проходим шагами не больше половины клетки,
+        # чтобы быстрый снаряд не проскакивал сквозь стены и танки
+        start_x, start_y = self.rect.center
+        steps = max(1, math.ceil(max(abs(self.velocity_x), abs(self.velocity_y)) / BULLET_STEP))
+        for step in range(1, steps + 1):
+            self.rect.center = (start_x + round(self.velocity_x * step / steps),
+                                start_y + round(self.velocity_y * step / steps))
+            if self.check_collisions():
                 return
-        elif isinstance(self.owner, Player):
-            collided = get_collided_by_mask(self, game.enemies)
+            if self.start_terminate:
+                break
+
+        if self.rect.bottom < 0 or self.rect.top > PLAYGROUND_WIDTH:
+            if isinstance(self.owner, Player) and SOUND_ON:
+                self.beyond_sound.play()
+            self.terminate()
+        elif self.rect.right < 0 or self.rect.left > PLAYGROUND_WIDTH:
+            if isinstance(self.owner, Player) and SOUND_ON:
+                self.beyond_sound.play()
+            self.terminate()
+
+    def check_collisions(self):
+        """
+        Проверка попаданий в текущем положении снаряда.
+        Возвращает True, если снаряд попал в танк
+        """
+        if isinstance(self.owner, Player):
+            collided = get_collided_by_mask(self, self.game.enemies)
             if collided:
                 self.owner.score += collided[0].reward
                 collided[0].is_under_fire()
                 self.terminate()
-                return
-            collided = get_collided_by_mask(self, game.blocks)
-            if collided:
+                return True
+            if self.game.terrain.collides(self.mask, self.rect.topleft, ('brick', 'concrete')):
+                collided = get_collided_by_mask(self, self.game.blocks)
                 for sprite in collided:
                     sprite.is_under_fire(self)
                 if not all(map(lambda x: isinstance(x, WaterWall), collided)):
                     self.terminate()
         elif isinstance(self.owner, Enemy):
-            collided = get_collided_by_mask(self, game.players)
+            collided = get_collided_by_mask(self, self.game.players)
             if collided:
                 collided[0].is_under_fire()
                 self.terminate()
-                return
-            collided = get_collided_by_mask(self, game.blocks)
-            if collided:
+                return True
+            if self.game.terrain.collides(self.mask, self.rect.topleft, ('brick', 'concrete', 'water')):
+                collided = get_collided_by_mask(self, self.game.blocks)
                 for sprite in collided:
                     sprite.is_under_fire(self)
                 if not all(map(lambda x: isinstance(x, WaterWall), collided)):
                     self.terminate()
                 self.terminate()
-        if get_collided_by_mask(self, game.flag_group):
+        if get_collided_by_mask(self, self.game.flag_group):
             if SOUND_ON:
                 pygame.mixer.Sound('data/music/base_explosion.ogg').play()
             self.terminate()
-            game.game_over = True
-            game.save_config()
-        collided = get_collided_by_mask(self, game.bullets)
+            self.game.game_over = True
+            self.game.save_config()
+        collided = get_collided_by_mask(self, self.game.bullets)
         if collided:
             for sprite in collided:
                 sprite.terminate()
             self.terminate()
-
-        if self.rect.bottom < 0 or self.rect.top > PLAYGROUND_WIDTH:
-            if isinstance(self.owner, Player) and SOUND_ON:
-                self.beyond_sound.play()
-            self.terminate()
-        elif self.rect.right < 0 or self.rect.left > PLAYGROUND_WIDTH:
-            if isinstance(self.owner, Player) and SOUND_ON:
-                self.beyond_sound.play()
-            self.terminate()
+        return False
 
     def terminate(self):
         if isinstance(self.owner, Player) and SOUND_ON:
             self.ex_sound.play()
         self.start_terminate = True
 
+    def get_state(self):
+        return {'owner': self.owner, 'facing': self.facing, 'velocity_x': self.velocity_x,
+                'velocity_y': self.velocity_y, 'flag_move': self.flag_move,
+                'start_terminate': self.start_terminate, 'explosion_phase': self.explosion_phase}
+
+    def set_state(self, state, game):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.game = game
+        if isinstance(self.owner, Player) and SOUND_ON:
+            self.ex_sound = pygame.mixer.Sound('data/music/bullet_explosion.ogg')
+            self.beyond_sound = pygame.mixer.Sound('data/music/bullet_beyond_field.ogg')
+        self.explosion_animation = tuple(load_image('bullet_explosion_%d' % i, (50, 50), -1) for i in range(3))
+        frames = IMAGE_CACHE.get_frames(('bullet',), (17, 17), (0, 0, 0))
+        self.image = frames.images[self.facing][0]
+        self.mask = frames.masks[self.facing][0]
+        if self.explosion_phase:
+            self.image = self.explosion_animation[self.explosion_phase - 1]
+
 
 class TankExplosion(pygame.sprite.Sprite):
     def __init__(self, tank):
         super().__init__()
+        self.reset(tank)
+
+    def reset(self, tank):
         if SOUND_ON:
             pygame.mixer.Sound('data/music/tank_explosion.ogg').play()
-        self.animation = iter(
-            [load_image('tank_explosion_0', (CELL_SIZE * 3, CELL_SIZE * 3), -1) for _ in range(4)] +
-            [load_image('tank_explosion_1', (CELL_SIZE * 3, CELL_SIZE * 3), (0, 10)) for _ in range(4)])
-        self.image = next(self.animation)
+        self.game = tank.game
+        self.animation = self.load_animation()
+        self.phase = 0
+        self.image = self.animation[self.phase]
         self.rect = self.image.get_rect()
         self.rect.x = tank.rect.x - CELL_SIZE // 2
         self.rect.y = tank.rect.y - CELL_SIZE // 2
 
+    def load_animation(self):
+        return tuple([load_image('tank_explosion_0', (CELL_SIZE * 3, CELL_SIZE * 3), -1) for _ in range(4)] +
+                     [load_image('tank_explosion_1', (CELL_SIZE * 3, CELL_SIZE * 3), (0, 10)) for _ in range(4)])
+
     def update(self, *args):
-        self.image = next(self.animation, None)
-        if not self.image:
-            game.explosions.remove(self)
-            del self
+        self.phase += 1
+        if self.phase >= len(self.animation):
+            release(self)
+            return
+        self.image = self.animation[self.phase]
+
+    def get_state(self):
+        return {'phase': self.phase}
+
+    def set_state(self, state, game):
+        self.game = game
+        self.phase = state['phase']
+        self.animation = self.load_animation()
+        self.image = self.animation[self.phase]
+
+
+class ShieldGroup(pygame.sprite.Group):
+    """
+    Щиты с индексом по танкам: щит танка находится без обхода всей группы
+    """
+    def __init__(self, *sprites):
+        self.tanks = dict()
+        super().__init__(*sprites)
+
+    def add_internal(self, sprite, layer=None):
+        super().add_internal(sprite, layer)
+        self.tanks.setdefault(sprite.tank, sprite)
+
+    def remove_internal(self, sprite):
+        super().remove_internal(sprite)
+        if self.tanks.get(sprite.tank) is sprite:
+            del self.tanks[sprite.tank]
+
+    def get(self, tank):
+        return self.tanks.get(tank)
 
 
 class Shield(pygame.sprite.Sprite):
     def __init__(self, tank):
         super().__init__()
+        self.reset(tank)
+
+    def reset(self, tank):
+        self.prev_pos = None
         self.tank = tank
-        self.animation = cycle((load_image('shield', (tank.cell_size + 10, tank.cell_size + 10), -1),
-                                load_image('shield_2', (tank.cell_size + 10, tank.cell_size + 10), -1)))
-        self.image = next(self.animation)
+        self.animation = self.load_animation()
+        self.phase = 0
+        self.image = self.animation[self.phase]
         self.rect = self.tank.image.get_rect()
         self.rect.x = self.tank.rect.x - 5
         self.rect.y = self.tank.rect.y - 5
-        self.animation_time = time.time()
+        self.animation_count = 0
+        self.animation_duration = FPS * 3 // 20
 
     def update(self, *args):
         self.rect.x = self.tank.rect.x - 5
         self.rect.y = self.tank.rect.y - 5
-        if time.time() - self.animation_time > 0.15:
-            self.animation_time = time.time()
-            self.image = next(self.animation)
+        self.animation_count += 1
+        if self.animation_count > self.animation_duration:
+            self.animation_count = 0
+            self.phase = (self.phase + 1) % len(self.animation)
+            self.image = self.animation[self.phase]
+
+    def load_animation(self):
+        size = (self.tank.cell_size + 10, self.tank.cell_size + 10)
+        return load_image('shield', size, -1), load_image('shield_2', size, -1)
+
+    def get_state(self):
+        return {'tank': self.tank, 'phase': self.phase, 'animation_count': self.animation_count,
+                'animation_duration': self.animation_duration}
+
+    def set_state(self, state, game):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self.animation = self.load_animation()
+        self.image = self.animation[self.phase]
 
 
 class Bonus(pygame.sprite.Sprite):
-    def __init__(self, image, x, y):
+    image_name = None
+
+    def __init__(self, x, y):
         super().__init__()
-        self.image = image
+        self.reset(x, y)
+
+    def reset(self, x, y):
+        self.image = load_image(self.image_name, (CELL_SIZE * 2, CELL_SIZE * 2), -1)
         self.rect = self.image.get_rect()
         self.rect.x = x
         self.rect.y = y
-        self.mask = pygame.mask.from_surface(self.image)
+        self.mask = get_mask(self.image)
         if SOUND_ON:
             pygame.mixer.Sound('data/music/bonus_appears.wav').play()
 
     def terminate(self):
-        del self
+        release(self)
+
+    def get_state(self):
+        return dict()
+
+    def set_state(self, state, game):
+        self.__init__(*self.rect.topleft)
 
 
 class BonusStar(Bonus):
-    def __init__(self, x, y):
-        super().__init__(load_image('bonus_star', (CELL_SIZE * 2, CELL_SIZE * 2), -1), x, y)
+    image_name = 'bonus_star'
 
 
 class BonusGrenade(Bonus):
-    def __init__(self, x, y):
-        super().__init__(load_image('bonus_grenade', (CELL_SIZE * 2, CELL_SIZE * 2), -1), x, y)
+    image_name = 'bonus_grenade'
 
 
 class BonusHelmet(Bonus):
-    def __init__(self, x, y):
-        super().__init__(load_image('bonus_helmet', (CELL_SIZE * 2, CELL_SIZE * 2), -1), x, y)
+    image_name = 'bonus_helmet'
 
 
 class BonusShovel(Bonus):
-    def __init__(self, x, y):
-        super().__init__(load_image('bonus_shovel', (CELL_SIZE * 2, CELL_SIZE * 2), -1), x, y)
+    image_name = 'bonus_shovel'
 
 
 class BonusClock(Bonus):
-    def __init__(self, x, y):
-        super().__init__(load_image('bonus_clock', (CELL_SIZE * 2, CELL_SIZE * 2), -1), x, y)
+    image_name = 'bonus_clock'
 
 
 class BonusTank(Bonus):
-    def __init__(self, x, y):
-        super().__init__(load_image('bonus_tank', (CELL_SIZE * 2, CELL_SIZE * 2), -1), x, y)
+    image_name = 'bonus_tank'
+
+
+# Классы спрайтов, которые могут встретиться в снимке состояния игры
+SPRITE_TYPES = {sprite_type.__name__: sprite_type for sprite_type in (
+    Player, SimpleEnemy, QuickTank, QuickFireTank, StrongTank, BrickWall, StrongBrickWall, WaterWall, IceWall,
+    GrassWall, Bullet, TankExplosion, Shield, BonusStar, BonusGrenade, BonusHelmet, BonusShovel, BonusClock,
+    BonusTank)}
+
+
+class SpritePool:
+    """
+    Пул спрайтов одного типа. acquire отдает освобожденный спрайт, заново настроенный
+    через reset, или создает новый; release убирает спрайт из всех групп и оставляет
+    его для следующего acquire. Без пула каждый выстрел и взрыв в перестрелке
+    создавал новые объекты, и сборка мусора давала рывки кадров
+    """
+    def __init__(self, sprite_type, size=POOL_SIZE):
+        self.sprite_type = sprite_type
+        self.size = size
+        self.free = []
+        self.created = 0
+        self.reused = 0
+        self.dropped = 0
+
+    def acquire(self, *args):
+        if self.free:
+            sprite = self.free.pop()
+            sprite.reset(*args)
+            self.reused += 1
+        else:
+            sprite = self.sprite_type(*args)
+            self.created += 1
+        sprite.pooled = False
+        return sprite
+
+    def release(self, sprite):
+        sprite.kill()
+        if getattr(sprite, 'pooled', False):
+            return
+        sprite.pooled = True
+        # Спрайт в пуле не должен держать в памяти погибшие танки и старые игры
+        for name in ('game', 'owner', 'tank'):
+            if hasattr(sprite, name):
+                setattr(sprite, name, None)
+        if len(self.free) < self.size:
+            self.free.append(sprite)
+        else:
+            self.dropped += 1
+
+    def clear(self):
+        self.free.clear()
+
+    def stats(self):
+        return {'created': self.created, 'reused': self.reused, 'free': len(self.free), 'dropped': self.dropped}
+
+
+# Пулы переиспользуемых спрайтов по типам
+SPRITE_POOLS = {sprite_type: SpritePool(sprite_type) for sprite_type in (
+    Bullet, TankExplosion, Shield, BonusStar, BonusGrenade, BonusHelmet, BonusShovel, BonusClock, BonusTank)}
+
+
+def acquire(sprite_type, *args):
+    return SPRITE_POOLS[sprite_type].acquire(*args)
+
+
+def release(sprite):
+    SPRITE_POOLS[type(sprite)].release(sprite)
+
+
+def release_all(group):
+    """
+    Очищает группу, возвращая спрайты из пулов обратно в пулы
+    """
+    for sprite in group.sprites():
+        if type(sprite) in SPRITE_POOLS:
+            release(sprite)
+    group.empty()
+
+
+def get_pool_stats():
+    return {sprite_type.__name__: pool.stats() for sprite_type, pool in SPRITE_POOLS.items()}
 
 
 class Menu:
@@ -1248,27 +2450,39 @@ class Menu:
         self.width, self.height = WINDOW_SIZE
         pygame.font.init()
         if self.parent.fullscreen_mode:
-            self.screen = pygame.display.set_mode(self.get_size(), pygame.FULLSCREEN)
+            self.screen = set_display_mode(self.get_size(), pygame.FULLSCREEN)
         else:
-            self.screen = pygame.display.set_mode(WINDOW_SIZE)
+            self.screen = set_display_mode(WINDOW_SIZE)
         self.font = pygame.font.SysFont(None, 40)
+        self.big_font = pygame.font.SysFont(None, 50)
+        self.labels = dict()
         self.buttons = {'Новая игра': {'font': self.font, 'selected': False, 'pos': None},
                         'Продолжить': {'font': self.font, 'selected': False, 'pos': None},
                         'Конструктор': {'font': self.font, 'selected': False, 'pos': None},
                         'Выход': {'font': self.font, 'selected': False, 'pos': None}}
         self.players_button_selected = False
-        text = self.players_button_rect = pygame.font.SysFont(None, 50).render('Один игрок', 1, (255, 255, 255))
+        text = self.get_label('Один игрок', True)
         self.players_button_rect = text.get_rect().move(self.width - text.get_width(), self.height - text.get_height())
         self.logo = load_image('logo', color_key=(0, 0, 0))
         self.copyright = load_image('copyright', color_key=(0, 0, 0))
         self.running = True
+        self.redraw = True
         self.main_loop()
 
     def main_loop(self):
         while self.running:
-            self.render()
+            if self.redraw:
+                self.render()
+                self.redraw = False
             self.check_events()
 
+    def get_label(self, text, selected=False):
+        label = self.labels.get((text, selected))
+        if label is None:
+            label = (self.big_font if selected else self.font).render(text, 1, (255, 255, 255))
+            self.labels[(text, selected)] = label
+        return label
+
     def render(self):
         self.screen.fill((0, 0, 0))
         self.screen.blit(self.logo, (self.width // 2 - self.logo.get_width() // 2, 30))
@@ -1278,20 +2492,16 @@ class Menu:
         for n, (key, value) in enumerate(self.buttons.items()):
             text_x = self.width // 2 - 77
             text_y = self.height // 2 - 100 + n * 50
-            button = value['font'].render(key, 1, (255, 255, 255))
+            button = self.get_label(key)
             if value['selected']:
                 default_width, default_height = button.get_width(), button.get_height()
-                button = pygame.font.SysFont(None, 50).render(key, 1, (255, 255, 255))
+                button = self.get_label(key, True)
                 text_x = self.width // 2 - 77 - (button.get_width() - default_width) // 2
                 text_y = self.height // 2 - 100 + n * 50 - (button.get_height() - default_height) // 2
             self.buttons[key]['pos'] = (text_x, text_y, text_x + button.get_width(), text_y + button.get_height())
             self.screen.blit(button, (text_x, text_y))
 
-        if self.players_button_selected:
-            text = pygame.font.SysFont(None, 50).render('Два игрока' if TWO_PLAYERS else 'Один игрок',
-                                                        1, (255, 255, 255))
-        else:
-            text = self.font.render('Два игрока' if TWO_PLAYERS else 'Один игрок', 1, (255, 255, 255))
+        text = self.get_label('Два игрока' if TWO_PLAYERS else 'Один игрок', self.players_button_selected)
         x, y = self.width - text.get_width(), self.height - text.get_height()
         self.screen.blit(text, (x, y))
         # ^ Конец рендера кнопок
@@ -1299,7 +2509,9 @@ class Menu:
 
     def check_events(self):
         global EXIT_TO_MENU, TWO_PLAYERS
-        for event in pygame.event.get():
+        for event in wait_events():
+            if event.type != pygame.MOUSEMOTION:
+                self.redraw = True
             if event.type == pygame.QUIT:
                 self.running = False
                 self.parent.run = False
@@ -1309,22 +2521,25 @@ class Menu:
                 if event.key == pygame.K_F11:
                     if self.parent.fullscreen_mode:
                         self.width, self.height = WINDOW_SIZE
-                        pygame.display.set_mode(self.get_size())
+                        set_display_mode(self.get_size())
                     else:
                         self.width, self.height = self.get_resolution()
-                        pygame.display.set_mode(self.get_size(), pygame.FULLSCREEN)
+                        set_display_mode(self.get_size(), pygame.FULLSCREEN)
                     self.parent.fullscreen_mode = not self.parent.fullscreen_mode
             elif event.type == pygame.MOUSEMOTION:
                 mouse_x, mouse_y = event.pos
                 # Проверка на наведение мышки на кнопку
                 for key, value in self.buttons.items():
                     button_x, button_y, button_width, button_height = value['pos']
-                    if mouse_x in range(button_x, button_width + 1) and \
-                            mouse_y in range(button_y, button_height + 1):
-                        self.buttons[key]['selected'] = True
-                    else:
-                        self.buttons[key]['selected'] = False
-                self.players_button_selected = self.players_button_rect.collidepoint((mouse_x, mouse_y))
+                    selected = mouse_x in range(button_x, button_width + 1) and \
+                        mouse_y in range(button_y, button_height + 1)
+                    if self.buttons[key]['selected'] != selected:
+                        self.buttons[key]['selected'] = selected
+                        self.redraw = True
+                players_button_selected = bool(self.players_button_rect.collidepoint((mouse_x, mouse_y)))
+                if self.players_button_selected != players_button_selected:
+                    self.players_button_selected = players_button_selected
+                    self.redraw = True
             elif event.type == pygame.MOUSEBUTTONUP:
                 if self.players_button_selected:
                     TWO_PLAYERS = not TWO_PLAYERS
@@ -1353,39 +2568,140 @@ class Menu:
         return ctypes.windll.user32.GetSystemMetrics(0), ctypes.windll.user32.GetSystemMetrics(1)
 
 
+class ThumbnailCache:
+    """
+    Миниатюры уровней для меню выбора. Хранятся на диске под хэшем содержимого
+    файла уровня, поэтому измененный уровень получает новую миниатюру.
+    Недостающие миниатюры рисуются в фоновом потоке
+    """
+    directory = 'data/cache/thumbnails'
+
+    def __init__(self, textures: dict):
+        self.textures = textures
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        self.worker = threading.Thread(target=self.work, daemon=True)
+        self.worker.start()
+
+    def get_path(self, filename):
+        with open(filename, 'rb') as file:
+            key = hashlib.sha1(file.read()).hexdigest()
+        return os.path.join(self.directory, key + '.png')
+
+    def load(self, filename):
+        """
+        Возвращает миниатюру с диска или ставит ее в очередь на отрисовку
+        """
+        path = self.get_path(filename)
+        if os.path.exists(path):
+            try:
+                image = pygame.image.load(path)
+            except pygame.error:
+                pass
+            else:
+                # Как в ImageCache.load: без окна переводить поверхность не во что
+                return image.convert() if pygame.display.get_surface() is not None else image
+        self.jobs.put(filename)
+        return None
+
+    def poll(self):
+        ready = []
+        while not self.results.empty():
+            ready.append(self.results.get())
+        return ready
+
+    def close(self):
+        # Уровни, пролистанные в меню, рисовать уже не нужно: поток не должен мешать игре
+        while True:
+            try:
+                self.jobs.get_nowait()
+            except queue.Empty:
+                break
+        self.jobs.put(None)
+
+    def work(self):
+        while True:
+            filename = self.jobs.get()
+            if filename is None:
+                return
+            # Ошибка в одном файле уровня не должна останавливать поток: такой уровень
+            # отдается с миниатюрой None и остается с заглушкой
+            try:
+                image = self.render(filename)
+                path = self.get_path(filename)
+                os.makedirs(self.directory, exist_ok=True)
+                # Пишем во временный файл, чтобы не оставить на диске недописанную картинку
+                pygame.image.save(image, path + '.tmp.png')
+                os.replace(path + '.tmp.png', path)
+            except Exception:
+                image = None
+            self.results.put((filename, image))
+            pygame.event.post(pygame.event.Event(THUMBNAIL_READY))
+
+    def render(self, filename):
+        image = pygame.Surface((PLAYGROUND_WIDTH, PLAYGROUND_WIDTH))
+        _map, enemies = read_map(filename)
+        for i in range(len(_map)):
+            for j in range(len(_map[i])):
+                if _map[i][j] in self.textures:
+                    image.blit(self.textures[_map[i][j]], (j * CELL_SIZE, i * CELL_SIZE))
+        return pygame.transform.scale(image, (240, 240))
+
+
 class LevelMenu:
     def __init__(self, menu: Menu):
         self.menu = menu
         self.width, self.height = WINDOW_SIZE
         pygame.font.init()
         if self.menu.parent.fullscreen_mode:
-            self.screen = pygame.display.set_mode(self.menu.get_size(), pygame.FULLSCREEN)
+            self.screen = set_display_mode(self.menu.get_size(), pygame.FULLSCREEN)
         else:
-            self.screen = pygame.display.set_mode(WINDOW_SIZE)
-        self.shortcuts = ShortcutGroup()
+            self.screen = set_display_mode(WINDOW_SIZE)
+        parent = self.menu.parent
+        self.thumbnails = ThumbnailCache({1: parent.brick_wall_texture, 2: parent.concrete_wall_texture,
+                                          3: parent.water_texture, 4: parent.ice_texture, 5: parent.grass_texture})
+        levels = []
         if os.path.exists('data/levels'):
             maps_list = sorted(filter(lambda x: x[6].isdigit(), os.listdir('data/levels')), key=lambda x: int(x[6:-4]))
             for item in maps_list:
                 num = item[6:-4]
                 if item[:6] == 'level_' and num.isdigit() and item[-4:] == '.txt':
-                    self.load_shortcut(f'data/levels/{item}')
+                    levels.append(f'data/levels/{item}')
+        self.tape_size = (752, self.height - self.menu.logo.get_height() - 46)
+        self.shortcuts = ShortcutGroup(levels, self.thumbnails, self.tape_size[1])
+        self.shortcuts.load_visible()
         self.run = True
+        self.redraw = True
+        self.clock = pygame.time.Clock()
         self.main_loop()
+        self.thumbnails.close()
 
     def main_loop(self):
         while self.run:
             self.check_controls()
-            self.shortcuts.update()
-            self.render()
+            if self.redraw:
+                self.render()
+                self.redraw = False
 
     def check_controls(self):
-        for event in pygame.event.get():
+        # Пока зажата стрелка, лента прокручивается с ограниченной частотой,
+        # иначе ждем следующего события
+        scrolling = pygame.key.get_pressed()[pygame.K_UP] or pygame.key.get_pressed()[pygame.K_DOWN]
+        if scrolling:
+            self.clock.tick(MENU_FPS)
+            events = pygame.event.get()
+        else:
+            events = wait_events()
+        for event in events:
+            if event.type != pygame.MOUSEMOTION:
+                self.redraw = True
             if event.type == pygame.QUIT:
                 self.run = False
                 self.menu.running = False
                 self.menu.parent.run = False
             elif event.type == pygame.MOUSEMOTION:
-                self.shortcuts.check_mouse_move(self.to_tape_coords(event.pos))
+                if self.shortcuts.check_mouse_move(self.to_tape_coords(event.pos)):
+                    self.redraw = True
             elif event.type == pygame.MOUSEBUTTONDOWN:
                 if event.button == 1:
                     self.menu.parent.level = self.shortcuts.check_click(self.to_tape_coords(event.pos))
@@ -1393,20 +2709,26 @@ class LevelMenu:
                         self.run = False
                         self.menu.running = False
                 elif event.button == 4:
-                    self.shortcuts.move_down(50, self.height - self.menu.logo.get_height() - 46)
+                    self.shortcuts.move_down(50)
                 elif event.button == 5:
-                    self.shortcuts.move_down(-50, self.height - self.menu.logo.get_height() - 46)
+                    self.shortcuts.move_down(-50)
             elif event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE:
                 self.run = False
+            elif event.type == THUMBNAIL_READY:
+                self.shortcuts.poll()
         if pygame.key.get_pressed()[pygame.K_UP]:
-            self.shortcuts.move_down(10, self.height - self.menu.logo.get_height() - 46)
+            self.shortcuts.move_down(10)
+            self.redraw = True
         elif pygame.key.get_pressed()[pygame.K_DOWN]:
-            self.shortcuts.move_down(-10, self.height - self.menu.logo.get_height() - 46)
+            self.shortcuts.move_down(-10)
+            self.redraw = True
+        if self.redraw:
+            self.shortcuts.load_visible()
 
     def render(self):
         self.screen.fill((0, 0, 0))
         self.screen.blit(self.menu.logo, (self.width // 2 - self.menu.logo.get_width() // 2, 30))
-        canvas_tape = pygame.Surface((752, self.height - self.menu.logo.get_height() - 46))
+        canvas_tape = pygame.Surface(self.tape_size)
         self.shortcuts.draw(canvas_tape)
         self.screen.blit(canvas_tape, (self.width // 2 - canvas_tape.get_width() // 2,
                                        self.menu.logo.get_height() + 46))
@@ -1418,77 +2740,104 @@ class LevelMenu:
     def to_tape_coords(self, coords: tuple):
         return coords[0] - (self.width // 2 - 376), coords[1] - (self.menu.logo.get_height() + 46)
 
-    def load_shortcut(self, filename):
-        image = pygame.Surface((PLAYGROUND_WIDTH, PLAYGROUND_WIDTH))
-        _map, enemies = read_map(filename)
-        for i in range(len(_map)):
-            for j in range(len(_map[i])):
-                if _map[i][j] == 1:
-                    image.blit(self.menu.parent.brick_wall_texture, (j * CELL_SIZE, i * CELL_SIZE))
-                elif _map[i][j] == 2:
-                    image.blit(self.menu.parent.concrete_wall_texture, (j * CELL_SIZE, i * CELL_SIZE))
-                elif _map[i][j] == 3:
-                    image.blit(self.menu.parent.water_texture, (j * CELL_SIZE, i * CELL_SIZE))
-                elif _map[i][j] == 4:
-                    image.blit(self.menu.parent.ice_texture, (j * CELL_SIZE, i * CELL_SIZE))
-                elif _map[i][j] == 5:
-                    image.blit(self.menu.parent.grass_texture, (j * CELL_SIZE, i * CELL_SIZE))
-        Shortcut(pygame.transform.scale(image, (240, 240)), filename, self.shortcuts)
-
-
-class Shortcut(pygame.sprite.Sprite):
-    def __init__(self, image: pygame.SurfaceType, level, *groups):
-        super().__init__(*groups)
-        self.image = image
-        self.rect = pygame.Rect(self.image.get_rect())
-        self.shift = 0
-        self.rect.x += ((len(self.groups()[0]) - 1) % 3) * (self.rect.width + self.rect.width // 15)
-        self.rect.y += ((len(self.groups()[0]) - 1) // 3) * (self.rect.width + self.rect.width // 15)
-        pygame.draw.rect(self.image, (255, 255, 255), (0, 0, self.rect.width, self.rect.height), 5)
-        self.level = level
-        self.highlighted = False
-
-    def update(self):
-        if self.highlighted:
-            pygame.draw.rect(self.image, (255, 0, 0), (0, 0, self.rect.width, self.rect.height), 5)
-        else:
-            pygame.draw.rect(self.image, (255, 255, 255), (0, 0, self.rect.width, self.rect.height), 5)
-
-    def check_mouse_move(self, point: tuple):
-        self.highlighted = self.rect.collidepoint(point) and 0 <= point[1]
-
-    def check_click(self, point: tuple):
-        return self.rect.collidepoint(point)
-
 
-class ShortcutGroup(pygame.sprite.Group):
-    def __init__(self, *sprites: Shortcut):
-        super().__init__(*sprites)
+class ShortcutGroup:
+    """
+    Виртуальная сетка миниатюр уровней. Позиции ячеек вычисляются из смещения
+    прокрутки, а в памяти держится ограниченное число последних миниатюр
+    """
+    size = 240
+    step = size + size // 15
+    columns = 3
+
+    def __init__(self, levels: list, thumbnails: ThumbnailCache, height: int):
+        self.levels = levels
+        self.thumbnails = thumbnails
+        self.height = height
+        self.offset = 0
+        self.highlighted = None
+        self.images = OrderedDict()
+        self.pending = set()
+        self.placeholder = pygame.Surface((self.size, self.size))
+        self.placeholder.fill((32, 32, 32))
+
+    def get_rows(self):
+        return (len(self.levels) + self.columns - 1) // self.columns
+
+    def get_rect(self, index: int):
+        row, column = divmod(index, self.columns)
+        return pygame.Rect(column * self.step, row * self.step + self.offset, self.size, self.size)
+
+    def get_visible(self):
+        if not self.levels:
+            return range(0)
+        first = -self.offset // self.step
+        last = min((self.height - 1 - self.offset) // self.step, self.get_rows() - 1)
+        return range(first * self.columns, min((last + 1) * self.columns, len(self.levels)))
+
+    def get_index(self, point: tuple):
+        x, y = point
+        if not (0 <= x < self.columns * self.step and 0 <= y < self.height):
+            return None
+        row, row_shift = divmod(y - self.offset, self.step)
+        column, column_shift = divmod(x, self.step)
+        if row_shift >= self.size or column_shift >= self.size:
+            return None
+        index = row * self.columns + column
+        return index if index < len(self.levels) else None
+
+    def set_thumbnail(self, level, image):
+        # image None - миниатюру не удалось нарисовать, повторно она не запрашивается
+        self.images[level] = image
+        self.images.move_to_end(level)
+        while len(self.images) > THUMBNAIL_LRU_SIZE:
+            self.images.popitem(last=False)
+
+    def load_visible(self):
+        # Миниатюры подгружаются только для видимой части ленты
+        for index in self.get_visible():
+            level = self.levels[index]
+            if level in self.images or level in self.pending:
+                continue
+            image = self.thumbnails.load(level)
+            if image is None:
+                self.pending.add(level)
+            else:
+                self.set_thumbnail(level, image)
+
+    def poll(self):
+        for level, image in self.thumbnails.poll():
+            self.pending.discard(level)
+            self.set_thumbnail(level, image)
+
+    def draw(self, surface: pygame.SurfaceType):
+        for index in self.get_visible():
+            level = self.levels[index]
+            rect = self.get_rect(index)
+            image = self.images.get(level)
+            if image is None:
+                image = self.placeholder
+            else:
+                self.images.move_to_end(level)
+            surface.blit(image, rect)
+            color = (255, 0, 0) if index == self.highlighted else (255, 255, 255)
+            pygame.draw.rect(surface, color, rect, 5)
 
     def check_mouse_move(self, point: tuple):
-        for sprite in self.sprites():
-            sprite.check_mouse_move(point)
+        index = self.get_index(point)
+        changed = index != self.highlighted
+        self.highlighted = index
+        return changed
 
     def check_click(self, point: tuple):
-        chosen_level = None
-        for sprite in self.sprites():
-            if sprite.check_click(point):
-                sprite.highlighted = True
-                chosen_level = sprite.level
-            else:
-                sprite.highlighted = False
-        return chosen_level
+        self.highlighted = self.get_index(point)
+        if self.highlighted is None:
+            return None
+        return self.levels[self.highlighted]
 
-    def move_down(self, step: int, bottom_edge: int):
-        rect = self.sprites()[0].rect.move(0, step)
-        if rect.top > 0:
-            step = -self.sprites()[0].rect.top
-        else:
-            rect = self.sprites()[-1].rect.move(0, step)
-            if rect.bottom < bottom_edge:
-                step = bottom_edge - rect.bottom
-        for sprite in self.sprites():
-            sprite.rect.y += step
+    def move_down(self, step: int):
+        bottom = (self.get_rows() - 1) * self.step + self.size
+        self.offset = min(0, max(self.offset + step, self.height - bottom))
 
 
 class Constructor:
@@ -1497,9 +2846,9 @@ class Constructor:
         self.width, self.height = WINDOW_SIZE
         pygame.font.init()
         if self.menu.parent.fullscreen_mode:
-            self.screen = pygame.display.set_mode(self.menu.get_size(), pygame.FULLSCREEN)
+            self.screen = set_display_mode(self.menu.get_size(), pygame.FULLSCREEN)
         else:
-            self.screen = pygame.display.set_mode(WINDOW_SIZE)
+            self.screen = set_display_mode(WINDOW_SIZE)
         self.spawn_pos = ((0, 0), (0, 1), (1, 0), (1, 1),
                           (12, 0), (12, 1), (13, 0), (13, 1),
                           (24, 0), (24, 1), (25, 0), (25, 1))
@@ -1516,16 +2865,20 @@ class Constructor:
         self.curr_y = 0
         self.map = [[None for _ in range(26)] for __ in range(26)]
         self.load_level()
+        self.canvas = pygame.Surface((PLAYGROUND_WIDTH, PLAYGROUND_WIDTH))
         self.running = True
+        self.redraw = True
         self.main_loop()
 
     def main_loop(self):
         while self.running:
             self.check_events()
-            self.render()
+            if self.redraw:
+                self.render()
+                self.redraw = False
 
     def render(self):
-        canvas = pygame.Surface((PLAYGROUND_WIDTH, PLAYGROUND_WIDTH))
+        canvas = self.canvas
         canvas.fill((0, 0, 0))
         self.blocks.draw(canvas)
         canvas.blit(self.flag_image, (PLAYGROUND_WIDTH // 2 - CELL_SIZE + 5, PLAYGROUND_WIDTH - CELL_SIZE * 2 + 5))
@@ -1539,7 +2892,8 @@ class Constructor:
         pygame.display.flip()
 
     def check_events(self):
-        for event in pygame.event.get():
+        events = wait_events()
+        for event in events:
             if event.type == pygame.QUIT:
                 self.running = False
             elif event.type == pygame.KEYDOWN:
@@ -1555,7 +2909,9 @@ class Constructor:
                     self.running = False
                 elif event.key == pygame.K_s:
                     self.save()
-        self.check_controls()
+        if events:
+            self.check_controls()
+            self.redraw = True
 
     def check_controls(self):
         if pygame.key.get_pressed()[pygame.K_1]:
@@ -1638,7 +2994,11 @@ class Constructor:
 def get_collided_by_mask(sprite_1: pygame.sprite.Sprite, *groups):
     collided = []
     for group in groups:
-        for sprite_2 in group.sprites():
+        if isinstance(group, (BlockGroup, SpatialHashGroup)):
+            candidates = group.query(sprite_1.rect)
+        else:
+            candidates = group.sprites()
+        for sprite_2 in candidates:
             if pygame.sprite.collide_mask(sprite_1, sprite_2) and sprite_1 is not sprite_2:
                 collided.append(sprite_2)
     return collided
@@ -1647,29 +3007,119 @@ def get_collided_by_mask(sprite_1: pygame.sprite.Sprite, *groups):
 def get_collided_by_rect(sprite, *groups: pygame.sprite.Group):
     collided = []
     for group in groups:
-        collided.extend(pygame.sprite.spritecollide(sprite, group, False))
+        if isinstance(group, BlockGroup):
+            collided.extend(group.query(sprite.rect))
+        elif isinstance(group, SpatialHashGroup):
+            found = group.query(sprite.rect)
+            # Сам спрайт может числиться в хэше по положению до перемещения
+            if group.has(sprite) and sprite not in found:
+                found.append(sprite)
+            collided.extend(found)
+        else:
+            collided.extend(pygame.sprite.spritecollide(sprite, group, False))
     return collided
 
 
+def wait_events(timeout=MENU_IDLE_TIMEOUT):
+    # Блокируемся до первого события, остальные забираем из очереди разом
+    event = pygame.event.wait(timeout)
+    if event.type == pygame.NOEVENT:
+        return []
+    return [event] + pygame.event.get()
+
+
+def get_drawn_rect(sprite, alpha=1.0):
+    """
+    Прямоугольник картинки спрайта на кадре. Положение интерполируется
+    от prev_pos (до последнего тика) к текущему на долю тика alpha
+    """
+    prev_pos = getattr(sprite, 'prev_pos', None)
+    if prev_pos is None or alpha >= 1:
+        return pygame.Rect(sprite.rect.topleft, sprite.image.get_size())
+    return pygame.Rect(round(prev_pos[0] + (sprite.rect.x - prev_pos[0]) * alpha),
+                       round(prev_pos[1] + (sprite.rect.y - prev_pos[1]) * alpha), *sprite.image.get_size())
+
+
+def get_cell(rect: pygame.Rect):
+    return rect.y // CELL_SIZE, rect.x // CELL_SIZE
+
+
 def read_map(filename: str, enemies=True):
-    with open(filename) as file:
-        content = file.readlines()
-    res = []
-    for i in range(len(content[:-1]) if enemies else len(content)):
-        line = []
-        for j in range(len(content[i].strip())):
-            line.append(int(content[i][j]))
-        res.append(line)
-    if enemies:
-        enemies = tuple(map(int, content[-1].strip().split()))
-        return res, enemies
-    else:
-        return res
+    # Разобранные карты кэшируются до изменения файла, поэтому карта общая и менять ее нельзя
+    stat = os.stat(filename)
+    key = (filename, enemies, stat.st_mtime_ns, stat.st_size)
+    if key not in MAP_CACHE:
+        with open(filename) as file:
+            content = file.readlines()
+        res = []
+        for i in range(len(content[:-1]) if enemies else len(content)):
+            line = []
+            for j in range(len(content[i].strip())):
+                line.append(int(content[i][j]))
+            res.append(tuple(line))
+        if enemies:
+            MAP_CACHE[key] = tuple(res), tuple(map(int, content[-1].strip().split()))
+        else:
+            MAP_CACHE[key] = tuple(res)
+    return MAP_CACHE[key]
 
 
 if __name__ == '__main__':
-    pygame.init()
-    while EXIT_TO_MENU:
-        game = Game()
-        game.main_loop()
+    parser = argparse.ArgumentParser(description='Tanks')
+    parser.add_argument('--level', type=int, help='начать с уровня без показа меню')
+    parser.add_argument('--headless', action='store_true', help='симуляция без окна на максимальной скорости')
+    parser.add_argument('--ticks', type=int, default=FPS * 60, help='число тиков для --headless')
+    parser.add_argument('--seed', type=int, help='сид генератора случайных чисел')
+    parser.add_argument('--record', metavar='FILE', help='записать первую игру в файл')
+    parser.add_argument('--replay', metavar='FILE', help='воспроизвести запись без окна и сверить результат')
+    parser.add_argument('--seek', type=int, metavar='TICK', help='для --replay: перемотать запись к тику')
+    parser.add_argument('--horde', type=int, metavar='ENEMIES', help='режим орды: до ENEMIES врагов на поле')
+    parser.add_argument('--waves', type=int, default=10, help='для --horde: сколько раз повторить врагов уровня')
+    args = parser.parse_args()
+    if args.horde:
+        HORDE = Horde(args.horde, args.waves)
+    if args.headless or args.replay:
+        os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        os.environ['SDL_AUDIODRIVER'] = 'dummy'
+        pygame.init()
+        if args.replay:
+            replay = Replay(args.replay)
+            TWO_PLAYERS = replay.two_players
+            if replay.horde is not None:
+                HORDE = Horde()
+                HORDE.set_state(replay.horde)
+            game = Game(replay.level, headless=True, seed=replay.seed)
+            # Уровни и жизни игроков (например, после "Продолжить") есть только в начальном снимке записи
+            keyframe = replay.keyframe(0)
+            if keyframe is not None:
+                game.restore(keyframe[1])
+            start = time.perf_counter()
+            if args.seek is None:
+                ticks = game.simulate(replay.ticks, replay)
+            else:
+                ticks = game.seek(replay, min(args.seek, replay.ticks))
+        else:
+            game = Game(args.level or 1, headless=True, seed=args.seed)
+            if args.record:
+                game.start_recording(args.record)
+            start = time.perf_counter()
+            ticks = game.simulate(args.ticks)
+            if game.recorder is not None:
+                game.stop_recording()
+        elapsed = time.perf_counter() - start
+        print(f'level {game.level}, tick {ticks}, {elapsed:.2f} s, game over: {game.game_over}')
+        if args.replay and game.tick == replay.ticks and replay.checksum is not None:
+            print('replay matches' if game.checksum() == replay.checksum else 'replay desync')
+    else:
+        pygame.init()
+        level, seed, record = args.level, args.seed, args.record
+        while EXIT_TO_MENU:
+            game = Game(level, seed=seed)
+            if record and game.run:
+                game.start_recording(record)
+            game.main_loop()
+            if game.recorder is not None:
+                game.stop_recording()
+                record = None
+            level = seed = None
     pygame.quit()
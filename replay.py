@@ -0,0 +1,149 @@
+"""
+Запись матча для воспроизведения и перемотки.
+
+Файл состоит из текстового заголовка и потока сжатых блоков:
+    tanks-replay 2
+    {"seed": ..., "level": ..., "two_players": ..., "horde": ...}
+    <блок><блок>...
+Блок - это вид (1 байт), тик (4 байта), длина данных (4 байта) и данные, сжатые zlib.
+Виды блоков:
+    C - команды игроков [[тик, номер игрока, направление U/D/L/R/-, выстрел 0/1], ...],
+        команда пишется только когда меняется;
+    K - снимок состояния игры Game.snapshot() после тика; первый снимок пишется при начале записи,
+        с него начинается воспроизведение (уровни и жизни игроков есть только в нем);
+    E - конец записи [число тиков, контрольная сумма состояния].
+Блоки только дописываются в конец и сбрасываются на диск вместе со снимками,
+поэтому после падения игры запись читается до последнего целого блока.
+Индекс снимков для перемотки собирается по заголовкам блоков, без распаковки снимков
+"""
+import bisect
+import json
+import os
+import struct
+import zlib
+
+import pygame
+
+MAGIC = 'tanks-replay 2'
+CHUNK = struct.Struct('<cII')
+DIRECTIONS = {pygame.K_UP: 'U', pygame.K_DOWN: 'D', pygame.K_LEFT: 'L', pygame.K_RIGHT: 'R', None: '-'}
+CODES = {code: direction for direction, code in DIRECTIONS.items()}
+
+
+class ReplayRecorder:
+    def __init__(self, filename, seed, level, two_players=False, horde=None):
+        """
+        horde - настройки режима орды (Horde.get_state()) или None
+        """
+        self.file = open(filename, 'wb')
+        self.file.write(f'{MAGIC}\n'.encode())
+        header = {'seed': seed, 'level': level, 'two_players': two_players, 'horde': horde}
+        self.file.write((json.dumps(header) + '\n').encode())
+        self.commands = []
+        self.directions = dict()
+
+    def record(self, tick, commands):
+        for number, (direction, shoot) in sorted(commands.items()):
+            if shoot or self.directions.get(number) != direction:
+                self.directions[number] = direction
+                self.commands.append([tick, number, DIRECTIONS[direction], int(bool(shoot))])
+
+    def add_keyframe(self, tick, snapshot):
+        self.write_commands()
+        self.write_chunk(b'K', tick, snapshot)
+        self.flush()
+
+    def close(self, ticks, checksum):
+        self.write_commands()
+        self.write_chunk(b'E', ticks, [ticks, checksum])
+        self.flush()
+        self.file.close()
+
+    def write_commands(self):
+        if self.commands:
+            self.write_chunk(b'C', self.commands[-1][0], self.commands)
+            self.commands = []
+
+    def write_chunk(self, kind, tick, data):
+        payload = zlib.compress(json.dumps(data, separators=(',', ':')).encode())
+        self.file.write(CHUNK.pack(kind, tick, len(payload)))
+        self.file.write(payload)
+
+    def flush(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+
+class Replay:
+    """
+    Загруженная запись. commands(tick) отдает команды игроков на тик,
+    поэтому объект можно передать в Game.simulate как сценарий.
+    keyframe(tick) - ближайший снимок не позже тика
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.changes = dict()
+        self.keyframes = []
+        self.ticks = self.checksum = None
+        last_tick = 0
+        size = os.path.getsize(filename)
+        with open(filename, 'rb') as file:
+            if file.readline().decode().strip() != MAGIC:
+                raise ValueError(f'{filename} is not a replay')
+            header = json.loads(file.readline())
+            self.seed = header['seed']
+            self.level = header['level']
+            self.two_players = header['two_players']
+            self.horde = header.get('horde')
+            while True:
+                head = file.read(CHUNK.size)
+                if len(head) < CHUNK.size:
+                    break
+                kind, tick, length = CHUNK.unpack(head)
+                offset = file.tell()
+                if offset + length > size:
+                    # Недописанный блок после падения
+                    break
+                if kind == b'K':
+                    self.keyframes.append((tick, offset, length))
+                    file.seek(length, os.SEEK_CUR)
+                else:
+                    try:
+                        data = json.loads(zlib.decompress(file.read(length)))
+                    except (zlib.error, ValueError):
+                        break
+                    if kind == b'C':
+                        for command_tick, number, direction, shoot in data:
+                            self.changes.setdefault(command_tick, []).append((number, CODES[direction], shoot == 1))
+                    elif kind == b'E':
+                        self.ticks, self.checksum = data
+                last_tick = max(last_tick, tick)
+        if self.ticks is None:
+            self.ticks = last_tick
+        self.keyframe_ticks = [tick for tick, offset, length in self.keyframes]
+        self.directions = dict()
+        self.tick = 0
+
+    def keyframe(self, tick):
+        index = bisect.bisect_right(self.keyframe_ticks, tick) - 1
+        if index < 0:
+            return None
+        keyframe_tick, offset, length = self.keyframes[index]
+        with open(self.filename, 'rb') as file:
+            file.seek(offset)
+            return keyframe_tick, json.loads(zlib.decompress(file.read(length)))
+
+    def commands(self, tick):
+        # Направления держатся до следующего изменения, выстрел - только на своем тике
+        if tick < self.tick:
+            self.directions = dict()
+            self.tick = 0
+        while self.tick < tick:
+            self.tick += 1
+            for number, direction, shoot in self.changes.get(self.tick, ()):
+                self.directions[number] = direction
+        shots = {number for number, direction, shoot in self.changes.get(tick, ()) if shoot}
+        return {number: (direction, number in shots) for number, direction in self.directions.items()}
+
+    def __call__(self, game):
+        return self.commands(game.tick + 1)